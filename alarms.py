@@ -1,12 +1,11 @@
 import argparse
 import os
 
-import numpy
 import numpy as np
 from bs4 import BeautifulSoup as bs
 from config import BUFFER_DIR, XML_INVENTORY
+from ring_buffer import RING_EXTENSION, RingBuffer
 
-import pandas as pd
 from scipy import interpolate
 
 from obspy import Trace, UTCDateTime, read_inventory
@@ -99,14 +98,26 @@ def create_alarm_from_data(type_connection='server'):
     # CREATE ALARMS
     alarms = []
     for file in os.listdir(BUFFER_DIR):
-        if file == 'streams.data':
+        if not file.endswith(RING_EXTENSION):
             continue
 
-        data = pd.read_feather(BUFFER_DIR+'/'+file)
+        try:
+            ring = RingBuffer.open(BUFFER_DIR+'/'+file)
+        except (FileNotFoundError, ValueError):
+            # channel removed since listdir, or not a ring buffer of this version: the other channels are checked
+            continue
+        try:
+            data = ring.snapshot()
+        except BlockingIOError:
+            # ring buffer written during all the attempts of the snapshot, checked at the next pass
+            continue
+        finally:
+            ring.close()
 
         # here you implement probes
 
-        datetime, detail, _id, problem, state, station = below_noise_model(file, data, XML_INVENTORY)
+        datetime, detail, _id, problem, state, station = below_noise_model(file[:-len(RING_EXTENSION)], data,
+                                                                           XML_INVENTORY)
 
 
     # ADDING THE ALARMS TO THE FILE
@@ -118,6 +129,8 @@ def create_alarm_from_data(type_connection='server'):
 
 def below_noise_model(station, data, inv, save_plot=False):
     tr = df_to_trace(station, data)
+    if tr is None:
+        return None, f'No data. BelowLowNoiseModel of {station}', None, 0, None, None
     ppsd = PPSD(tr.stats, metadata=inv)
     ppsd.add(tr)
 
@@ -158,16 +171,23 @@ def below_noise_model(station, data, inv, save_plot=False):
 
 
 def df_to_trace(station, data):
+    """
+    Trace of the longest contiguous segment of a ring buffer snapshot. The start time and the sampling rate are given by
+    the segment, there is no time axis to rebuild.
+    :param station: NET.STA.LOC.CHA
+    :param data: list of Segment (RingBuffer.snapshot)
+    :return: obspy Trace, None if the ring buffer has no segment (channel just created)
+    """
     station = station.split('.')
     net, sta, loc, cha = station[0], station[1], station[2], station[3]
 
-    data_x = data['Date'].values
-    data_sta = data['Data_Sta'].values
-    delta_t = data_x[1] - data_x[0]
-    fs = round(numpy.timedelta64(1, 's') / delta_t, 1)
-    starttime = UTCDateTime(str(data_x[0]))
+    if not data:
+        return None
+    segment = max(data, key=len)
+    fs = segment.sampling_rate
+    starttime = UTCDateTime(segment.starttime)
 
-    tr = Trace(data_sta)
+    tr = Trace(np.asarray(segment.data, dtype=np.float64))
     tr.stats.network = net
     tr.stats.station = sta
     tr.stats.location = loc
@@ -14,13 +14,15 @@
 
 import base64
 import gc
+import glob
+import json
 import os
 import psutil
 import webbrowser
 import logging as log
 
 import dash
-from dash.dependencies import Input, Output, State, MATCH
+from dash.dependencies import Input, Output, State, ALL, MATCH
 from dash import dcc
 from dash import html
 
@@ -28,13 +30,23 @@ import dash_bootstrap_components as dbc
 import plotly.graph_objects as go
 
 from obspy import read
+import numpy as np
 import pandas as pd
 
 # style and config
 from assets.style import *
 # from config import *
 from state_health import *
-from utils import get_network_list, delete_residual_data
+from utils import get_network_list, delete_residual_data, parse_servers
+from ring_buffer import RingBufferReader, ring_path, segments_to_arrays
+from control import is_server, read_streams_file, send_control, split_servers
+from catalog import read_catalog
+from availability import DAY, daily_coverage
+from history import read_history, trim_segment
+from latency import read_latency
+from pyramid import bin_duration, choose_level, pyramid_key_paths, read_level
+from push import new_samples, register_push
+from overview import OverviewTiles, duration_label, register_overview
 from bs4 import BeautifulSoup as BS
 
 # sidebar connection
@@ -53,6 +65,9 @@ app.scripts.config.serve_locally = True
 
 app.title = 'MONA-JH'
 server = app.server
+if PUSH_ENABLED:
+    # new samples, alarms and states sent to the browser as they come (see push.py and assets/push.js)
+    register_push(server)
 # global variables which are useful, dash will say remove these variables, I say let them exist, else I will have
 # problems between some callbacks.
 
@@ -61,15 +76,19 @@ try:
 except NameError:
     pass
 
-# Remove all the data residual files if they exist
-delete_residual_data()
+# Remove the residual files, the ring buffers are kept (warm start: the graphs show at once the last data received)
+delete_residual_data(delete_streams=False, delete_rings=False)
 
 time_graphs_names = []
 time_graphs = []
-fig_list = []
 network_list = []
 network_list_values = []
+channel_servers = {}  # NET.STA.LOC.CHA -> server (host:port) which sends it
 interval_time_graphs = []
+ring_reader = RingBufferReader()
+pyramid_reader = RingBufferReader(pyramid_key_paths)
+overview_tiles = OverviewTiles()  # PNG tiles of the overview of many channels (see overview.py)
+register_overview(server, overview_tiles)
 init_oracle_client(CLIENT_ORACLE)
 client_oracle = OracleClient()
 
@@ -176,6 +195,15 @@ def render_connection(tab):
                              html.P('Connection not active', style={'color': 'red'})
                              ]
                      ),
+            dbc.RadioItems(
+                id='graph-mode',
+                options=[
+                    {'label': 'Time graphs', 'value': 'graphs'},
+                    {'label': 'Overview', 'value': 'overview'}
+                ],
+                value='graphs',
+                inline=True
+            ),
             dbc.RadioItems(
                 id='realtime-radiobox',
                 options=[
@@ -225,6 +253,15 @@ def render_connection(tab):
                              html.P('Folder not active', style={'color': 'red'})
                              ]
                      ),
+            dbc.RadioItems(
+                id='graph-mode',
+                options=[
+                    {'label': 'Time graphs', 'value': 'graphs'},
+                    {'label': 'Overview', 'value': 'overview'}
+                ],
+                value='graphs',
+                inline=True
+            ),
             dbc.RadioItems(
                 id='realtime-radiobox',
                 options=[
@@ -272,7 +309,7 @@ def display_data_retrieval(value, tab):
     # global client_thread
     if value == 'realtime':
         if tab == 'server':
-            delete_residual_data(delete_streams=False)
+            delete_residual_data(delete_streams=False, delete_rings=False)
             # try:
             #     client.data_retrieval = False
             #     client_thread.close()
@@ -385,20 +422,32 @@ def connect_update_server(n_clicks, value, tab):
 
     if tab == 'server':
         if value is not None:
+            # several servers can be given, separated by commas, their channels are shown together
+            channel_servers.clear()
             try:
-                server_info = value.split(':')
-                if len(server_info) == 1:
-                    server_hostname = server_info[0]
-                    server_port = 18000
-                else:
-                    server_hostname = server_info[0]
-                    server_port = server_info[1]
-
-                connected = get_network_list('server', network_list, network_list_values,
-                                 server_hostname=server_hostname, server_port=server_port)
+                connected = None
+                for server_hostname, server_port in parse_servers(value):
+                    server = f'{server_hostname}:{server_port}'
+                    server_list = []
+                    server_list_values = []
+                    server_connected = get_network_list('server', server_list, server_list_values,
+                                                        server_hostname=server_hostname, server_port=server_port)
+                    if server_connected != 1:
+                        if connected is None:
+                            connected = server_connected
+                        continue
+                    connected = 1
+                    for option in server_list:
+                        if option['value'] in channel_servers:
+                            continue
+                        channel_servers[option['value']] = server
+                        if ',' in value:
+                            option['label'] = f"{option['value']} ({server})"
+                        network_list.append(option)
+                        network_list_values.append(option['value'])
                 # client = EasySLC(value, network_list, network_list_values)
 
-            except SeedLinkException:
+            except (SeedLinkException, ValueError):
                 connected = 0
                 # client.connected = 0
 
@@ -548,6 +597,15 @@ def update_list_station(n_clicks):
     except AttributeError:
         print('No station found for OracleClient.')
 
+    # stations with the quality of their miniSEED records (see quality.py)
+    for path in glob.glob('log/server/states_mseed*.xml'):
+        with open(path, 'r', encoding='utf-8') as fp:
+            for bs_station in BS(fp.read(), 'lxml-xml').find_all('station'):
+                sta = bs_station.get('name')
+                if sta not in stations_names:
+                    stations.append({'label': sta, 'value': sta})
+                    stations_names.append(sta)
+
     return [dcc.Dropdown(id='station-list-one-choice', placeholder='Select a station',
                          options=stations, multi=False, style={'color': 'black'})]
 
@@ -584,6 +642,10 @@ def update_states(station_name, n_intervals, tab):
 graph_top = html.Div(children=[
     html.Div(id='alarm-alert', children=[]),
     html.Div(id='old-number-alarms', children=0, hidden=True),
+    # clicked by assets/push.js when the push stream says that the alarms or the states changed
+    html.Button(id='push-alarms', n_clicks=0, hidden=True),
+    html.Button(id='push-states', n_clicks=0, hidden=True),
+    html.Div(id='push-enabled', hidden=True) if PUSH_ENABLED else None,
     html.Div(id='content_top_output'),
     html.Div(children=None, id='data-output', hidden=True),
     html.Br()])
@@ -628,14 +690,219 @@ def create_alert(nb_alarms, old_nb_alarms, n_clicks):
 # FUNCTION TO RETRIEVE DATA AND STORE IT IN DATA BUFFER FOLDER
 
 
+def read_station_segments(station, start=None):
+    """
+    Snapshot of the ring buffer of a station written by the SeedLink client.
+    :param station: NET.STA.LOC.CHA
+    :param start: timestamp (s), the samples older than the ring buffer since then are read in the compressed history
+    of the SeedLink client (see history.py)
+    :return: list of Segment ordered in time
+    """
+    try:
+        segments = ring_reader.snapshot(station)
+    except (FileNotFoundError, BlockingIOError):
+        segments = []
+
+    if start is not None:
+        ring_start = segments[0].starttime if segments else UTCDateTime().timestamp
+        if start < ring_start:
+            segments = read_history(station, start, ring_start - 1e-6) + segments
+    return segments
+
+
+def read_station_range(station, start=None, end=None):
+    """
+    Data of a station between start and end for its time graph, at the resolution of the window: the samples of the
+    ring buffer (and of the history) for a short window, else the level of the min/max pyramid written by the SeedLink
+    client which gives about one bin per pixel (see pyramid.py). The size of a figure is bounded whatever the window.
+    :param start: timestamp (s), if None the window is the last TIME_DELTA of the ring buffer
+    :param end: timestamp (s)
+    :return: dates (datetime64), data, start, end and level (0 for the samples)
+    """
+    if start is None or end is None:
+        ring = ring_reader.get(station)
+        end = ring.endtime() if ring is not None else None
+        if end is None:
+            end = UTCDateTime().timestamp
+        start = end - TIME_DELTA.total_seconds()
+
+    level = choose_level(end - start)
+    if level == 0:
+        segments = [trim_segment(segment.starttime, segment.sampling_rate, segment.data, start, end)
+                    for segment in read_station_segments(station, start)]
+        segments = [segment for segment in segments if segment is not None]
+    else:
+        segments = read_level(pyramid_reader, station, level, start, end)
+
+    # the time axis is only built here, the buffers hold segments (start time, sampling rate, samples). Gaps between
+    # segments are NaN, so they are not drawn. Without data, a single point is returned so the graph can be drawn.
+    times, data = segments_to_arrays(segments)
+    if len(times) == 0:
+        times, data = np.array([end]), np.array([0.])
+
+    return pd.to_datetime(times, unit='s').values, data, start, end, level
+
+
+def time_graph_figure(station, window=None):
+    """
+    Figure of the time graph of a station, and its state kept by the browser in the dcc.Store next to the graph (each
+    client has its own): the timestamp of the last sample drawn, the window zoomed by the user and the level read.
+    :param window: (start, end) timestamps zoomed by the user, None to follow the last TIME_DELTA of the data
+    :return: figure and state
+    """
+    last = None
+    if window is None:
+        ring = ring_reader.get(station)
+        last = ring.endtime() if ring is not None else None
+        end = last if last is not None else UTCDateTime().timestamp
+        start, end = end - TIME_DELTA.total_seconds(), end
+    else:
+        start, end = window
+    date_x, data_sta_y, start, end, level = read_station_range(station, start, end)
+
+    fig = go.Figure()
+    fig.update_layout(template='plotly_dark',
+                      yaxis={'autorange': True},
+                      height=HEIGHT_GRAPH,
+                      margin=dict(l=LEFT_GRAPH, r=RIGHT_GRAPH, b=BOTTOM_GRAPH, t=TOP_GRAPH, pad=4),
+                      title=station if level == 0 else f'{station} (min/max every {bin_duration(level):.2f} s)')
+    fig.add_trace(go.Scattergl(x=date_x, y=data_sta_y, mode='lines', showlegend=False,
+                               line=dict(color=COLOR_TIME_GRAPH),
+                               hovertemplate='<b>Date:</b> %{x}<br>' +
+                                             '<b>Val:</b> %{y}<extra></extra>'))
+    if window is None:
+        # the x axis follows the samples added by extendData
+        fig.update_xaxes(autorange=True)
+    else:
+        fig.update_xaxes(range=[pd.to_datetime(start, unit='s'), pd.to_datetime(end, unit='s')])
+    return fig, {'last': last, 'window': None if window is None else list(window), 'level': level}
+
+
+def relayout_window(relayout_data):
+    """
+    Window (start, end timestamps) chosen by the user in the relayoutData of a time graph, None for a double click
+    (autorange, back to the last TIME_DELTA of the data), False if the x axis did not change.
+    """
+    if not relayout_data:
+        return False
+    if relayout_data.get('xaxis.autorange'):
+        return None
+    if 'xaxis.range[0]' in relayout_data and 'xaxis.range[1]' in relayout_data:
+        return [pd.Timestamp(relayout_data['xaxis.range[0]']).timestamp(),
+                pd.Timestamp(relayout_data['xaxis.range[1]']).timestamp()]
+    if 'xaxis.range' in relayout_data:
+        return [pd.Timestamp(date).timestamp() for date in relayout_data['xaxis.range']]
+    return False
+
+
+@app.callback(Output({'type': 'time-graph', 'station': ALL}, 'extendData'),
+              Output({'type': 'time-graph', 'station': ALL}, 'figure'),
+              Output({'type': 'time-graph-state', 'station': ALL}, 'data'),
+              Input('interval-time-graph', 'n_intervals'),
+              Input({'type': 'time-graph', 'station': ALL}, 'relayoutData'),
+              State({'type': 'time-graph', 'station': ALL}, 'id'),
+              State({'type': 'time-graph-state', 'station': ALL}, 'data'),
+              prevent_initial_call=True)
+def update_time_graphs(n_intervals, relayouts, graph_ids, states):
+    """
+    Refresh of the time graphs, which stay mounted in the browser:
+        interval: the graphs following the data receive through extendData only the samples newer than the last one
+            they have (kept per client in their dcc.Store), at most maxPoints points stay in the browser. The payload
+            is the data received since the previous refresh, not the window.
+        zoom: the window chosen by the user is read again at its resolution (see read_station_range) and the figure
+            is replaced, the graph is not refreshed anymore until a double click brings it back to the last data.
+    """
+    n = len(graph_ids)
+    extend_data, figures, new_states = [dash.no_update] * n, [dash.no_update] * n, [dash.no_update] * n
+    if len(states) != n:
+        return extend_data, figures, new_states
+    triggered = {trigger['prop_id'] for trigger in dash.callback_context.triggered}
+
+    for i, (graph_id, relayout_data, state) in enumerate(zip(graph_ids, relayouts, states)):
+        station = graph_id['station']
+        state = state or {'last': None, 'window': None, 'level': 0}
+        prop_id = json.dumps(graph_id, sort_keys=True, separators=(',', ':')) + '.relayoutData'
+        if prop_id in triggered:
+            window = relayout_window(relayout_data)
+            if window is not False and (window is not None or state['window'] is not None):
+                figures[i], new_states[i] = time_graph_figure(station, window)
+                continue
+        if 'interval-time-graph.n_intervals' not in triggered or state['window'] is not None:
+            continue
+
+        if state['level'] != 0:
+            # channel sampled too fast for the samples of TIME_DELTA in one graph, the figure is drawn again
+            figures[i], new_states[i] = time_graph_figure(station)
+            continue
+        samples = new_samples(ring_reader, station, state['last'])
+        if samples is None:
+            continue
+        times, data, sampling_rate = samples
+        max_points = int(TIME_DELTA.total_seconds() * sampling_rate) + 1
+        extend_data[i] = [dict(x=[pd.to_datetime(times, unit='s').values], y=[data]), [0], max_points]
+        new_states[i] = dict(state, last=float(times[-1]))
+
+    return extend_data, figures, new_states
+
+
+def overview_images(key, rows, zoom):
+    """
+    Images of the overview: the names of the stations, then the tiles of the window of the zoom level, stretched to
+    the width of the page (a tile has a column of pixels per OVERVIEW_TILE_WIDTH-th of its time bucket).
+    """
+    height = f'{rows * OVERVIEW_ROW_HEIGHT}px'
+    images = [html.Img(src=f'/overview/{key}/labels.png',
+                       style={'height': height, 'width': f'{OVERVIEW_LABEL_WIDTH}px', 'flex': 'none'})]
+    for url in overview_tiles.urls(key, zoom):
+        images.append(html.Img(src=url, style={'height': height, 'flex': '1 1 0', 'minWidth': 0}))
+    return html.Div(children=images, style={'display': 'flex'})
+
+
+def overview_layout(stations):
+    """
+    Overview of the stations selected, drawn by the server in PNG tiles (see OverviewTiles): the browser only loads
+    images, whatever the number of stations. The interval asks again for the tiles of the last time buckets.
+    """
+    key = overview_tiles.register(stations)
+    zoom = min(1, len(OVERVIEW_DURATIONS) - 1)
+    return html.Div([
+        dbc.RadioItems(id='overview-zoom',
+                       options=[{'label': duration_label(duration), 'value': i}
+                                for i, duration in enumerate(OVERVIEW_DURATIONS)],
+                       value=zoom,
+                       inline=True),
+        html.Div(id='overview-images', children=overview_images(key, len(stations), zoom)),
+        dcc.Store(id='overview-key', data={'key': key, 'rows': len(stations), 'stations': list(stations)}),
+        dcc.Interval(id='interval-overview', interval=OVERVIEW_REFRESH, n_intervals=0)
+    ])
+
+
+@app.callback(Output('overview-images', 'children'),
+              Input('interval-overview', 'n_intervals'),
+              Input('overview-zoom', 'value'),
+              State('overview-key', 'data'),
+              prevent_initial_call=True)
+def update_overview(n_intervals, zoom, overview):
+    """New URLs of the tiles (a few bytes), the browser keeps the images of the tiles which did not change."""
+    if not overview or zoom is None:
+        return dash.no_update
+    # registered again: the dashboard only keeps the last lists of channels used (OVERVIEW_CHANNEL_SETS)
+    key = overview_tiles.register(overview['stations'])
+    return overview_images(key, overview['rows'], zoom)
+
+
 @app.callback(Output('content_top_output', 'children'),
               Input('tabs-connection', 'active_tab'),
               Input('network-list-active', 'value'),
-              Input('interval-time-graph', 'n_intervals'),
+              Input('graph-mode', 'value'),
               # Input('Trace', 'fig'),
               prevent_initial_call=True)
-def render_figures_top(tab, sta_list, n_intervals):
-
+def render_figures_top(tab, sta_list, graph_mode):
+    """
+    Graphs of the stations selected, drawn again only when the list changes: the interval refreshes them with
+    update_time_graphs, without mounting them again. With the overview mode, or more than OVERVIEW_MAX_GRAPHS
+    stations, the stations are drawn by the server in the images of the overview instead (see overview_layout).
+    """
     if VERBOSE == 2:
         pid = os.getpid()
         python_process = psutil.Process(pid)
@@ -648,84 +915,40 @@ def render_figures_top(tab, sta_list, n_intervals):
         # global client
         global time_graphs_names
         global time_graphs
-        global fig_list
         global interval_time_graphs
         if sta_list is None:
             time_graphs_names = []
             time_graphs = []
-            fig_list = []
         else:
-            for i, name in enumerate(time_graphs_names):
-                if name not in sta_list:
-                    time_graphs_names.pop(i)
-                    time_graphs.pop(i)
-                    fig_list.pop(i)
-
+            time_graphs_names = [name for name in time_graphs_names if name in sta_list]
             for station in sta_list:
                 # ADDING NEW STATION TO THE GRAPH LIST
-
                 if station not in time_graphs_names:
                     if os.path.isdir(BUFFER_DIR) is not True:
                         os.mkdir(BUFFER_DIR)
-
-                    try:
-                        data_sta = pd.read_feather(BUFFER_DIR+'/'+station+'.data')
-                    except FileNotFoundError:
-                        data_sta = pd.DataFrame({'Date': [pd.to_datetime(UTCDateTime().timestamp, unit='s')], 'Data_Sta': [0]})
-
-                    date_x = data_sta['Date'].values
-                    data_sta_y = data_sta['Data_Sta'].values
-
-                    fig = go.Figure(go.Scattergl(x=date_x, y=data_sta_y, mode='lines', showlegend=False,
-                                                 line=dict(color=COLOR_TIME_GRAPH),
-                                                 hovertemplate='<b>Date:</b> %{x}<br>' +
-                                                               '<b>Val:</b> %{y}<extra></extra>'))
-
-                    range_x = [pd.Timestamp(date_x[-1])-TIME_DELTA, pd.Timestamp(date_x[-1])]
-
-                    fig.update_layout(template='plotly_dark', title=station,
-                                      xaxis={'range': range_x},
-                                      yaxis={'autorange': True},
-                                      height=HEIGHT_GRAPH,
-                                      margin=dict(l=LEFT_GRAPH, r=RIGHT_GRAPH, b=BOTTOM_GRAPH, t=TOP_GRAPH, pad=4))
-
-                    fig_list.append(fig)
                     time_graphs_names.append(station)
-                    time_graphs.append(dcc.Graph(figure=fig, id=station, config={'displaylogo': False}))
 
+                    if graph_mode == 'overview' or len(sta_list) > OVERVIEW_MAX_GRAPHS:
+                        continue
+                    # with the push stream, the samples are added by assets/push.js and the interval is not needed
                     interval_time_graphs = dcc.Interval(
                         id='interval-time-graph',
                         interval=UPDATE_TIME_GRAPH,  # in milliseconds
                         n_intervals=0,
-                        disabled=False)
+                        disabled=PUSH_ENABLED)
 
-                # UPDATING THE EXISTING GRAPHS
-                else:
-                    i = time_graphs_names.index(station)
-
-                    try:
-                        data_sta = pd.read_feather(BUFFER_DIR+'/'+station+'.data')
-                    except FileNotFoundError:
-                        data_sta = pd.DataFrame({'Date': [pd.to_datetime(UTCDateTime().timestamp, unit='s')], 'Data_Sta': [0]})
-
-                    date_x = data_sta['Date'].values
-                    data_sta_y = data_sta['Data_Sta'].values
-
-                    fig_list[i].data = []
-                    fig_list[i].add_trace(go.Scattergl(x=date_x, y=data_sta_y, mode='lines', showlegend=False,
-                                                       line=dict(color=COLOR_TIME_GRAPH),
-                                                       hovertemplate='<b>Date:</b> %{x}<br>' +
-                                                                     '<b>Val:</b> %{y}<extra></extra>'))
-                    try:
-                        # if client.data_retrieval is False:
-                        range_x = [pd.Timestamp(date_x[-1]) - TIME_DELTA, pd.Timestamp(date_x[-1])]
-                        fig_list[i].update_xaxes(range=range_x)
-                        # else:
-                        # range_x = [pd.Timestamp(date_x[0]), pd.Timestamp(date_x[-1])]
-                        # fig_list[i].update_xaxes(range=range_x)
-                    except AttributeError:
-                        range_x = [pd.Timestamp(date_x[-1]) - TIME_DELTA, pd.Timestamp(date_x[-1])]
-                        fig_list[i].update_xaxes(range=range_x)
+            if graph_mode == 'overview' or len(sta_list) > OVERVIEW_MAX_GRAPHS:
+                time_graphs = []
+                return overview_layout(time_graphs_names)
+
+            # the figures are drawn again with the last data, the windows zoomed by the user are reset
+            time_graphs = []
+            for station in time_graphs_names:
+                fig, state = time_graph_figure(station)
+                time_graphs.append(html.Div([
+                    dcc.Graph(figure=fig, id={'type': 'time-graph', 'station': station},
+                              config={'displaylogo': False}),
+                    dcc.Store(id={'type': 'time-graph-state', 'station': station}, data=state)]))
 
         return html.Div([
             # html.H6('Connection server tab active'),
@@ -734,6 +957,42 @@ def render_figures_top(tab, sta_list, n_intervals):
         ])
 
 
+def selection_servers(channels, servers):
+    """
+    Server of each selected channel. channel_servers is only filled by the Connect callback of this process: after a
+    restart of the dashboard, or in another worker process, the channels are looked up in streams.data, then in the
+    catalogs of the servers (see catalog.py).
+    :param channels: NET.STA.LOC.CHA selected
+    :param servers: host:port of the connection input, in their order
+    :return: dict channel -> server, without the channels of no server
+    """
+    routes = {}
+    for server, server_channels in split_servers(read_streams_file()).items():
+        for channel in server_channels:
+            routes.setdefault(channel, server)
+    catalogs = {}
+    result = {}
+    for channel in channels:
+        server = channel_servers.get(channel)
+        if server not in servers:
+            server = routes.get(channel)
+        if server not in servers:
+            server = None
+            for candidate in servers:
+                if candidate not in catalogs:
+                    catalog = read_catalog(candidate)
+                    catalogs[candidate] = set(catalog['channels']) if catalog is not None else set()
+                if channel in catalogs[candidate]:
+                    server = candidate
+                    break
+        if server is None and len(servers) == 1:
+            # channels of the StationXML file of the server (see get_network_list)
+            server = servers[0]
+        if server is not None:
+            result[channel] = server
+    return result
+
+
 @app.callback(Output('data-output', 'children'),
               Input('tabs-connection', 'active_tab'),
               # Input('interval-data', 'n_intervals'),
@@ -751,15 +1010,29 @@ def update_data(tab, network_list_active, submit_value):
             if os.path.isdir(BUFFER_DIR) is not True:
                 os.mkdir(BUFFER_DIR)
 
-            with open(BUFFER_DIR+'/streams.data', 'w') as streams:
-                streams.write(submit_value)
-                for sta in network_list_active:
-                    streams.write('\n'+sta)
+            # each server followed by its channels
+            streams = []
+            if submit_value:
+                servers = [f'{server_hostname}:{server_port}' for server_hostname, server_port in
+                           parse_servers(submit_value)]
+            else:
+                # connection input empty after a restart of the dashboard, the servers of the last selection
+                servers = [server for server in split_servers(read_streams_file()) if is_server(server)]
+            routes = selection_servers(network_list_active, servers)
+            for server in servers:
+                server_channels = [sta for sta in network_list_active if routes.get(sta) == server]
+                if server_channels:
+                    streams += [server] + server_channels
+            with open(BUFFER_DIR+'/streams.data', 'w') as file:
+                file.write('\n'.join(streams))
+            # the SeedLink client applies the selection at once, streams.data is only read when it starts
+            send_control({'cmd': 'subscribe', 'streams': streams})
         else:
             try:
                 os.remove(BUFFER_DIR+'/streams.data')
             except FileNotFoundError:
                 pass
+            send_control({'cmd': 'subscribe', 'streams': []})
 
         if network_list_active is not None:
             return html.Div(children=network_list_active.copy(), id='data-output', hidden=True)
@@ -799,6 +1072,8 @@ graph_bottom = html.Div(
                  children=[
                      dbc.Tab(label='Map', tab_id='map'),
                      dbc.Tab(label='State of Health', tab_id='soh'),
+                     dbc.Tab(label='Freshness', tab_id='freshness'),
+                     dbc.Tab(label='Availability', tab_id='availability'),
                      dbc.Tab(label='Alarms in progress', tab_id='alarms_in_progress'),
                      dbc.Tab(label='Alarms completed', tab_id='alarms_completed'),
                     ],
@@ -851,8 +1126,10 @@ def complete_alarm(n_clicks, _id, tab):
               Input('interval-alarms', 'n_intervals'),
               State('tabs-connection', 'active_tab'),
               Input('station-list-one-choice', 'value'),
+              Input('push-alarms', 'n_clicks'),
+              Input('push-states', 'n_clicks'),
               prevent_initial_call=True)
-def update_alarms(tab, n_intervals, type_connection, sta):
+def update_alarms(tab, n_intervals, type_connection, sta, push_alarms, push_states):
     # COUNTING THE ALARMS WHATEVER THE TAB
     i = 0
     try:
@@ -890,41 +1167,101 @@ def update_alarms(tab, n_intervals, type_connection, sta):
             with open(f'log/{type_connection}/states.xml', 'r', encoding='utf-8') as fp:
                 content = fp.read()
                 bs_states = BS(content, 'lxml-xml')
-            bs_station = bs_states.find('station', {'name': sta})
-            if bs_station is not None:
-                for state in bs_station.find_all('state'):
-                    state_dt = state.get('datetime')
-                    if len(state_dt) == 0:
-                        state_datetime = html.B(state.get("name"))
-                        state_name = ''
-                    else:
-                        state_datetime = state_dt[1:5] + '-' + state_dt[5:7] + '-' + \
-                                         state_dt[7:9] + ' ' + state_dt[10:12] + ':' + \
-                                         state_dt[12:14] + ':' + state_dt[14:]
-                        state_name = state.get("name")
-                    states_table.append(html.Tr(
-                        [html.Td(state_datetime),
-                         html.Td(state_name),
-                         html.Td(state.get('value'))
-                         ]
-                    ))
-
-            table_body = [html.Tbody(states_table)]
-
-            states = dbc.Table(table_body,
-                               bordered=True,
-                               dark=True,
-                               hover=True,
-                               responsive=True,
-                               striped=True
-                               )
+            bs_stations = [bs_states.find('station', {'name': sta})]
         except FileNotFoundError:
             print(f'states.xml file not found in log/{type_connection}')
+            bs_stations = []
+        # quality of the miniSEED records written by the SeedLink client (see quality.py), after the Oracle states
+        for path in sorted(glob.glob(f'log/{type_connection}/states_mseed*.xml')):
+            with open(path, 'r', encoding='utf-8') as fp:
+                bs_stations.append(BS(fp.read(), 'lxml-xml').find('station', {'name': sta}))
+        for bs_station in bs_stations:
+            if bs_station is None:
+                continue
+            for state in bs_station.find_all('state'):
+                state_dt = state.get('datetime')
+                if len(state_dt) == 0:
+                    state_datetime = html.B(state.get("name"))
+                    state_name = ''
+                else:
+                    state_datetime = state_dt[1:5] + '-' + state_dt[5:7] + '-' + \
+                                     state_dt[7:9] + ' ' + state_dt[10:12] + ':' + \
+                                     state_dt[12:14] + ':' + state_dt[14:]
+                    state_name = state.get("name")
+                states_table.append(html.Tr(
+                    [html.Td(state_datetime),
+                     html.Td(state_name),
+                     html.Td(state.get('value'))
+                     ]
+                ))
+
+        table_body = [html.Tbody(states_table)]
+
+        states = dbc.Table(table_body,
+                           bordered=True,
+                           dark=True,
+                           hover=True,
+                           responsive=True,
+                           striped=True
+                           )
 
 
         return [html.Div(id='tabs-content-inline', children=states),
                 html.Div(id='number-alarms', children=i, hidden=True)]
 
+    elif tab == 'freshness':
+        # latency and gaps of the selected channels, from the tables of the SeedLink client (see latency.py)
+        selected = {stream for stream in read_streams_file()[1:] if not is_server(stream)}
+        now = UTCDateTime()
+        freshness_table = [html.Thead(html.Tr([html.Th('Channel'), html.Th('Last sample'), html.Th('Data latency'),
+                                               html.Th('Feed latency'), html.Th('Mean packet latency'),
+                                               html.Th('Gaps'), html.Th('Gap duration'), html.Th('')]))]
+        rows = []
+        for channel in read_latency(channels=selected or None, now=now.timestamp):
+            if channel['data_latency'] >= LATENCY_CRITICAL:
+                badge = dbc.Badge('Critic', color='danger', className="mr-1")
+            elif channel['data_latency'] >= LATENCY_WARNING:
+                badge = dbc.Badge('Warning', color='warning', className="mr-1")
+            else:
+                badge = dbc.Badge('OK', color='success', className="mr-1")
+            rows.append(html.Tr([html.Td(channel['channel']),
+                                 html.Td(UTCDateTime(now.timestamp - channel['data_latency'])
+                                         .strftime('%Y-%m-%d %H:%M:%S')),
+                                 html.Td(f"{channel['data_latency']:.1f} s"),
+                                 html.Td(f"{channel['feed_latency']:.1f} s"),
+                                 html.Td(f"{channel['mean_latency']:.1f} s"),
+                                 html.Td(channel['gaps']),
+                                 html.Td(f"{channel['gap_duration']:.1f} s"),
+                                 html.Td(badge)]))
+        freshness_table.append(html.Tbody(rows))
+
+        freshness = dbc.Table(freshness_table,
+                              bordered=True,
+                              dark=True,
+                              hover=True,
+                              responsive=True,
+                              striped=True
+                              )
+
+        return [html.Div(id='tabs-content-inline', children=freshness),
+                html.Div(id='number-alarms', children=i, hidden=True)]
+
+    elif tab == 'availability':
+        # coverage of each channel per day, from the availability index of the SeedLink client (see availability.py)
+        now = UTCDateTime().timestamp
+        last_day = int(now // DAY)
+        channels, days, percents = daily_coverage(last_day - AVAILABILITY_CHART_DAYS + 1, last_day, now=now)
+        fig = go.Figure(data=go.Heatmap(z=percents, x=days, y=channels, zmin=0, zmax=100,
+                                        colorscale=[[0, '#b2182b'], [0.9, '#fdb863'], [1, '#1a9850']],
+                                        hovertemplate='%{y}<br>%{x}: %{z:.2f}%<extra></extra>',
+                                        colorbar=dict(title='%')))
+        fig.update_layout(height=max(HEIGHT_GRAPH, 20 * len(channels) + TOP_GRAPH + 60),
+                          margin={"r": RIGHT_GRAPH, "t": TOP_GRAPH, "l": LEFT_GRAPH, "b": BOTTOM_GRAPH},
+                          yaxis=dict(autorange='reversed'))
+
+        return [html.Div(id='tabs-content-inline', children=dcc.Graph(figure=fig, config={'displaylogo': False})),
+                html.Div(id='number-alarms', children=i, hidden=True)]
+
     elif tab == 'alarms_in_progress':
         nc_alarms_list = []
         i = 0
@@ -1150,8 +1487,10 @@ if __name__ == '__main__':
 
     # ACTIONS TO EXECUTE IF SOFTWARE QUIT
     # #1 DELETE THE BUFFER FILES
+    ring_reader.close()
+    overview_tiles.close()
     for _, name in enumerate(time_graphs_names):
-        os.remove(BUFFER_DIR+'/'+name+'.data')
+        os.remove(ring_path(name))
         os.remove(BUFFER_DIR+'/streams.data')
 
     # if type(client) == EasySLC:
@@ -0,0 +1,103 @@
+// push.js
+// Author: Jeremy
+// Description: client of the push stream of MONA (see push.py). The new samples are added to the time graphs with
+// Plotly.extendTraces, the alarms and states changes click the hidden buttons read by the Dash callbacks.
+// Served by Dash with the other files of assets, only used if the page has the element 'push-enabled' (PUSH_ENABLED).
+
+(function () {
+    var source = null;
+    var sourceKey = null;
+
+    // time of a point of a date axis in ms: a number, or a date string of the figure (UTC, without time zone)
+    function toMs(x) {
+        if (typeof x === 'number') {
+            return x;
+        }
+        var match = String(x).replace(' ', 'T').match(/^([^.]*)(\.\d{0,3})?/);
+        return Date.parse(match[1] + (match[2] || '') + 'Z');
+    }
+
+    // time graphs of the page: station -> plotly div, the id of a dcc.Graph is its dict id in JSON
+    function timeGraphs() {
+        var graphs = {};
+        document.querySelectorAll('[id^="{"]').forEach(function (element) {
+            var id;
+            try {
+                id = JSON.parse(element.id);
+            } catch (e) {
+                return;
+            }
+            if (id.type !== 'time-graph') {
+                return;
+            }
+            var gd = element.querySelector('.js-plotly-plot');
+            if (gd) {
+                graphs[id.station] = gd;
+            }
+        });
+        return graphs;
+    }
+
+    function lastTime(gd) {
+        var trace = gd.data && gd.data[0];
+        if (!trace || !trace.x || trace.x.length === 0) {
+            return null;
+        }
+        return toMs(trace.x[trace.x.length - 1]);
+    }
+
+    function onSamples(message) {
+        var samples = JSON.parse(message.data);
+        var gd = timeGraphs()[samples.station];
+        // a graph zoomed by the user is not followed, Dash draws it again when it goes back to the last data
+        if (!gd || !window.Plotly || (gd.layout && gd.layout.xaxis && gd.layout.xaxis.autorange === false)) {
+            return;
+        }
+        // after a reconnection, the samples already drawn are sent again
+        var last = lastTime(gd);
+        var first = 0;
+        while (last !== null && first < samples.x.length && samples.x[first] <= last) {
+            first++;
+        }
+        if (first === samples.x.length) {
+            return;
+        }
+        window.Plotly.extendTraces(gd, {x: [samples.x.slice(first)], y: [samples.y.slice(first)]}, [0],
+                                   samples.maxPoints);
+    }
+
+    function click(id) {
+        var button = document.getElementById(id);
+        if (button) {
+            button.click();
+        }
+    }
+
+    // the stream is opened again when the list of graphs changes, from the last sample of each graph
+    function connect() {
+        if (!document.getElementById('push-enabled') || typeof EventSource === 'undefined') {
+            return;
+        }
+        var graphs = timeGraphs();
+        var stations = Object.keys(graphs).sort();
+        var key = stations.join(',');
+        if (source !== null && key === sourceKey) {
+            return;
+        }
+        if (source !== null) {
+            source.close();
+        }
+        var since = stations.map(function (station) {
+            var last = lastTime(graphs[station]);
+            return last === null || isNaN(last) ? '' : last / 1000;
+        });
+        source = new EventSource('/push?stations=' + encodeURIComponent(key) +
+                                 '&since=' + encodeURIComponent(since.join(',')));
+        sourceKey = key;
+        source.addEventListener('samples', onSamples);
+        source.addEventListener('alarms', function () { click('push-alarms'); });
+        source.addEventListener('states', function () { click('push-states'); });
+    }
+
+    setInterval(connect, 1000);
+})();
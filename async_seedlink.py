@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+# async_seedlink.py
+# Author: Jeremy
+# Description: asyncio version of the SeedLink client of MONA.
+
+import asyncio
+import queue
+import struct
+import time
+
+from obspy.clients.seedlink.seedlinkexception import SeedLinkException
+from obspy.clients.seedlink.slpacket import SLPacket
+
+from config import *
+from control import split_servers
+from mona_sl_client import MonaSeedLinkClient, logger
+from mseed_fast import parse_header
+from receive_queue import packet_channel
+from seedlink_state import SeedLinkState
+
+
+def parse_server(server):
+    """
+    :param server: 'host' or 'host:port' as written in streams.data
+    :return: host, port (18000 by default)
+    """
+    server_info = server.split(':')
+    if len(server_info) == 1:
+        return server_info[0], 18000
+    return server_info[0], int(server_info[1])
+
+
+class AsyncSeedLinkConnection:
+    """
+    AsyncSeedLinkConnection is one connection to a SeedLink server on the asyncio event loop: handshake (HELLO,
+    STATION, SELECT, DATA, END), then the stream of 520-byte packets. Waiting for the server never blocks the other
+    connections of the loop.
+
+    If nothing is received during SEEDLINK_KEEPALIVE seconds, an INFO ID request is sent to keep the connection open.
+    After SEEDLINK_TIMEOUT seconds without anything, or on any network error, the connection is made again after a
+    delay which starts at RECONNECT_DELAY and is doubled up to RECONNECT_MAX_DELAY. The sequence number of the last
+    packet of each station is kept, so the server sends again what was missed while reconnecting.
+
+    Attributes
+    ----------
+    host, port
+        address of the SeedLink server
+    on_packet : coroutine function
+        awaited with each data SLPacket
+    stations : dict
+        (net, sta) -> {'selectors': list of LOC+CHA, 'seqnum': last sequence number received, -1 if none}
+    state : SeedLinkState
+        if given, sequence numbers of the stations at the start (state file) and updated with each packet
+
+    Methods
+    -------
+    set_streams(streams)
+        Change the selected channels (list of NET.STA.LOC.CHA), the connection is made again (from the last sequence
+        numbers) only if channels were added. Returns True in this case.
+    run()
+        Coroutine which keeps the connection alive, to give to asyncio.create_task.
+    """
+    def __init__(self, host, port, on_packet, state=None, timeout=SEEDLINK_TIMEOUT, keepalive=SEEDLINK_KEEPALIVE):
+        self.host = host
+        self.port = int(port)
+        self.on_packet = on_packet
+        self.state = state
+        self.timeout = timeout
+        self.keepalive = keepalive
+        self.stations = {}
+        self.delay = RECONNECT_DELAY
+        self._writer = None
+        self._reconnect_now = False
+
+    def set_streams(self, streams):
+        stations = {}
+        for stream in streams:
+            full_sta_name = stream.split('.')
+            net, sta = full_sta_name[0], full_sta_name[1]
+            if (net, sta) in self.stations:
+                seqnum = self.stations[(net, sta)]['seqnum']
+            else:
+                seqnum = self.state.resume_seqnum(net, sta) if self.state is not None else -1
+            entry = stations.setdefault((net, sta), {'selectors': [], 'seqnum': seqnum})
+            entry['selectors'].append(full_sta_name[2] + full_sta_name[3])
+
+        # the removed channels are only filtered by the client, the added ones need a new negotiation
+        added = any(selector not in self.stations.get(key, {}).get('selectors', [])
+                    for key, entry in stations.items() for selector in entry['selectors'])
+        self.stations = stations
+        if added:
+            self.reconnect()
+        return added
+
+    def reconnect(self):
+        """Close the current connection, it is made again at once with the current streams."""
+        if self._writer is not None:
+            self._reconnect_now = True
+            self._writer.close()
+
+    async def run(self):
+        while True:
+            try:
+                await self._session()
+            except (OSError, EOFError, asyncio.TimeoutError, SeedLinkException) as e:
+                if self._reconnect_now:
+                    self._reconnect_now = False
+                    continue
+                logger.warning(f'SeedLink {self.host}:{self.port}: {type(e).__name__} {e}, '
+                               f'reconnecting in {self.delay:.1f} s')
+                await asyncio.sleep(self.delay)
+                self.delay = min(2 * self.delay, RECONNECT_MAX_DELAY)
+
+    async def _command(self, reader, writer, command):
+        writer.write(command.encode('ascii') + b'\r')
+        await writer.drain()
+        response = await asyncio.wait_for(reader.readline(), self.timeout)
+        if response.strip() != b'OK':
+            raise SeedLinkException(f'response to {command}: {response.strip()}')
+
+    async def _session(self):
+        if not self.stations:
+            await asyncio.sleep(1)
+            return
+
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+        self._writer = writer
+        try:
+            writer.write(b'HELLO\r')
+            await writer.drain()
+            for _ in range(2):  # server version and server identifier
+                await asyncio.wait_for(reader.readline(), self.timeout)
+
+            for (net, sta), entry in list(self.stations.items()):
+                await self._command(reader, writer, f'STATION {sta} {net}')
+                for selector in entry['selectors']:
+                    await self._command(reader, writer, f'SELECT {selector}')
+                if entry['seqnum'] >= 0:
+                    await self._command(reader, writer, f"DATA {(entry['seqnum'] + 1) % 0x1000000:06X}")
+                else:
+                    await self._command(reader, writer, 'DATA')
+            writer.write(b'END\r')
+            await writer.drain()
+
+            idle = 0.
+            while True:
+                try:
+                    signature = await asyncio.wait_for(reader.readexactly(2), self.keepalive)
+                except asyncio.TimeoutError:
+                    idle += self.keepalive
+                    if idle >= self.timeout:
+                        raise
+                    writer.write(b'INFO ID\r')
+                    await writer.drain()
+                    continue
+                idle = 0.
+
+                if signature == b'ER':
+                    # ERROR answer to the keepalive INFO request
+                    await asyncio.wait_for(reader.readline(), self.timeout)
+                    continue
+                if signature != SLPacket.SIGNATURE:
+                    raise SeedLinkException(f'unexpected data from server: {signature}')
+
+                packet_bytes = signature + await asyncio.wait_for(
+                    reader.readexactly(SLPacket.SLHEADSIZE - 2 + SLPacket.SLRECSIZE), self.timeout)
+                if packet_bytes.startswith(SLPacket.INFOSIGNATURE):
+                    continue
+
+                self.delay = RECONNECT_DELAY
+                packet = SLPacket(packet_bytes, 0)
+                # station and network codes of the miniSEED fixed header
+                record = packet.msrecord
+                key = (record[18:20].decode('ascii').strip(), record[8:13].decode('ascii').strip())
+                if key in self.stations:
+                    self.stations[key]['seqnum'] = packet.get_sequence_number()
+                    if self.state is not None:
+                        # time of the record, as the synchronous client (MonaSeedLinkConnection.update_stream)
+                        try:
+                            starttime = parse_header(record).starttime
+                        except (struct.error, ValueError):
+                            starttime = None
+                        if starttime is not None:
+                            self.state.update(key[0], key[1], self.stations[key]['seqnum'], starttime)
+                await self.on_packet(packet)
+        finally:
+            self._writer = None
+            writer.close()
+
+
+class AsyncMonaSeedLinkClient(MonaSeedLinkClient):
+    """
+    AsyncMonaSeedLinkClient receives the data with AsyncSeedLinkConnection instead of the blocking conn.collect() of
+    obspy. The packets go to the same processing as MonaSeedLinkClient (pipelines, BufferWriter). The subscription can
+    hold several servers (see split_servers in control.py): there is one connection per server on the same event
+    loop, and all the channels are written in the same ring buffers of BUFFER_DIR.
+
+    A change of the subscription (control channel) is applied on the event loop as soon as it is received; a server
+    removed from the subscription loses its connection, added channels only renegotiate the connection of their
+    server and removed channels are filtered by on_data.
+    """
+    def __init__(self, server_url, shard=0, shards=1, subscription=None, writer=None, archive=None, quality=None,
+                 latency=None, availability=None):
+        super(AsyncMonaSeedLinkClient, self).__init__(server_url, autoconnect=False, shard=shard, shards=shards,
+                                                      subscription=subscription, writer=writer, archive=archive,
+                                                      quality=quality, latency=latency,
+                                                      availability=availability)
+        self.connections = {}
+        # one state file per server, the end of the last packet of all the channels is kept together
+        self.states = {}
+        self.channel_end = {}
+        self.routes = {}
+
+    def run(self):
+        asyncio.run(self.run_async())
+
+    async def run_async(self):
+        loop = asyncio.get_running_loop()
+        self.processor.start()
+
+        def listener():
+            loop.call_soon_threadsafe(self.update_streams)
+
+        self.subscription.add_listener(listener)
+        try:
+            while True:
+                self.update_streams()
+                self.save_state()
+                self.report_stats()
+                await asyncio.sleep(1)
+        finally:
+            self.subscription.remove_listener(listener)
+
+    def update_streams(self):
+        if self.subscription.version == self.subscription_version:
+            return
+        self.subscription_version = self.subscription.version
+        new_streams = self.shard_streams(self.subscription.streams)
+        if new_streams == self.streams:
+            return
+
+        old_routes = split_servers(self.streams)
+        new_routes = split_servers(new_streams)
+        for server in list(self.connections):
+            if server not in new_routes:
+                self.save_state(force=True)
+                _, task = self.connections.pop(server)
+                task.cancel()
+                del self.states[server]
+
+        transition = set()
+        for server, channels in new_routes.items():
+            reconnected = server not in self.connections
+            if reconnected:
+                state = SeedLinkState(server, self.shard)
+                self.states[server] = state
+                for channel, end in state.channels.items():
+                    self.channel_end.setdefault(channel, end)
+                connection = AsyncSeedLinkConnection(*parse_server(server), self.on_packet, state=state)
+                self.connections[server] = (connection, asyncio.create_task(connection.run()))
+            if self.connections[server][0].set_streams(channels) or reconnected:
+                transition |= set(old_routes.get(server, [])) & set(channels)
+        self.transition_pending = transition
+        self.channels = {channel for channels in new_routes.values() for channel in channels}
+        self.routes = new_routes
+        self.streams = new_streams
+
+    def save_state(self, force=False):
+        """Save the sequence numbers of the stations every STATE_SAVE_INTERVAL seconds (see SeedLinkState)."""
+        now = time.time()
+        if not force and now - self.state_time < STATE_SAVE_INTERVAL:
+            return
+        self.state_time = now
+        for server, state in self.states.items():
+            state.channels.update({channel: self.channel_end[channel] for channel in self.routes.get(server, [])
+                                   if channel in self.channel_end})
+            try:
+                state.save()
+            except OSError as e:
+                logger.error(f'SeedLink state file of {server} not saved: {e}', extra={'key': 'state:' + server})
+
+    async def on_packet(self, packet):
+        if packet.get_type() in (SLPacket.TYPE_SLINF, SLPacket.TYPE_SLINFT):
+            return
+        # decoded by the processing thread
+        channel = packet_channel(packet)
+        try:
+            self.queue.put(channel, packet, block=False)
+        except queue.Full:
+            # 'block' policy: only this connection waits for the processing, in a thread of the executor, the other
+            # connections and the keepalives of the event loop go on
+            await asyncio.get_running_loop().run_in_executor(None, self.queue.put, channel, packet)
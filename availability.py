@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+# availability.py
+# Author: Jeremy
+# Description: persisted index of the time ranges received by the SeedLink client, per channel and per day.
+
+import argparse
+import bisect
+import datetime
+import fnmatch
+import glob
+import json
+import os
+import threading
+import time
+
+from config import AVAILABILITY_SAVE_INTERVAL, BUFFER_DIR
+from mona_logging import get_logger
+
+logger = get_logger('availability')
+
+DAY = 86400
+_cache = {}  # path -> (modification time, channels), day files already read by this process
+
+
+def availability_dir():
+    return os.path.join(BUFFER_DIR, 'availability')
+
+
+def day_name(day):
+    """Day number (days since 1970-01-01) -> YYYY-MM-DD."""
+    return (datetime.date(1970, 1, 1) + datetime.timedelta(days=day)).isoformat()
+
+
+def availability_path(day, shard=0, directory=None):
+    """File of the intervals received by a SeedLink client process during a day: YYYY-MM-DD.shard.json."""
+    return os.path.join(availability_dir() if directory is None else directory, f'{day_name(day)}.{shard}.json')
+
+
+def insert_interval(intervals, start, end, tolerance=0.):
+    """
+    Add [start, end] to a sorted list of disjoint intervals, merged with the intervals it touches (within tolerance).
+    A packet following the last interval only moves its end, a late packet is put in its place by binary search.
+    """
+    if intervals and start >= intervals[-1][0]:
+        last = intervals[-1]
+        if start <= last[1] + tolerance:
+            if end > last[1]:
+                last[1] = end
+        else:
+            intervals.append([start, end])
+        return
+    i = bisect.bisect_left(intervals, [start])
+    if i > 0 and intervals[i - 1][1] + tolerance >= start:
+        i -= 1
+        start = intervals[i][0]
+    j = i
+    while j < len(intervals) and intervals[j][0] <= end + tolerance:
+        end = max(end, intervals[j][1])
+        j += 1
+    intervals[i:j] = [[start, end]]
+
+
+def covered(intervals, start, end):
+    """Seconds of [start, end] covered by a sorted list of disjoint intervals."""
+    total = 0.
+    for interval_start, interval_end in intervals[max(0, bisect.bisect_left(intervals, [start]) - 1):]:
+        if interval_start >= end:
+            break
+        total += max(0., min(end, interval_end) - max(start, interval_start))
+    return total
+
+
+class AvailabilityIndex(threading.Thread):
+    """
+    AvailabilityIndex keeps the time ranges received by the SeedLink client for each channel and each day (UTC): a
+    sorted list of merged intervals [start, end[ per NET.STA.LOC.CHA. A packet following the last interval of its
+    channel only moves the end of the interval (O(1)), a late packet filling a gap is inserted by binary search and
+    merged with its neighbours.
+
+    The days modified are written every AVAILABILITY_SAVE_INTERVAL seconds in BUFFER_DIR/availability, one JSON file
+    per day and per SeedLink client process (see availability_path). Only the current and the previous days stay in
+    memory, a late packet of an older day reads its file again. The dashboard only reads these files (see coverage and
+    daily_coverage), never the ring buffers.
+
+    Attributes
+    ----------
+    days : dict
+        day number -> {NET.STA.LOC.CHA: [[start, end], ...]}
+    dirty : set
+        days modified since the last save
+    """
+    def __init__(self, shard=0, directory=None, save_interval=AVAILABILITY_SAVE_INTERVAL):
+        super(AvailabilityIndex, self).__init__(name='MONA availability index', daemon=True)
+        self.shard = shard
+        self.directory = availability_dir() if directory is None else directory
+        self.save_interval = save_interval
+        self.days = {}
+        self.dirty = set()
+        self.last_day = None
+        self._lock = threading.Lock()
+        self._closing = threading.Event()
+
+    def _day(self, day):
+        channels = self.days.get(day)
+        if channels is None:
+            # day already saved and forgotten (late packet), or written by the previous run of the client
+            channels = {channel: [list(interval) for interval in intervals]
+                        for channel, intervals in read_day(availability_path(day, self.shard, self.directory)).items()}
+            self.days[day] = channels
+            if self.last_day is None or day > self.last_day:
+                self.last_day = day
+        return channels
+
+    def add(self, channel, starttime, endtime, sampling_rate):
+        """
+        :param starttime: timestamp (s) of the first sample of the packet
+        :param endtime: timestamp (s) of the last sample of the packet, the packet covers one more sample period
+        """
+        end = endtime + 1. / sampling_rate
+        tolerance = 0.5 / sampling_rate
+        day = int(starttime // DAY)
+        with self._lock:
+            while True:
+                day_end = (day + 1) * DAY
+                intervals = self._day(day).setdefault(channel, [])
+                insert_interval(intervals, starttime, min(end, day_end), tolerance)
+                self.dirty.add(day)
+                if end <= day_end:
+                    return
+                # packet over midnight
+                starttime = day_end
+                day += 1
+
+    def save(self):
+        with self._lock:
+            days = {day: {channel: [list(interval) for interval in intervals]
+                          for channel, intervals in self.days[day].items()} for day in self.dirty}
+            self.dirty.clear()
+            if self.last_day is not None:
+                for day in [day for day in self.days if day < self.last_day - 1 and day not in days]:
+                    del self.days[day]
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            for day, channels in days.items():
+                path = availability_path(day, self.shard, self.directory)
+                temp_path = path + '.tmp'
+                with open(temp_path, 'w') as file:
+                    json.dump({'day': day_name(day), 'channels': channels}, file)
+                os.replace(temp_path, path)
+        except OSError:
+            with self._lock:
+                # written again at the next save (the days are kept in memory until then)
+                self.dirty.update(days)
+            raise
+
+    def run(self):
+        while not self._closing.wait(self.save_interval):
+            try:
+                self.save()
+            except OSError as e:
+                logger.error(f'Availability index not saved: {e}', extra={'key': 'availability'})
+
+    def close(self):
+        self._closing.set()
+        if self.is_alive():
+            self.join()
+        self.save()
+
+
+def read_day(path):
+    """
+    Intervals of a day file, read again only when it changed.
+    :return: dict NET.STA.LOC.CHA -> list of [start, end], empty if the file is missing
+    """
+    try:
+        modified = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return {}
+    cached = _cache.get(path)
+    if cached is not None and cached[0] == modified:
+        return cached[1]
+    try:
+        with open(path, 'r') as file:
+            channels = json.load(file)['channels']
+    except (OSError, ValueError, KeyError):
+        return {}
+    _cache[path] = (modified, channels)
+    return channels
+
+
+def load_day(day, directory=None):
+    """Intervals of a day of all the SeedLink client processes, merged per channel."""
+    files = sorted(glob.glob(os.path.join(availability_dir() if directory is None else directory,
+                                          f'{day_name(day)}.*.json')))
+    if len(files) == 1:
+        return read_day(files[0])
+    merged = {}
+    for path in files:
+        for channel, intervals in read_day(path).items():
+            channel_intervals = merged.setdefault(channel, [])
+            for start, end in intervals:
+                insert_interval(channel_intervals, start, end)
+    return merged
+
+
+def match(channel, patterns):
+    return patterns is None or any(fnmatch.fnmatchcase(channel, pattern) for pattern in patterns)
+
+
+def coverage(patterns, start, end, directory=None):
+    """
+    Part of [start, end] (timestamps in s) received for each channel matching the patterns, e.g. the coverage of a
+    station over the last 7 days: coverage(['NET.STA.*'], time.time() - 7 * 86400, time.time()).
+    :param patterns: fnmatch patterns of NET.STA.LOC.CHA, all the channels if None
+    :return: dict NET.STA.LOC.CHA -> percent of [start, end] covered
+    """
+    seconds = {}
+    for day in range(int(start // DAY), int((end - 1e-9) // DAY) + 1):
+        for channel, intervals in load_day(day, directory).items():
+            if match(channel, patterns):
+                seconds[channel] = seconds.get(channel, 0.) + covered(intervals, max(start, day * DAY),
+                                                                      min(end, (day + 1) * DAY))
+    return {channel: 100. * total / (end - start) for channel, total in sorted(seconds.items())}
+
+
+def daily_coverage(first_day, last_day, patterns=None, directory=None, now=None):
+    """
+    Coverage of each channel for each day, for the availability chart of the dashboard. The coverage of the current
+    day is the part of the day already elapsed.
+    :param first_day, last_day: day numbers (days since 1970-01-01), both included
+    :return: channels (sorted), days (YYYY-MM-DD) and percents (list per channel of the percent of each day)
+    """
+    if now is None:
+        now = time.time()
+    days = list(range(first_day, last_day + 1))
+    percents = {}
+    for i, day in enumerate(days):
+        duration = min(DAY, max(1., now - day * DAY))
+        for channel, intervals in load_day(day, directory).items():
+            if match(channel, patterns):
+                row = percents.setdefault(channel, [0.] * len(days))
+                row[i] = min(100., 100. * sum(interval_end - interval_start for interval_start, interval_end
+                                              in intervals) / duration)
+    channels = sorted(percents)
+    return channels, [day_name(day) for day in days], [percents[channel] for channel in channels]
+
+
+def get_arguments():
+    """returns AttribDict with command line arguments"""
+    parser = argparse.ArgumentParser(description='coverage of the channels received by the SeedLink client of MONA',
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('-c', '--channels', nargs='+', default=None,
+                        help='NET.STA.LOC.CHA patterns, e.g. "XX.STA.*" (all the channels by default)')
+    parser.add_argument('-d', '--days', type=float, default=7., help='Coverage over the last DAYS days')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_arguments()
+
+    now = time.time()
+    for channel, percent in coverage(args.channels, now - args.days * DAY, now).items():
+        print(f'{channel}: {percent:.2f}%')
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+# buffer_writer.py
+# Author: Jeremy
+# Description: background writer of the ring buffers for the SeedLink client.
+
+import os
+import threading
+import time
+
+import numpy as np
+
+from config import CHECKPOINT_BUDGET, CHECKPOINT_INTERVAL, FLUSH_INTERVAL, FLUSH_SAMPLES
+from history import History
+from mona_logging import get_logger
+from pyramid import Pyramid
+from ring_buffer import RingBuffer, checkpoint_path, ring_path
+
+logger = get_logger('writer')
+
+
+class BufferWriter(threading.Thread):
+    """
+    BufferWriter keeps the processed packets of each channel in memory and writes them to the ring buffers from its own
+    thread, so the conn.collect() loop of the SeedLink client never waits for the disk.
+
+    The dirty channels are flushed together every FLUSH_INTERVAL seconds, or sooner when a channel has FLUSH_SAMPLES
+    samples waiting. The contiguous packets of a channel are concatenated before being written, so a flush costs one
+    append per channel and per segment.
+
+    Every CHECKPOINT_INTERVAL seconds, the ring buffers modified since their last checkpoint are copied in
+    BUFFER_DIR/checkpoint (see RingBuffer.checkpoint), after a flush so the copies are consistent. The copies of a
+    round are spread over the next flushes, CHECKPOINT_BUDGET seconds at most each time, so a checkpoint never delays
+    the writing of the packets by more than that. When the SeedLink client starts again, a channel whose ring buffer is
+    missing or was left in the middle of a write is restored from its checkpoint.
+
+    The written samples are also given to history (see history.py), which keeps them compressed for hours, and to
+    pyramid (see pyramid.py), which keeps their minimum and maximum at several resolutions for the zoom of the graphs.
+
+    Attributes
+    ----------
+    flush_interval : float
+        maximum time (s) a packet waits in memory
+    flush_samples : int
+        number of waiting samples of a channel which triggers a flush
+    history : History
+        compressed history of the channels
+    pyramid : Pyramid
+        min/max decimation pyramid of the channels
+    flush_count, flushed_samples, flush_time, max_flush_time
+        statistics of the flushes (time in s), see stats()
+    write_errors : int
+        channels of a flush not written because of an error (logged, the other channels are written)
+    checkpoint_count, checkpoint_bytes, checkpoint_time, max_checkpoint_time
+        statistics of the checkpoints (time in s of each call, bounded by checkpoint_budget)
+
+    Methods
+    -------
+    add(station, starttime, sampling_rate, data)
+        Called by the SeedLink client for each processed packet.
+    flush()
+        Write all the waiting packets into the ring buffers.
+    close()
+        Flush one last time, stop the thread and close the ring buffers.
+    """
+    def __init__(self, flush_interval=FLUSH_INTERVAL, flush_samples=FLUSH_SAMPLES,
+                 checkpoint_interval=CHECKPOINT_INTERVAL, checkpoint_budget=CHECKPOINT_BUDGET, history=None,
+                 pyramid=None):
+        super(BufferWriter, self).__init__(name='MONA buffer writer', daemon=True)
+        self.flush_interval = flush_interval
+        self.flush_samples = flush_samples
+        self.checkpoint_interval = checkpoint_interval
+        self.checkpoint_budget = checkpoint_budget
+        self.history = History() if history is None else history
+        self.pyramid = Pyramid() if pyramid is None else pyramid
+        self.rings = {}
+        self.rings_checked = {}
+
+        self._pending = {}
+        self._pending_samples = {}
+        self._lock = threading.Lock()
+        self._wake_up = threading.Event()
+        self._closing = threading.Event()
+
+        self.flush_count = 0
+        self.flushed_samples = 0
+        self.flush_time = 0.
+        self.max_flush_time = 0.
+        self.write_errors = 0
+
+        self.checkpointed = {}  # station -> number of samples written in its ring buffer at its last checkpoint
+        self._checkpoint_due = []
+        self._checkpoint_started = time.time()
+        self.checkpoint_count = 0
+        self.checkpoint_calls = 0
+        self.checkpoint_bytes = 0
+        self.checkpoint_time = 0.
+        self.max_checkpoint_time = 0.
+
+    def add(self, station, starttime, sampling_rate, data):
+        with self._lock:
+            self._pending.setdefault(station, []).append((starttime, sampling_rate, data))
+            waiting = self._pending_samples.get(station, 0) + len(data)
+            self._pending_samples[station] = waiting
+            if waiting >= self.flush_samples:
+                self._wake_up.set()
+
+    def run(self):
+        while not self._closing.is_set():
+            self._wake_up.wait(self.flush_interval)
+            self._wake_up.clear()
+            try:
+                self.flush()
+                self.checkpoint()
+            except Exception as e:
+                # the thread has to go on, else the packets of all the channels would wait in memory forever
+                logger.exception(f'Buffer writer error: {e}', extra={'key': 'writer'})
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._pending_samples = {}
+        if not pending:
+            return
+
+        t_start = time.perf_counter()
+        n = 0
+        for station, chunks in pending.items():
+            # an error on a channel (disk full, bad sampling rate...) does not stop the writing of the other ones
+            try:
+                ring = self.get_ring(station)
+                # late packets (filling a gap) are put back in time order before being concatenated
+                for starttime, sampling_rate, data in coalesce(sorted(chunks, key=lambda chunk: chunk[0])):
+                    ring.append(starttime, sampling_rate, data)
+                    n += len(data)
+                    self.history.add(station, starttime, sampling_rate, data.astype(ring.dtype, copy=False))
+                    self.pyramid.add(station, starttime, sampling_rate, data)
+            except Exception as e:
+                self.write_errors += 1
+                logger.error(f'Samples of {station} not written: {e!r}', extra={'key': 'write:' + station})
+        duration = time.perf_counter() - t_start
+
+        self.flush_count += 1
+        self.flushed_samples += n
+        self.flush_time += duration
+        self.max_flush_time = max(self.max_flush_time, duration)
+
+    def checkpoint(self):
+        """
+        Copy the ring buffers of the current round of checkpoints, until checkpoint_budget is spent (one buffer at
+        least). A new round starts every checkpoint_interval seconds with the buffers modified since their last copy.
+        """
+        if self.checkpoint_interval <= 0:
+            return
+        if not self._checkpoint_due:
+            now = time.time()
+            if now - self._checkpoint_started < self.checkpoint_interval:
+                return
+            self._checkpoint_started = now
+            self._checkpoint_due = [station for station, ring in self.rings.items()
+                                    if ring.count != self.checkpointed.get(station)]
+            if not self._checkpoint_due:
+                return
+            os.makedirs(os.path.dirname(checkpoint_path(self._checkpoint_due[0])), exist_ok=True)
+
+        t_start = time.perf_counter()
+        while self._checkpoint_due and time.perf_counter() - t_start < self.checkpoint_budget:
+            station = self._checkpoint_due.pop()
+            ring = self.rings.get(station)
+            if ring is None or ring.is_deleted():
+                continue
+            try:
+                self.checkpoint_bytes += ring.checkpoint(checkpoint_path(station))
+            except OSError as e:
+                logger.error(f'Checkpoint of {station} failed: {e}', extra={'key': 'checkpoint:' + station})
+                continue
+            self.checkpointed[station] = ring.count
+            self.checkpoint_count += 1
+        duration = time.perf_counter() - t_start
+
+        self.checkpoint_calls += 1
+        self.checkpoint_time += duration
+        self.max_checkpoint_time = max(self.max_checkpoint_time, duration)
+
+    def get_ring(self, station):
+        """
+        Ring buffer of a channel, created at the first packet. Every second at most, it verifies that the file was not
+        removed from BUFFER_DIR by the dashboard (delete_residual_data), else it creates it again. A ring buffer
+        created again is restored from the checkpoint of the channel if it is recent enough.
+        """
+        now = time.time()
+        ring = self.rings.get(station)
+        if ring is not None and now - self.rings_checked[station] > 1:
+            self.rings_checked[station] = now
+            if ring.is_deleted():
+                ring.close()
+                ring = None
+        if ring is None:
+            ring = RingBuffer.create(ring_path(station), checkpoint=checkpoint_path(station))
+            self.rings[station] = ring
+            self.rings_checked[station] = now
+        return ring
+
+    def stats(self):
+        return {'flushes': self.flush_count,
+                'samples': self.flushed_samples,
+                'mean_flush_ms': 1000 * self.flush_time / self.flush_count if self.flush_count else 0.,
+                'max_flush_ms': 1000 * self.max_flush_time,
+                'write_errors': self.write_errors,
+                'checkpoints': self.checkpoint_count,
+                'checkpoint_mb': self.checkpoint_bytes / 1e6,
+                'mean_checkpoint_ms': 1000 * self.checkpoint_time / self.checkpoint_calls if self.checkpoint_calls
+                else 0.,
+                'max_checkpoint_ms': 1000 * self.max_checkpoint_time}
+
+    def close(self):
+        self._closing.set()
+        self._wake_up.set()
+        if self.is_alive():
+            self.join()
+        self.flush()
+        for ring in self.rings.values():
+            ring.close()
+        self.rings = {}
+        self.pyramid.close()
+
+
+def coalesce(chunks):
+    """
+    Concatenate the consecutive packets of a channel which follow each other (same sampling rate, start one sample
+    after the end of the previous one, within half a sample).
+    :param chunks: list of (starttime, sampling_rate, data)
+    :return: list of (starttime, sampling_rate, data)
+    """
+    merged = []
+    run = []
+    run_length = 0
+    for starttime, sampling_rate, data in chunks:
+        if run:
+            run_start, run_rate = run[0][0], run[0][1]
+            if sampling_rate != run_rate or \
+                    abs(run_start + run_length / run_rate - starttime) > 0.5 / sampling_rate:
+                merged.append((run_start, run_rate, np.concatenate([chunk[2] for chunk in run])))
+                run = []
+                run_length = 0
+        run.append((starttime, sampling_rate, data))
+        run_length += len(data)
+    if run:
+        merged.append((run[0][0], run[0][1], np.concatenate([chunk[2] for chunk in run])))
+    return merged
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+# catalog.py
+# Author: Jeremy
+# Description: catalog of the streams sent by each SeedLink server (INFO STREAMS), cached on disk for the dashboard.
+
+import json
+import os
+import threading
+import time
+
+from obspy.clients.seedlink.basic_client import Client
+
+from config import BUFFER_DIR, CATALOG_CHECK_INTERVAL, CATALOG_TIMEOUT, CATALOG_TTL
+from control import split_servers
+from mona_logging import get_logger
+
+logger = get_logger('catalog')
+
+_cache = {}  # path -> (modification time, catalog), catalogs already read by this process
+
+
+def catalog_path(server):
+    """Catalog of a server (host:port), in the catalog directory of BUFFER_DIR."""
+    return BUFFER_DIR + '/catalog/' + server.replace(':', '_') + '.json'
+
+
+def split_server(server):
+    server_info = server.split(':')
+    if len(server_info) == 1:
+        return server_info[0], 18000
+    return server_info[0], int(server_info[1])
+
+
+def fetch_streams(server, timeout=CATALOG_TIMEOUT):
+    """
+    Ask the streams of a server with a SeedLink INFO STREAMS request.
+    :return: sorted list of NET.STA.LOC.CHA
+    """
+    hostname, port = split_server(server)
+    client = Client(hostname, port, timeout=timeout)
+    return sorted('.'.join(stream) for stream in client.get_info(level='channel', cache=False))
+
+
+def write_catalog(server, channels):
+    """
+    Write the catalog of a server (temporary file then rename, the dashboard never reads it half written). The
+    channels are indexed by station (NET.STA -> list of LOC.CHA) next to the sorted list used for the dropdowns.
+    """
+    stations = {}
+    for channel in channels:
+        net, sta, loc, cha = channel.split('.')
+        stations.setdefault(net + '.' + sta, []).append(loc + '.' + cha)
+    catalog = {'server': server, 'updated': time.time(), 'channels': list(channels), 'stations': stations}
+
+    path = catalog_path(server)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as file:
+        json.dump(catalog, file)
+    os.replace(temp_path, path)
+    return catalog
+
+
+def read_catalog(server):
+    """
+    Catalog of a server, as written by write_catalog. The file is only read again when it changed, so the dashboard
+    gets the channels without parsing anything at each connection.
+    :return: dict with 'server', 'updated' (timestamp), 'channels' and 'stations', None if there is no catalog
+    """
+    path = catalog_path(server)
+    try:
+        modified = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    cached = _cache.get(path)
+    if cached is not None and cached[0] == modified:
+        return cached[1]
+    try:
+        with open(path, 'r') as file:
+            catalog = json.load(file)
+    except (OSError, ValueError):
+        return None
+    _cache[path] = (modified, catalog)
+    return catalog
+
+
+def is_expired(catalog, ttl=CATALOG_TTL):
+    return catalog is None or time.time() - catalog.get('updated', 0.) > ttl
+
+
+class CatalogRefresher(threading.Thread):
+    """
+    CatalogRefresher runs in the SeedLink client process and keeps the catalogs of the servers up to date: the servers
+    of the subscription, and the ones asked by the dashboard with the 'catalog' command of the control channel. A
+    catalog older than CATALOG_TTL is requested again to its server (INFO STREAMS); the old one is still used by the
+    dashboard until then. A server which does not answer is tried again after CATALOG_CHECK_INTERVAL.
+
+        {"cmd": "catalog", "servers": ["host:port", ...]}  ->  {"ok": true, "updated": {"host:port": timestamp, ...}}
+
+    Attributes
+    ----------
+    get_streams : function
+        returns the current subscription (servers followed by their channels, see split_servers)
+    servers : set
+        servers asked on the control channel
+    """
+    def __init__(self, get_streams=None, ttl=CATALOG_TTL, check_interval=CATALOG_CHECK_INTERVAL):
+        super(CatalogRefresher, self).__init__(name='MONA stream catalog', daemon=True)
+        self.get_streams = get_streams
+        self.ttl = ttl
+        self.check_interval = check_interval
+        self.servers = set()
+        self.failed = {}  # server -> time of the last failed request
+        self._wake = threading.Event()
+
+    def register(self, control):
+        control.register('catalog', self.request)
+
+    def request(self, request):
+        """Handler of the 'catalog' command: the expired catalogs of the servers are refreshed in the thread."""
+        updated = {}
+        for server in request['servers']:
+            self.servers.add(server)
+            catalog = read_catalog(server)
+            updated[server] = None if catalog is None else catalog['updated']
+            if is_expired(catalog, self.ttl):
+                self.failed.pop(server, None)
+        self._wake.set()
+        return {'ok': True, 'updated': updated}
+
+    def expired_servers(self):
+        servers = set(self.servers)
+        if self.get_streams is not None:
+            servers.update(split_servers(self.get_streams()))
+        now = time.time()
+        return [server for server in sorted(servers) if is_expired(read_catalog(server), self.ttl)
+                and now - self.failed.get(server, 0.) > self.check_interval]
+
+    def refresh(self, server):
+        t_start = time.perf_counter()
+        try:
+            channels = fetch_streams(server)
+        except Exception as e:
+            self.failed[server] = time.time()
+            logger.warning(f'INFO STREAMS of {server} failed: {e}', extra={'key': 'catalog:' + server})
+            return None
+        self.failed.pop(server, None)
+        logger.info(f'Catalog of {server} updated: {len(channels)} channels in {time.perf_counter() - t_start:.2f} s')
+        return write_catalog(server, channels)
+
+    def run(self):
+        while True:
+            self._wake.clear()
+            for server in self.expired_servers():
+                self.refresh(server)
+            self._wake.wait(self.check_interval)
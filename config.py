@@ -2,7 +2,7 @@
 # SERVER
 import pandas as pd
 
-VERBOSE: int = 0
+VERBOSE: int = 0  # 0: warnings and errors, 1: + summaries and statistics, 2: + details of each packet
 
 SERVER_DASH_IP: str = "localhost"
 SERVER_DASH_PORT: int = 8050
@@ -35,6 +35,10 @@ UPDATE_TIME_GRAPH: int = 15000  # in ms
 UPDATE_DATA: int = 30000
 UPDATE_TIME_STATES: int = 100000  # in ms
 UPDATE_TIME_ALARMS: int = 60000  # in ms
+PUSH_ENABLED: bool = True  # new samples, alarms and states pushed to the browser (Server-Sent Events) instead of polled
+PUSH_POLL_INTERVAL: float = 0.5  # in s, interval at which the push watcher looks at the ring buffers and log files
+PUSH_HEARTBEAT: float = 15.  # in s, comment sent on an idle push stream, so the stream of a closed browser stops
+PUSH_QUEUE_SIZE: int = 100  # events waiting for a slow browser, its next samples wait in the ring buffers
 
 # STYLE
 COLOR_TIME_GRAPH: str = "#ffe476"
@@ -47,6 +51,85 @@ RIGHT_GRAPH: int = 10
 
 # DATA BUFFER
 BUFFER_DIR: str = 'data'
+BUFFER_DTYPE: str = 'float32'  # type of the samples in the ring buffers: 'float32' or 'int32' (raw counts)
+FLUSH_INTERVAL: float = 1.0  # in s, maximum time a packet waits in memory before being written to its ring buffer
+FLUSH_SAMPLES: int = 500  # a channel with this number of waiting samples is written without waiting FLUSH_INTERVAL
+INGEST_REPORT_INTERVAL: int = 60  # in s, statistics of the SeedLink client printed if VERBOSE >= 1
+INGEST_WORKERS: int = 1  # processes of the SeedLink client, each one receives a share of the stations
+WORKER_RESTART_DELAY: float = 5.  # in s, first delay before restarting a dead worker, doubled if it dies again
+RECEIVE_QUEUE_SIZE: int = 5000  # SeedLink packets waiting between the reception and the processing
+RECEIVE_BATCH: int = 256  # packets decoded together by the processing thread (miniSEED decoding with numpy)
+RECEIVE_QUEUE_POLICY: str = 'block'  # when the queue is full: 'block', 'drop_oldest' or 'priority'
+CHANNEL_PRIORITIES: dict = {}  # 'priority' policy, NET.STA.LOC.CHA pattern -> int (default 0), e.g. {'*.*.*.HHZ': 1}
+CHECKPOINT_INTERVAL: float = 30.  # in s, copy of each modified ring buffer in BUFFER_DIR/checkpoint (0 to disable)
+CHECKPOINT_BUDGET: float = 0.05  # in s, maximum time of the checkpoints per flush, the other channels wait the next one
+HISTORY_CHANNEL_BYTES: int = 2000000  # compressed history kept in RAM for each channel (about 8 h of 25 Hz float32)
+HISTORY_BLOCK_DURATION: float = 120.  # in s, samples compressed together, a read decompresses whole blocks
+HISTORY_COMPRESSION_LEVEL: int = 6  # zlib level of the history blocks
+HISTORY_READ_TIMEOUT: float = 10.  # in s, maximum time the dashboard waits for a read of the history
+PYRAMID_LEVELS: int = 4  # min/max levels of each channel in BUFFER_DIR/pyramid, for the zoom of the graphs (0: none)
+PYRAMID_FACTOR: int = 8  # samples of the ring buffer per bin of the level 1, bins of a level per bin of the next one
+PYRAMID_CAPACITY: int = 10000  # bins kept by each level (8 samples per bin at 25 Hz: 53 min at level 1, 19 days at 4)
+PYRAMID_PIXELS: int = 1500  # width (points) of a time graph, the level read gives about one bin per pixel
+
+# SDS ARCHIVE (raw miniSEED records received by the SeedLink client)
+ARCHIVE_DIR: str = ''  # root of the SDS archive YEAR/NET/STA/CHA.D/NET.STA.LOC.CHA.D.YEAR.DOY, '' to disable it
+ARCHIVE_FLUSH_INTERVAL: float = 2.  # in s, the waiting records are written together at this interval
+ARCHIVE_MAX_OPEN_FILES: int = 512  # files (one per channel-day) kept open, the least recently used ones are closed
+ARCHIVE_QUEUE_SIZE: int = 200000  # records waiting for the archive writer, the next ones are dropped (and counted)
+
+# MINISEED QUALITY (flags and timing quality of the records, written in log/server/states_mseed.xml)
+QUALITY_WINDOW: float = 3600.  # in s, window of the aggregates of each channel (60 bins)
+QUALITY_WRITE_INTERVAL: float = 60.  # in s, the aggregates are written for the State of Health tab at this interval
+TIMING_QUALITY_WARNING: int = 80  # in %, a minimum timing quality below is a warning (problem 1)
+TIMING_QUALITY_CRITICAL: int = 50  # in %, a minimum timing quality below is critical (problem 2)
+
+# LOGGING (the messages are written to stdout by a thread of each process, see mona_logging.py)
+LOG_QUEUE_SIZE: int = 10000  # messages waiting to be written, the next ones are dropped
+LOG_RATE_INTERVAL: float = 60.  # in s, window of the rate limiting of the repeated messages (same key)
+LOG_RATE_BURST: int = 5  # messages of a same key written per window, the next ones are counted and suppressed
+LOG_SUMMARY_INTERVAL: float = 60.  # in s, packets/s of each channel logged at this interval instead of each packet
+
+# LATENCY (latency and gaps of each channel, written by the SeedLink client in BUFFER_DIR/latency)
+LATENCY_MAX_CHANNELS: int = 4096  # rows of the latency table of each SeedLink client process
+LATENCY_WARNING: float = 60.  # in s, data latency shown as a warning in the Freshness tab
+LATENCY_CRITICAL: float = 600.  # in s, data latency shown as critical in the Freshness tab
+
+# AVAILABILITY (time ranges received per channel and per day, written by the SeedLink client in BUFFER_DIR/availability)
+AVAILABILITY_SAVE_INTERVAL: float = 60.  # in s, the days modified are written at this interval
+AVAILABILITY_CHART_DAYS: int = 30  # days shown by the Availability tab
+
+# OVERVIEW (all the channels selected drawn by the dashboard in PNG tiles, see overview.py)
+OVERVIEW_MAX_GRAPHS: int = 20  # above this number of channels selected, the overview replaces the time graphs
+OVERVIEW_DURATIONS: list = [600, 3600, 6 * 3600, 24 * 3600]  # in s, windows of the overview (its zoom levels)
+OVERVIEW_TILES: int = 4  # tiles per window, a tile covers a fixed time bucket of DURATION / TILES seconds
+OVERVIEW_TILE_WIDTH: int = 400  # in px, a column of pixels shows the minimum and maximum of its time
+OVERVIEW_ROW_HEIGHT: int = 16  # in px, height of a channel in the tiles
+OVERVIEW_LABEL_WIDTH: int = 130  # in px, width of the image of the names of the channels
+OVERVIEW_WORKERS: int = 2  # processes rendering the tiles
+OVERVIEW_CACHE_TILES: int = 256  # tiles kept in memory by the dashboard
+OVERVIEW_CHANNEL_SETS: int = 64  # lists of channels kept by the dashboard (least recently used are forgotten)
+OVERVIEW_REFRESH: int = 10000  # in ms, the tile of the current time is rendered again at this interval
+OVERVIEW_RENDER_TIMEOUT: float = 30.  # in s, maximum time the dashboard waits for a tile
+
+# SEEDLINK CONNECTION (asyncio client)
+SEEDLINK_TIMEOUT: float = 30.  # in s, the connection is made again if nothing is received
+SEEDLINK_KEEPALIVE: float = 10.  # in s, an INFO ID request is sent if nothing is received
+RECONNECT_DELAY: float = 1.  # in s, first delay before reconnecting, doubled at each failure
+RECONNECT_MAX_DELAY: float = 60.  # in s
+STATE_SAVE_INTERVAL: float = 10.  # in s, the sequence numbers of the stations are saved in BUFFER_DIR/state
+BACKFILL_MAX_AGE: float = 3600.  # in s, older sequence numbers are not resumed with ARCHIVE_DIR (else QUEUE_DURATION)
+REASSEMBLY_WINDOW: float = 600.  # in s, packets of a channel older than its last one by more than this are dropped
+
+# STREAM CATALOG (INFO STREAMS of the SeedLink servers, cached in BUFFER_DIR/catalog)
+CATALOG_TTL: float = 3600.  # in s, older catalogs are requested again to the server (still used meanwhile)
+CATALOG_CHECK_INTERVAL: float = 60.  # in s, the SeedLink client looks for expired catalogs at this interval
+CATALOG_TIMEOUT: float = 20.  # in s, maximum time of an INFO STREAMS request
+
+# CONTROL CHANNEL (dashboard -> SeedLink client)
+CONTROL_SOCKET: str = BUFFER_DIR + '/control/ingest.sock'  # UNIX domain socket of the SeedLink client
+CONTROL_PORT: int = 18050  # TCP port on 127.0.0.1 used instead of CONTROL_SOCKET on the systems without UNIX sockets
+CONTROL_TIMEOUT: float = 1.  # in s, the dashboard does not wait longer for an answer of the SeedLink client
 
 # ORACLE CLIENT
 CLIENT_ORACLE: str = r'/u01/app/oracle/product/19.3.0/dbhome_1/lib'
@@ -85,3 +168,6 @@ XML_INVENTORY: str = ""
 # DATA PROCESSING
 SAMPLING_RATE: float = 25.0
 QUEUE_DURATION: int = 180
+GAP_HISTORY: int = 100  # gaps kept for each channel by the SeedLink client
+DEMEAN_WINDOW: float = 60.  # in s, window of the moving average removed from each channel
+RESAMPLER_HALF_LENGTH: int = 10  # length of the anti-alias filter of the resampler (same as scipy resample_poly)
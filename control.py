@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+# control.py
+# Author: Jeremy
+# Description: local control channel between the dashboard and the SeedLink client of MONA.
+
+import json
+import os
+import socket
+import socketserver
+import threading
+
+from config import BUFFER_DIR, CONTROL_PORT, CONTROL_SOCKET, CONTROL_TIMEOUT
+
+
+def read_streams_file():
+    """
+    Streams selected the last time the dashboard was used (each server followed by its channels NET.STA.LOC.CHA), to
+    start the SeedLink client again with the same selection. Empty list if there is no selection.
+    """
+    try:
+        with open(BUFFER_DIR + '/streams.data', 'r') as file:
+            return file.read().splitlines()
+    except FileNotFoundError:
+        return []
+
+
+def is_server(line):
+    """The servers of a subscription are given as host:port, a channel NET.STA.LOC.CHA has no ':'."""
+    return ':' in line
+
+
+def split_servers(streams):
+    """
+    Route the channels of a subscription to their server. A subscription (or streams.data) is a server followed by its
+    channels, for each server:
+        host1:port1
+        NET.STA.LOC.CHA
+        ...
+        host2:port2
+        NET.STA.LOC.CHA
+    The first line is always a server, even without port (old streams.data files).
+    :return: dict server -> list of channels, in the order of the subscription
+    """
+    routes = {}
+    channels = None
+    for i, line in enumerate(streams):
+        if i == 0 or is_server(line):
+            channels = routes.setdefault(line, [])
+        else:
+            channels.append(line)
+    return routes
+
+
+class SubscriptionState:
+    """
+    Streams the SeedLink client has to receive: each server followed by its channels NET.STA.LOC.CHA (same content as
+    streams.data, see split_servers). It is updated by the control channel; the client only compares the version
+    number with the one it applied, which costs nothing per packet.
+
+    Attributes
+    ----------
+    streams : list
+        current subscription, empty if no channel is selected
+    version : int
+        incremented at each update
+    """
+    def __init__(self, streams=None):
+        self.streams = list(streams) if streams else []
+        self.version = 1
+        self._condition = threading.Condition()
+        self._listeners = []
+
+    @classmethod
+    def from_file(cls):
+        return cls(read_streams_file())
+
+    def update(self, streams):
+        with self._condition:
+            self.streams = list(streams)
+            self.version += 1
+            self._condition.notify_all()
+        for listener in self._listeners:
+            listener()
+
+    def add_listener(self, listener):
+        """Function called (from the thread of the control channel) after each update."""
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+
+    def wait(self, timeout=None):
+        """
+        Wait until there is a subscription.
+        :return: the streams, empty if the timeout expired
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: len(self.streams) > 0, timeout)
+            return list(self.streams)
+
+    def wait_change(self, version, timeout=None):
+        with self._condition:
+            self._condition.wait_for(lambda: self.version != version, timeout)
+
+
+def control_family():
+    return socket.AF_UNIX if hasattr(socket, 'AF_UNIX') else socket.AF_INET
+
+
+def control_address():
+    """UNIX domain socket CONTROL_SOCKET, or 127.0.0.1:CONTROL_PORT on the systems without them."""
+    if control_family() == socket.AF_UNIX:
+        return CONTROL_SOCKET
+    return '127.0.0.1', CONTROL_PORT
+
+
+def worker_address(shard):
+    """
+    Control socket of a worker of IngestSupervisor (the supervisor forwards to it the requests about its channels).
+    """
+    if control_family() == socket.AF_UNIX:
+        return CONTROL_SOCKET + '.' + str(shard)
+    return '127.0.0.1', CONTROL_PORT + 1 + shard
+
+
+class _ControlHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                handler = self.server.handlers[request['cmd']]
+                response = handler(request)
+                if response is None:
+                    response = {'ok': True}
+            except (ValueError, KeyError, TypeError) as e:
+                response = {'ok': False, 'error': f'{type(e).__name__}: {e}'}
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+
+
+if hasattr(socketserver, 'ThreadingUnixStreamServer'):
+    class _UnixControlServer(socketserver.ThreadingUnixStreamServer):
+        daemon_threads = True
+        allow_reuse_address = True
+
+
+class _TCPControlServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class ControlServer(threading.Thread):
+    """
+    ControlServer listens on the control socket of the ingest process (UNIX domain socket CONTROL_SOCKET). The protocol
+    is one JSON object per line, with the command in 'cmd', and one JSON answer per line:
+
+        {"cmd": "subscribe", "streams": ["host:port", "NET.STA.LOC.CHA", ..., "host2:port", ...]}  ->  {"ok": true}
+        {"cmd": "ping"}  ->  {"ok": true}
+
+    Other commands are added with register(cmd, handler), the handler receives the request and returns the answer (a
+    dict, or None for {"ok": true}).
+    """
+    def __init__(self, address=None):
+        super(ControlServer, self).__init__(name='MONA control channel', daemon=True)
+        self.address = control_address() if address is None else address
+        self.handlers = {'ping': lambda request: None}
+
+        if control_family() == socket.AF_UNIX:
+            os.makedirs(os.path.dirname(self.address), exist_ok=True)
+            try:
+                os.remove(self.address)
+            except FileNotFoundError:
+                pass
+            server_class = _UnixControlServer
+        else:
+            server_class = _TCPControlServer
+        self.server = server_class(self.address, _ControlHandler)
+        self.server.handlers = self.handlers
+
+    def register(self, cmd, handler):
+        self.handlers[cmd] = handler
+
+    def register_subscription(self, subscription):
+        self.register('subscribe', lambda request: subscription.update(request['streams']))
+
+    def run(self):
+        self.server.serve_forever()
+
+    def close(self):
+        if self.is_alive():
+            self.server.shutdown()
+        self.server.server_close()
+
+
+def send_control(request, address=None, timeout=CONTROL_TIMEOUT):
+    """
+    Send a command to the ingest process (used by the dashboard).
+    :param request: dict with at least 'cmd'
+    :return: the answer (dict), None if the ingest process is not listening
+    """
+    if address is None:
+        address = control_address()
+    try:
+        with socket.socket(control_family(), socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(address)
+            sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+            answer = b''
+            while not answer.endswith(b'\n'):
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                answer += chunk
+        return json.loads(answer) if answer else None
+    except (OSError, ValueError):
+        return None
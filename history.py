@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+# history.py
+# Author: Jeremy
+# Description: compressed in-memory history of the channels received by the SeedLink client, beyond the ring buffers.
+
+import base64
+import bisect
+import itertools
+import threading
+import zlib
+
+import numpy as np
+
+from config import HISTORY_BLOCK_DURATION, HISTORY_CHANNEL_BYTES, HISTORY_COMPRESSION_LEVEL, HISTORY_READ_TIMEOUT
+from control import send_control
+from ring_buffer import Segment
+
+
+def encode_block(data, level=HISTORY_COMPRESSION_LEVEL):
+    """
+    Compress the samples of a block, without loss. The integer samples are replaced by their differences (as in
+    Steim), the float samples by the XOR of the bits of consecutive samples (their sign, exponent and high bits of the
+    mantissa are mostly equal, the XOR leaves zeros there). Then the bytes are shuffled (all the first bytes, then all
+    the second bytes...) before zlib, so the high bytes, mostly zero, compress well once together.
+    :param data: float32 or int32 samples
+    :return: compressed bytes
+    """
+    data = np.ascontiguousarray(data)
+    if data.dtype.kind == 'f':
+        bits = data.view(data.dtype.str.replace('f', 'u'))
+        data = np.concatenate((bits[:1], bits[1:] ^ bits[:-1]))
+    else:
+        data = np.diff(data, prepend=data.dtype.type(0)).astype(data.dtype, copy=False)
+    shuffled = data.view(np.uint8).reshape(-1, data.dtype.itemsize).T
+    return zlib.compress(shuffled.tobytes(), level)
+
+
+def decode_block(payload, dtype, npts):
+    """Samples of a block compressed by encode_block."""
+    dtype = np.dtype(dtype)
+    stored = np.dtype(dtype.str.replace('f', 'u'))
+    shuffled = np.frombuffer(zlib.decompress(payload), dtype=np.uint8).reshape(stored.itemsize, npts)
+    data = np.ascontiguousarray(shuffled.T).view(stored).ravel()
+    if dtype.kind == 'f':
+        return np.bitwise_xor.accumulate(data).view(dtype)
+    return np.cumsum(data, dtype=dtype.newbyteorder('=')).astype(dtype, copy=False)
+
+
+def trim_segment(starttime, sampling_rate, data, start, end):
+    """Segment of the samples between start and end (timestamps in s), None if there is none."""
+    first = max(0, int(np.ceil((start - starttime) * sampling_rate - 1e-6)))
+    last = min(len(data), int(np.floor((end - starttime) * sampling_rate + 1e-6)) + 1)
+    if last <= first:
+        return None
+    return Segment(starttime + first / sampling_rate, sampling_rate, data[first:last])
+
+
+class HistoryBlock:
+    """
+    Compressed contiguous samples of a channel (HISTORY_BLOCK_DURATION seconds at most), see encode_block.
+    """
+    __slots__ = ('starttime', 'sampling_rate', 'npts', 'dtype', 'payload')
+
+    def __init__(self, starttime, sampling_rate, npts, dtype, payload):
+        self.starttime = starttime
+        self.sampling_rate = sampling_rate
+        self.npts = npts
+        self.dtype = dtype
+        self.payload = payload
+
+    @property
+    def endtime(self):
+        """Timestamp of the last sample."""
+        return self.starttime + (self.npts - 1) / self.sampling_rate
+
+    def decode(self):
+        return decode_block(self.payload, self.dtype, self.npts)
+
+    def to_dict(self):
+        return {'starttime': self.starttime, 'sampling_rate': self.sampling_rate, 'npts': self.npts,
+                'dtype': self.dtype.str, 'payload': base64.b64encode(self.payload).decode('ascii')}
+
+    @classmethod
+    def from_dict(cls, block):
+        return cls(block['starttime'], block['sampling_rate'], block['npts'], np.dtype(block['dtype']),
+                   base64.b64decode(block['payload']))
+
+
+class ChannelHistory:
+    """
+    History of one channel: the samples are gathered in an open block, compressed when it holds
+    HISTORY_BLOCK_DURATION seconds or when the next samples do not follow it (gap, late packet, new sampling rate).
+    The blocks are sorted by time; when they use more than max_bytes, the oldest ones are forgotten.
+
+    Attributes
+    ----------
+    starts : list
+        timestamp (s) of the first sample of each block, for the binary search of blocks_between()
+    ends : list
+        latest timestamp (s) of the last sample of the blocks up to each one: a late block may end before the previous
+        one, the running maximum stays sorted for the binary search
+    blocks : list
+        HistoryBlock, sorted by time
+    nbytes : int
+        size of the compressed blocks
+    """
+    def __init__(self, max_bytes=HISTORY_CHANNEL_BYTES, block_duration=HISTORY_BLOCK_DURATION):
+        self.max_bytes = max_bytes
+        self.block_duration = block_duration
+        self.starts = []
+        self.ends = []
+        self.blocks = []
+        self.nbytes = 0
+        self.raw_bytes = 0
+
+        self._open_start = None
+        self._open_rate = None
+        self._open_chunks = []
+        self._open_npts = 0
+
+    def add(self, starttime, sampling_rate, data):
+        if self._open_chunks:
+            expected = self._open_start + self._open_npts / self._open_rate
+            if sampling_rate != self._open_rate or abs(starttime - expected) > 0.5 / sampling_rate:
+                self.close_block()
+        if not self._open_chunks:
+            self._open_start = starttime
+            self._open_rate = sampling_rate
+        self._open_chunks.append(data)
+        self._open_npts += len(data)
+        if self._open_npts >= self.block_duration * self._open_rate:
+            self.close_block()
+
+    def close_block(self):
+        if not self._open_chunks:
+            return
+        data = np.concatenate(self._open_chunks)
+        block = HistoryBlock(self._open_start, self._open_rate, len(data), data.dtype, encode_block(data))
+        self._open_chunks = []
+        self._open_npts = 0
+
+        # a late block (filling a gap) is put back in its place
+        i = bisect.bisect_right(self.starts, block.starttime)
+        self.starts.insert(i, block.starttime)
+        self.blocks.insert(i, block)
+        self.nbytes += len(block.payload)
+        self.raw_bytes += data.nbytes
+        while self.nbytes > self.max_bytes and len(self.blocks) > 1:
+            self.nbytes -= len(self.blocks[0].payload)
+            self.raw_bytes -= self.blocks[0].npts * self.blocks[0].dtype.itemsize
+            del self.starts[0], self.blocks[0]
+        self.ends = list(itertools.accumulate((block.endtime for block in self.blocks), max))
+
+    def open_block(self):
+        """Samples not compressed yet, as a HistoryBlock (compressed now), None if there is none."""
+        if not self._open_chunks:
+            return None
+        data = np.concatenate(self._open_chunks)
+        return HistoryBlock(self._open_start, self._open_rate, len(data), data.dtype, encode_block(data, level=1))
+
+    def blocks_between(self, start, end):
+        """Blocks (the open one included) with samples between start and end, found by binary search."""
+        i = bisect.bisect_left(self.ends, start)
+        j = bisect.bisect_right(self.starts, end)
+        blocks = [block for block in self.blocks[i:j] if block.endtime >= start]
+        if self._open_chunks and self._open_start <= end and \
+                self._open_start + (self._open_npts - 1) / self._open_rate >= start:
+            blocks.append(self.open_block())
+        return blocks
+
+
+def blocks_to_segments(blocks, start, end):
+    """Decompress the blocks and keep their samples between start and end, as a list of Segment ordered in time."""
+    segments = []
+    for block in sorted(blocks, key=lambda block: block.starttime):
+        segment = trim_segment(block.starttime, block.sampling_rate, block.decode(), start, end)
+        if segment is not None:
+            segments.append(segment)
+    return segments
+
+
+class History:
+    """
+    History holds the channels written by the BufferWriter for hours instead of the QUEUE_DURATION seconds of the ring
+    buffers, compressed in RAM (see encode_block), at most HISTORY_CHANNEL_BYTES per channel. A read only decompresses
+    the blocks overlapping the requested window.
+
+    The dashboard reads it with the 'history' command of the control channel (see read_history):
+
+        {"cmd": "history", "station": "NET.STA.LOC.CHA", "start": timestamp, "end": timestamp}
+            ->  {"ok": true, "blocks": [{"starttime", "sampling_rate", "npts", "dtype", "payload"}, ...]}
+
+    The blocks are sent compressed (payload in base64) and decompressed by the dashboard.
+
+    Methods
+    -------
+    add(station, starttime, sampling_rate, data)
+        Called by the BufferWriter with the samples written in the ring buffer.
+    read(station, start, end)
+        List of Segment between start and end.
+    """
+    def __init__(self, max_bytes=HISTORY_CHANNEL_BYTES, block_duration=HISTORY_BLOCK_DURATION):
+        self.max_bytes = max_bytes
+        self.block_duration = block_duration
+        self.channels = {}
+        self._lock = threading.Lock()
+
+    def add(self, station, starttime, sampling_rate, data):
+        with self._lock:
+            channel = self.channels.get(station)
+            if channel is None:
+                channel = ChannelHistory(self.max_bytes, self.block_duration)
+                self.channels[station] = channel
+            channel.add(starttime, sampling_rate, data)
+
+    def blocks_between(self, station, start, end):
+        with self._lock:
+            channel = self.channels.get(station)
+            return [] if channel is None else channel.blocks_between(start, end)
+
+    def read(self, station, start, end):
+        return blocks_to_segments(self.blocks_between(station, start, end), start, end)
+
+    def request(self, request):
+        """Handler of the 'history' command of the control channel."""
+        blocks = self.blocks_between(request['station'], float(request['start']), float(request['end']))
+        return {'ok': True, 'blocks': [block.to_dict() for block in blocks]}
+
+    def stats(self):
+        with self._lock:
+            nbytes = sum(channel.nbytes for channel in self.channels.values())
+            raw_bytes = sum(channel.raw_bytes for channel in self.channels.values())
+            return {'channels': len(self.channels),
+                    'mb': nbytes / 1e6,
+                    'ratio': nbytes / raw_bytes if raw_bytes else 0.,
+                    'duration_s': {station: channel.ends[-1] - channel.starts[0]
+                                   for station, channel in self.channels.items() if channel.blocks}}
+
+
+def read_history(station, start, end, address=None):
+    """
+    Samples of a channel between start and end (timestamps in s) kept by the SeedLink client (used by the dashboard).
+    :return: list of Segment ordered in time, empty if the SeedLink client is not listening
+    """
+    answer = send_control({'cmd': 'history', 'station': station, 'start': start, 'end': end}, address=address,
+                          timeout=HISTORY_READ_TIMEOUT)
+    if answer is None or not answer.get('ok'):
+        return []
+    return blocks_to_segments([HistoryBlock.from_dict(block) for block in answer['blocks']], start, end)
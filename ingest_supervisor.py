@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+# ingest_supervisor.py
+# Author: Jeremy
+# Description: runs the SeedLink client of MONA in several processes and restarts the ones which die.
+
+import multiprocessing
+import threading
+import time
+
+from catalog import CatalogRefresher
+from config import HISTORY_READ_TIMEOUT, WORKER_RESTART_DELAY
+from control import ControlServer, SubscriptionState, read_streams_file, send_control, worker_address
+from mona_logging import get_logger
+from mona_sl_client import run_client, shard_of
+
+logger = get_logger('supervisor')
+
+
+def run_worker(shard, shards, use_asyncio, queue):
+    """
+    Target of the worker processes: the subscriptions received by the supervisor on the control channel arrive on the
+    queue and are given to the client of the worker by a thread.
+    """
+    subscription = SubscriptionState(queue.get())
+
+    def relay():
+        while True:
+            subscription.update(queue.get())
+
+    threading.Thread(target=relay, name='MONA subscription relay', daemon=True).start()
+    run_client(shard, shards, use_asyncio, subscription=subscription)
+
+
+class IngestSupervisor:
+    """
+    IngestSupervisor splits the stations of streams.data between several worker processes. Each worker runs its own
+    MonaSeedLinkClient (own SeedLink connection, own BufferWriter) on the stations of its shard (see shard_of in
+    mona_sl_client.py), so the decoding, the resampling and the writing of the channels use several cores. The
+    channels of two workers are different, so each ring buffer still has only one writer.
+
+    The supervisor owns the control channel (see control.py): each subscription sent by MONA is forwarded to all the
+    workers, which keep only their shard. A worker started again receives the last subscription. The catalogs of
+    streams of the servers (see catalog.py) are also refreshed by the supervisor. The requests about one channel (its
+    compressed history) are forwarded to the control socket of the worker which receives it.
+
+    A worker which dies is started again. If it dies again shortly after, the delay before the next restart is doubled
+    (up to one minute), so a worker crashing in loop does not use all the CPU.
+
+    Attributes
+    ----------
+    workers : int
+        number of worker processes
+    use_asyncio : bool
+        the workers run AsyncMonaSeedLinkClient instead of MonaSeedLinkClient
+    processes : list
+        current multiprocessing.Process of each shard
+    streams : list
+        last subscription received on the control channel
+    """
+    def __init__(self, workers, use_asyncio=False):
+        self.workers = workers
+        self.use_asyncio = use_asyncio
+        self.processes = [None] * workers
+        self.started = [0.] * workers
+        self.delays = [WORKER_RESTART_DELAY] * workers
+        self.restart_at = [0.] * workers
+        self.queues = [None] * workers
+        self.streams = read_streams_file()
+        self._lock = threading.Lock()
+
+        self.control = ControlServer()
+        self.control.register('subscribe', self.subscribe)
+        self.control.register('history', self.forward)
+        self.catalog = CatalogRefresher(lambda: self.streams)
+        self.catalog.register(self.control)
+
+    def subscribe(self, request):
+        with self._lock:
+            self.streams = list(request['streams'])
+            for queue in self.queues:
+                if queue is not None:
+                    queue.put(self.streams)
+
+    def forward(self, request):
+        """Requests about a channel ('history') are answered by the worker which receives it."""
+        answer = send_control(request, address=worker_address(shard_of(request['station'], self.workers)),
+                              timeout=HISTORY_READ_TIMEOUT)
+        if answer is None:
+            return {'ok': False, 'error': f"worker of {request['station']} not available"}
+        return answer
+
+    def start_worker(self, shard):
+        with self._lock:
+            queue = multiprocessing.Queue()
+            queue.put(self.streams)
+            self.queues[shard] = queue
+        process = multiprocessing.Process(target=run_worker, args=(shard, self.workers, self.use_asyncio, queue),
+                                          name=f'MONA SeedLink worker {shard}')
+        process.start()
+        self.processes[shard] = process
+        self.started[shard] = time.time()
+        logger.info(f'SeedLink worker {shard + 1}/{self.workers} started (pid {process.pid})')
+
+    def check_workers(self):
+        now = time.time()
+        for shard, process in enumerate(self.processes):
+            if process is not None and process.is_alive():
+                continue
+
+            if process is not None:
+                logger.error(f'SeedLink worker {shard + 1}/{self.workers} died (exit code {process.exitcode})')
+                process.join()
+                self.processes[shard] = None
+                with self._lock:
+                    self.queues[shard] = None
+                if now - self.started[shard] < 60:
+                    self.delays[shard] = min(2 * self.delays[shard], 60.)
+                else:
+                    self.delays[shard] = WORKER_RESTART_DELAY
+                self.restart_at[shard] = now + self.delays[shard]
+
+            if now >= self.restart_at[shard]:
+                self.start_worker(shard)
+
+    def run(self):
+        self.catalog.start()
+        self.control.start()
+        try:
+            while True:
+                self.check_workers()
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def stop(self):
+        self.control.close()
+        for process in self.processes:
+            if process is not None and process.is_alive():
+                process.terminate()
+        for process in self.processes:
+            if process is not None:
+                process.join()
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+# interval_index.py
+# Author: Jeremy
+# Description: index of the time intervals already received for a channel, to remove duplicated and late packets.
+
+import bisect
+import collections
+
+from config import GAP_HISTORY, REASSEMBLY_WINDOW
+
+
+class IntervalIndex:
+    """
+    IntervalIndex holds the time intervals [start, end) already received for one channel, sorted and disjoint (two
+    intervals which touch are merged), so a packet is compared with them with a binary search, in O(log n) whatever
+    the size of the buffer (n is the number of gaps of the channel, the intervals ending more than REASSEMBLY_WINDOW
+    before the last packet are forgotten).
+
+    For each packet, add_packet gives the parts which were not received yet: nothing for a duplicated packet, the end
+    of a packet overlapping the last one, or the missing parts of a late packet filling a gap. The gaps seen in the
+    stream (a packet starting after the end of the last one) are kept in gaps. The part of a packet older than the
+    intervals kept cannot be told from a duplicate: it is dropped and the packet is counted in expired.
+
+    Attributes
+    ----------
+    starts, ends : list
+        timestamps (s) of the intervals
+    gaps : deque
+        (start, duration) of the last GAP_HISTORY gaps (s)
+    forgotten : float
+        timestamp (s) before which the intervals were forgotten, -inf if nothing was forgotten
+    expired : int
+        packets dropped because they were older than the intervals kept
+
+    Methods
+    -------
+    add_packet(starttime, sampling_rate, npts)
+        Returns the list of (first sample, number of samples) of the packet to keep, and marks them as received.
+    """
+    def __init__(self, received_until=None, horizon=REASSEMBLY_WINDOW):
+        self.starts = []
+        self.ends = []
+        self.horizon = horizon
+        self.forgotten = float('-inf')
+        self.expired = 0
+        self.gaps = collections.deque(maxlen=GAP_HISTORY)
+        if received_until is not None:
+            # state of a previous run (see SeedLinkState): all before this time was received
+            self.starts.append(received_until - horizon)
+            self.ends.append(received_until)
+            self.forgotten = received_until - horizon
+
+    @property
+    def end(self):
+        return self.ends[-1] if self.ends else None
+
+    def add_packet(self, starttime, sampling_rate, npts):
+        delta = 1. / sampling_rate
+        tolerance = 0.5 * delta
+        endtime = starttime + npts * delta
+
+        if endtime <= self.forgotten + tolerance:
+            self.expired += 1
+            return []
+        if self.ends and starttime > self.ends[-1] + tolerance:
+            self.gaps.append((self.ends[-1], starttime - self.ends[-1]))
+
+        # intervals which may overlap [starttime, endtime): the first one ending after starttime, and the next ones
+        i = bisect.bisect_right(self.ends, starttime + tolerance)
+        j = bisect.bisect_left(self.starts, endtime - tolerance)
+        pieces = []
+        first = 0 if starttime >= self.forgotten else int(round((self.forgotten - starttime) * sampling_rate))
+        for k in range(i, j):
+            last = int(round((self.starts[k] - starttime) * sampling_rate))
+            if last > first:
+                pieces.append((first, last - first))
+            first = max(first, int(round((self.ends[k] - starttime) * sampling_rate)))
+        if first < npts:
+            pieces.append((first, npts - first))
+
+        for first, n in pieces:
+            self._insert(starttime + first * delta, starttime + (first + n) * delta, tolerance)
+        self._forget(endtime - self.horizon)
+        return pieces
+
+    def _insert(self, start, end, tolerance):
+        i = bisect.bisect_left(self.ends, start - tolerance)
+        j = bisect.bisect_right(self.starts, end + tolerance)
+        if i < j:
+            # merged with the intervals it touches
+            start = min(start, self.starts[i])
+            end = max(end, self.ends[j - 1])
+        self.starts[i:j] = [start]
+        self.ends[i:j] = [end]
+
+    def _forget(self, before):
+        i = bisect.bisect_right(self.ends, before)
+        if i > 0:
+            del self.starts[:i]
+            del self.ends[:i]
+            self.forgotten = max(self.forgotten, before)
@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+# latency.py
+# Author: Jeremy
+# Description: per-channel latency and gaps measured by the SeedLink client, shared with the dashboard in a mmap table.
+
+import glob
+import mmap
+import os
+import struct
+import threading
+import time
+
+import numpy as np
+
+from config import BUFFER_DIR, LATENCY_MAX_CHANNELS
+from mona_logging import get_logger
+
+logger = get_logger('latency')
+
+TABLE_MAGIC = b'MONALATE'
+TABLE_VERSION = 1
+
+# magic, version, capacity, rows used
+TABLE_HEADER_FORMAT = '<8sIIQ'
+TABLE_HEADER_SIZE = 64
+# sequence, channel, time of reception of the last packet, end of the last sample, latency of the last packet, mean
+# latency, sampling rate, packets, gaps, total duration of the gaps, time of the last gap
+ROW_FORMAT = '<Q32sdddddQQdd'
+ROW_SIZE = struct.calcsize(ROW_FORMAT)
+ROW_DTYPE = np.dtype([('sequence', '<u8'), ('channel', 'S32'), ('last_packet', '<f8'), ('endtime', '<f8'),
+                      ('packet_latency', '<f8'), ('mean_latency', '<f8'), ('sampling_rate', '<f8'),
+                      ('packets', '<u8'), ('gaps', '<u8'), ('gap_duration', '<f8'), ('last_gap', '<f8')])
+LATENCY_SMOOTHING = 0.05  # weight of the last packet in the mean latency (exponential moving average)
+
+
+def latency_path(shard=0):
+    """Latency table of a SeedLink client process (one per worker of IngestSupervisor), in BUFFER_DIR/latency."""
+    return os.path.join(BUFFER_DIR, 'latency', f'latency.{shard}.tbl')
+
+
+class LatencyTracker:
+    """
+    LatencyTracker measures, for each channel received by the SeedLink client, the latency of the data and its gaps,
+    and publishes them in a table memory-mapped in BUFFER_DIR/latency (see latency_path). The dashboard reads the
+    table (read_latency) for the Freshness tab, without opening the ring buffers.
+
+    Each channel has a fixed row, found with a dict: add() costs a few operations and one struct.pack_into, whatever
+    the number of channels. A row is written as a seqlock, like the ring buffers: its sequence is odd during the write,
+    a reader keeps the rows read with the same even sequence before and after the copy.
+
+    Measured for each packet:
+        packet latency: reception time minus time of the last sample of the packet (mean: exponential moving average)
+        gap: the packet starts more than 1.5 sample after the last sample received (late packets are not gaps)
+    The dashboard computes from the times of the row the data latency (now minus the last sample) and the feed
+    latency (now minus the reception of the last packet).
+
+    Attributes
+    ----------
+    path : str
+        path of the table
+    rows : dict
+        NET.STA.LOC.CHA -> [row, sequence, end of the last sample, mean latency, packets, gaps, gap duration, last gap]
+    """
+    def __init__(self, path=None, capacity=LATENCY_MAX_CHANNELS):
+        self.path = latency_path() if path is None else path
+        self.capacity = capacity
+        self.rows = {}
+        self._lock = threading.Lock()
+
+        # a new table at each start, the channels of the previous run may not be received anymore
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as fp:
+            fp.write(struct.pack(TABLE_HEADER_FORMAT, TABLE_MAGIC, TABLE_VERSION, capacity, 0)
+                     .ljust(TABLE_HEADER_SIZE, b'\0'))
+            fp.truncate(TABLE_HEADER_SIZE + ROW_SIZE * capacity)
+        os.replace(tmp_path, self.path)
+        self._file = open(self.path, 'r+b')
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_WRITE)
+
+    def _new_row(self, channel):
+        with self._lock:
+            state = self.rows.get(channel)
+            if state is not None:
+                return state
+            if len(self.rows) >= self.capacity:
+                logger.warning(f'Latency table full ({self.capacity} channels), {channel} not tracked',
+                               extra={'key': 'latency full'})
+                return None
+            state = [len(self.rows), 0, None, None, 0, 0, 0., 0.]
+            self.rows[channel] = state
+            struct.pack_into('<Q', self._mm, 16, len(self.rows))
+            return state
+
+    def add(self, channel, starttime, endtime, sampling_rate, now=None):
+        """
+        :param channel: NET.STA.LOC.CHA
+        :param starttime: timestamp (s) of the first sample of the packet
+        :param endtime: timestamp (s) of the last sample of the packet
+        """
+        state = self.rows.get(channel)
+        if state is None:
+            state = self._new_row(channel)
+            if state is None:
+                return
+        if now is None:
+            now = time.time()
+        row, sequence, last_end, mean_latency, packets, gaps, gap_duration, last_gap = state
+
+        latency = now - endtime
+        mean_latency = latency if mean_latency is None else mean_latency + LATENCY_SMOOTHING * (latency - mean_latency)
+        if last_end is not None and starttime - last_end > 1.5 / sampling_rate:
+            gaps += 1
+            gap_duration += starttime - last_end - 1. / sampling_rate
+            last_gap = now
+        if last_end is None or endtime > last_end:
+            last_end = endtime
+        packets += 1
+
+        offset = TABLE_HEADER_SIZE + row * ROW_SIZE
+        struct.pack_into('<Q', self._mm, offset, sequence + 1)
+        struct.pack_into(ROW_FORMAT, self._mm, offset, sequence + 1, channel.encode('ascii'), now, last_end, latency,
+                         mean_latency, sampling_rate, packets, gaps, gap_duration, last_gap)
+        struct.pack_into('<Q', self._mm, offset, sequence + 2)
+        state[1:] = sequence + 2, last_end, mean_latency, packets, gaps, gap_duration, last_gap
+
+    def close(self):
+        self._mm.close()
+        self._file.close()
+
+
+def remove_stale_tables(shards, directory=None):
+    """
+    Remove the tables of the shards which do not run anymore (latency.N.tbl with N >= shards), left by a previous run
+    of the SeedLink client with more workers: read_latency would show their channels twice, with a stale latency.
+    """
+    if directory is None:
+        directory = os.path.join(BUFFER_DIR, 'latency')
+    for path in glob.glob(os.path.join(directory, 'latency.*.tbl')):
+        shard = os.path.basename(path).split('.')[1]
+        if shard.isdigit() and int(shard) >= shards:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def read_table(path, retries=5):
+    """
+    Rows of a latency table, without the ones being written during all the retries.
+    :return: numpy structured array (ROW_DTYPE), empty if the table is missing
+    """
+    try:
+        with open(path, 'rb') as fp:
+            mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    except (FileNotFoundError, ValueError):
+        return np.empty(0, dtype=ROW_DTYPE)
+    try:
+        magic, version, capacity, used = struct.unpack_from(TABLE_HEADER_FORMAT, mm, 0)
+        if magic != TABLE_MAGIC or version != TABLE_VERSION:
+            return np.empty(0, dtype=ROW_DTYPE)
+        table = np.ndarray((min(used, capacity),), dtype=ROW_DTYPE, buffer=mm, offset=TABLE_HEADER_SIZE)
+        rows = table.copy()
+        for _ in range(retries):
+            # a row is consistent if its sequence was even during the copy and did not change after it
+            torn = (rows['sequence'] % 2 == 1) | (rows['sequence'] != table['sequence'])
+            if not torn.any():
+                break
+            rows[torn] = table[torn]
+        else:
+            rows = rows[(rows['sequence'] % 2 == 0) & (rows['sequence'] == table['sequence'])]
+        del table
+        return rows
+    finally:
+        mm.close()
+
+
+def read_latency(directory=None, channels=None, now=None):
+    """
+    Latency of the channels of all the SeedLink client processes (used by the dashboard).
+    :param channels: only keep these NET.STA.LOC.CHA, all the channels if None
+    :return: list of dict sorted by channel, with 'data_latency' and 'feed_latency' computed at `now`
+    """
+    if directory is None:
+        directory = os.path.join(BUFFER_DIR, 'latency')
+    if now is None:
+        now = time.time()
+    latency = []
+    for path in sorted(glob.glob(os.path.join(directory, '*.tbl'))):
+        for row in read_table(path):
+            channel = row['channel'].decode('ascii')
+            if row['packets'] == 0 or (channels is not None and channel not in channels):
+                continue
+            latency.append({'channel': channel,
+                            'data_latency': now - float(row['endtime']),
+                            'feed_latency': now - float(row['last_packet']),
+                            'packet_latency': float(row['packet_latency']),
+                            'mean_latency': float(row['mean_latency']),
+                            'sampling_rate': float(row['sampling_rate']),
+                            'packets': int(row['packets']),
+                            'gaps': int(row['gaps']),
+                            'gap_duration': float(row['gap_duration']),
+                            'last_gap': float(row['last_gap']) if row['gaps'] else None,
+                            'last_packet': float(row['last_packet'])})
+    return sorted(latency, key=lambda channel: channel['channel'])
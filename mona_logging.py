@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+# mona_logging.py
+# Author: Jeremy
+# Description: non-blocking logging of MONA (queue handler, rate limiting of repeated messages, periodic summaries).
+
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+
+from config import LOG_QUEUE_SIZE, LOG_RATE_BURST, LOG_RATE_INTERVAL, LOG_SUMMARY_INTERVAL, VERBOSE
+
+LOGGER_NAME = 'mona'
+LEVELS = {0: logging.WARNING, 1: logging.INFO, 2: logging.DEBUG}  # VERBOSE -> level of the 'mona' loggers
+
+_listener = None
+_listener_pid = None
+_setup_lock = threading.Lock()
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Let through at most `burst` messages of a same key every `interval` seconds. The key is given with
+    extra={'key': ...} (e.g. 'old:NET.STA.LOC.CHA'), the messages without key are never limited. The number of
+    messages suppressed is added to the first message of the key let through after them.
+    """
+    def __init__(self, interval=LOG_RATE_INTERVAL, burst=LOG_RATE_BURST):
+        super(RateLimitFilter, self).__init__()
+        self.interval = interval
+        self.burst = burst
+        self.windows = {}  # key -> [start of the window, messages let through, messages suppressed]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        key = getattr(record, 'key', None)
+        if key is None:
+            return True
+        with self._lock:
+            window = self.windows.get(key)
+            if window is None or record.created - window[0] >= self.interval:
+                suppressed = 0 if window is None else window[2]
+                self.windows[key] = [record.created, 1, 0]
+            elif window[1] < self.burst:
+                window[1] += 1
+                return True
+            else:
+                window[2] += 1
+                return False
+        if suppressed:
+            record.msg = f'{record.getMessage()} ({suppressed} similar messages suppressed)'
+            record.args = None
+        return True
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler which never waits: when the queue is full (the terminal does not follow), the message is dropped and
+    counted, the thread which logs it goes on.
+    """
+    def __init__(self, log_queue):
+        super(DroppingQueueHandler, self).__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging(verbose=VERBOSE, stream=None):
+    """
+    Configure the 'mona' logger of this process: the messages are put in a bounded queue (DroppingQueueHandler, after
+    the rate limiting) and written by a QueueListener thread, so the reception of the packets never waits for stdout.
+    Called again in a new process (worker of IngestSupervisor), it starts the listener of this process.
+    :param verbose: 0 warnings and errors, 1 with the summaries and statistics, 2 with the details (debug)
+    """
+    global _listener, _listener_pid
+    with _setup_lock:
+        if _listener_pid == os.getpid():
+            return logging.getLogger(LOGGER_NAME)
+        logger = logging.getLogger(LOGGER_NAME)
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+
+        output = logging.StreamHandler(sys.stdout if stream is None else stream)
+        output.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(processName)s: %(message)s',
+                                              datefmt='%Y-%m-%d %H:%M:%S'))
+        handler = DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+        handler.addFilter(RateLimitFilter())
+        logger.addHandler(handler)
+        logger.setLevel(LEVELS.get(verbose, logging.DEBUG if verbose > 2 else logging.WARNING))
+        logger.propagate = False
+
+        _listener = logging.handlers.QueueListener(handler.queue, output)
+        _listener.start()
+        _listener_pid = os.getpid()
+        atexit.register(stop_logging)
+        return logger
+
+
+def stop_logging():
+    """Write the waiting messages and stop the listener thread."""
+    global _listener, _listener_pid
+    with _setup_lock:
+        if _listener is not None and _listener_pid == os.getpid():
+            _listener.stop()
+        _listener = None
+        _listener_pid = None
+
+
+def get_logger(name=None):
+    """Logger 'mona' (or 'mona.name'), the logging of the process is configured at the first call."""
+    setup_logging()
+    return logging.getLogger(LOGGER_NAME if name is None else LOGGER_NAME + '.' + name)
+
+
+class RateSummary:
+    """
+    Count events per key (packets per channel) and log one summary line every `interval` seconds instead of a line per
+    event: total rate and number of keys at INFO level, the rate of each key at DEBUG level. count() only adds to a
+    dict, the summary is made by the first count() after the interval.
+
+    Attributes
+    ----------
+    counts : dict
+        key -> events since the last summary
+    """
+    def __init__(self, logger, what='packets', interval=LOG_SUMMARY_INTERVAL):
+        self.logger = logger
+        self.what = what
+        self.interval = interval
+        self.counts = {}
+        self.start = time.monotonic()
+
+    def count(self, key, n=1):
+        self.counts[key] = self.counts.get(key, 0) + n
+        now = time.monotonic()
+        if now - self.start >= self.interval:
+            self.report(now)
+
+    def report(self, now=None):
+        now = time.monotonic() if now is None else now
+        counts, self.counts = self.counts, {}
+        duration, self.start = now - self.start, now
+        if not counts or duration <= 0:
+            return
+        total = sum(counts.values())
+        slowest = min(counts, key=counts.get)
+        self.logger.info(f'{self.what}/s: {total / duration:.1f} in {len(counts)} channels over {duration:.0f} s '
+                         f'(slowest {slowest} {counts[slowest] / duration:.2f})')
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(f'{self.what}/s per channel: ' +
+                              ', '.join(f'{key} {count / duration:.2f}' for key, count in sorted(counts.items())))
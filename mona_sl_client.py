@@ -3,10 +3,18 @@
 # Author: Jeremy
 # Description: SeedLink client for MONA, python dash version.
 
+import argparse
+import logging
+import signal
+import struct
+import sys
+import threading
 import time
+import zlib
 # from threading import Thread
 
 from obspy.clients.seedlink.client.seedlinkconnection import SeedLinkConnection
+from obspy.clients.seedlink.client.slnetstation import SLNetStation
 from obspy.clients.seedlink.easyseedlink import EasySeedLinkClient
 from obspy.clients.seedlink.seedlinkexception import SeedLinkException
 from obspy.clients.seedlink.slpacket import SLPacket
@@ -14,6 +22,49 @@ from obspy.clients.seedlink.slpacket import SLPacket
 from obspy import UTCDateTime
 
 from config import *
+from availability import AvailabilityIndex
+from buffer_writer import BufferWriter
+from catalog import CatalogRefresher
+from control import ControlServer, SubscriptionState, is_server, split_servers, worker_address
+from interval_index import IntervalIndex
+from latency import LatencyTracker, latency_path, remove_stale_tables
+from mona_logging import RateSummary, get_logger, setup_logging
+from mseed_fast import decode_records, parse_header
+from receive_queue import ReceiveQueue, packet_channel
+from quality import QualityTracker, states_path
+from sds_archive import SDSArchive
+from seedlink_state import SeedLinkState
+from streaming import ChannelPipeline
+
+logger = get_logger('ingest')
+
+
+class MonaSeedLinkConnection(SeedLinkConnection):
+    """
+    SeedLinkConnection which reads the station and the time of each packet in the fixed header of its record, to keep
+    the sequence numbers of the stations, instead of decoding the whole record into an obspy Trace.
+    """
+    def update_stream(self, slpacket):
+        seqnum = slpacket.get_sequence_number()
+        if seqnum == -1:
+            raise SeedLinkException("could not determine sequence number")
+        try:
+            record = parse_header(slpacket.msrecord)
+        except struct.error as e:
+            raise SeedLinkException(f'miniSEED header read error: {e}')
+        if not self.multistation:
+            # uni-station mode, as in SeedLinkConnection.update_stream
+            if len(self.streams) != 1:
+                raise SeedLinkException('cannot update uni-station stream, stream list does not have exactly one '
+                                        'element')
+            self.streams[0].seqnum = seqnum
+            self.streams[0].btime = UTCDateTime(record.starttime)
+            return
+        for stream in self.streams:
+            if stream.net == record.network and stream.station == record.station:
+                stream.seqnum = seqnum
+                stream.btime = UTCDateTime(record.starttime)
+                return
 
 
 class MonaSeedLinkClient(EasySeedLinkClient):
@@ -39,129 +90,428 @@ class MonaSeedLinkClient(EasySeedLinkClient):
     Methods
     -------
     on_data(tr)
-        When a obspy trace is retrieved, it verifies the metadata, the expired time of it. If all good, it will save
-        into a feather file in the BUFFER_DIR: NET.STA.LOC.CHA the duration QUEUE_DURATION of data into the file.
-        If it's bigger, it will delete half of it to add the data (actually only 30 sec of data are interesting but we
-        save around 180 sec. This can be changed in config.py)
+        When a obspy trace is retrieved, it verifies the metadata, the expired time of it. If all good, the trace goes
+        through the ChannelPipeline of its channel (streaming mean removal and resampling to SAMPLING_RATE, registered
+        at the first packet of the channel), then it is given to the BufferWriter which appends it from its own thread
+        (every FLUSH_INTERVAL) to the ring buffer of the channel in the BUFFER_DIR: NET.STA.LOC.CHA.ring (samples only,
+        the time is given by the start time and the sampling rate of each segment). The ring buffer holds the last
+        QUEUE_DURATION of data (actually only 30 sec of data are interesting but we save around 180 sec. This can be
+        changed in config.py), the oldest samples are overwritten.
 
     run()
         Here is the infinite loop of the SeedLink Client. Each time it gets through one step, it verifies that the
-        streams.data file didn't change (server ip, port and stations). If there's a change, it reboot the connection
-        and adapt it with the new parameters
+        version of the subscription didn't change (server ip, port and stations, sent by MONA on the control channel,
+        see control.py). If there's a change, it is applied by difference (see apply_subscription): only a new server
+        reboots the connection, a removed channel is filtered without reconnecting, and an added channel renegotiates
+        the same connection from the last sequence numbers. The time lost by the other channels is counted.
 
     on_seedlink_error()
     on_terminate()
         They have the same way of working.They delete the connection and put it back on track. Especially useful for
         changing fast of retrieving stations. Maybe some performance increase have to be done here. This is my way.
     """
-    def __init__(self, server_url, data_retrieval=False, begin_time=None, end_time=None):
+    def __init__(self, server_url, data_retrieval=False, begin_time=None, end_time=None, shard=0, shards=1,
+                 autoconnect=True, subscription=None, server=None, writer=None, archive=None, quality=None,
+                 latency=None, availability=None):
 
         try:
-            super(MonaSeedLinkClient, self).__init__(server_url, autoconnect=True)
-            self.conn.timeout = 30
+            super(MonaSeedLinkClient, self).__init__(server_url, autoconnect=False)
+            self.conn = MonaSeedLinkConnection(timeout=30)
+            self.conn.set_sl_address('%s:%d' % (self.server_hostname, self.server_port))
+            if autoconnect:
+                self.connect()
             self.data_retrieval = data_retrieval
             self.begin_time = begin_time
             self.end_time = end_time
             self.streams = []
+            self.server = server_url
+            self.fixed_server = server
+            self.channels = None
+            self.subscription = SubscriptionState.from_file() if subscription is None else subscription
+            self.subscription_version = 0
+            self.shard = shard
+            self.shards = shards
+            self.pipelines = {}
+            self.late_pipelines = {}
+            self.intervals = {}
+            if writer is None:
+                self.writer = BufferWriter()
+                self.writer.start()
+            else:
+                # shared by the clients of the other servers (see run_client)
+                self.writer = writer
+            # raw records of the new packets archived in an SDS tree (see sds_archive.py), None if ARCHIVE_DIR is ''
+            self.archive = archive
+            # aggregates of the quality flags and timing quality of the records (see quality.py)
+            if quality is None:
+                self.quality = QualityTracker()
+                self.quality.start()
+            else:
+                self.quality = quality
+            # latency and gaps of the channels published for the Freshness tab (see latency.py), None to disable it
+            self.latency = latency
+            # time ranges received per channel and per day (see availability.py), None to disable it
+            self.availability = availability
+            # the reception (conn.collect() loop) only fills the queue, the processing thread empties it
+            self.queue = ReceiveQueue()
+            self.processor = threading.Thread(target=self.process_packets, name='MONA packet processing', daemon=True)
+
+            self.packets = 0
+            self.channel_packets = RateSummary(logger)
+            self.collect_time = 0.
+            self.process_time = 0.
+            self.report_time = time.time()
+
+            # sequence numbers of the stations and end of the last packet of the channels, saved to resume without gap
+            self.state = SeedLinkState(server_url, shard)
+            self.state_time = time.time()
+            self.channel_end = self.state.channels
+            self.duplicate_packets = 0
+            self.late_packets = 0
+            self.transition_pending = set()
+            self.transition_loss = {}
+            self.dropped_packets = 0
+            self.failed_records = 0
 
         except SeedLinkException:
             pass
 
     def on_data(self, tr):
-        print(tr)
-        t_start = UTCDateTime()
-        if tr is not None and t_start - tr.stats.starttime <= 300:
-
-            tr.resample(sampling_rate=SAMPLING_RATE)
-            tr.detrend(type='constant')
-
-            if tr.stats.location == '':
-                station = tr.stats.network + '.' + tr.stats.station + '..' + tr.stats.channel
+        logger.debug(tr)
+        if tr is not None and tr.stats.npts > 0:
+            station = '.'.join((tr.stats.network, tr.stats.station, tr.stats.location, tr.stats.channel))
+            if self.latency is not None:
+                # before any filter: a channel whose packets arrive late is the one the Freshness tab has to show
+                self.latency.add(station, tr.stats.starttime.timestamp, tr.stats.endtime.timestamp,
+                                 tr.stats.sampling_rate)
+
+            self.channel_packets.count(station)
+            # old packets (backlog sent again after a resume) are kept as well, add_samples drops the duplicates
+            if self.add_samples(station, tr.stats.starttime.timestamp, tr.stats.sampling_rate, tr.data):
+                if self.availability is not None:
+                    self.availability.add(station, tr.stats.starttime.timestamp, tr.stats.endtime.timestamp,
+                                          tr.stats.sampling_rate)
+        else:
+            logger.warning('blockette contains no trace', extra={'key': 'empty'})
+
+    def on_record(self, record):
+        """
+        Same as on_data for a record decoded by mseed_fast (realtime path of the client), no obspy Trace is made.
+        """
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f'{record.id} | {UTCDateTime(record.starttime)} - {UTCDateTime(record.endtime)} | '
+                         f'{record.sampling_rate:.1f} Hz, {record.npts} samples')
+        self.channel_packets.count(record.id)
+        if record.npts == 0 or record.sampling_rate == 0:
+            logger.warning(f'{record.id}: blockette contains no trace', extra={'key': 'empty:' + record.id})
+            return
+        if self.latency is not None:
+            # before any filter: a channel whose packets arrive late is the one the Freshness tab has to show
+            self.latency.add(record.id, record.starttime, record.endtime, record.sampling_rate)
+        # old packets (backlog sent again after a resume) are kept as well, add_samples drops the duplicates
+        if self.add_samples(record.id, record.starttime, record.sampling_rate, record.data, record):
+            self.quality.add(record)
+            if self.availability is not None:
+                self.availability.add(record.id, record.starttime, record.endtime, record.sampling_rate)
+
+    def add_samples(self, station, starttime, sampling_rate, data, record=None):
+        """
+        :param station: NET.STA.LOC.CHA
+        :param starttime: timestamp (s) of the first sample of the packet
+        :param sampling_rate: sampling rate of the packet
+        :param data: samples of the packet
+        :param record: Record of mseed_fast the samples come from, archived if it is not a duplicate
+        :return: False if the packet was dropped (removed channel, or all its samples were already received)
+        """
+        if self.channels is not None and station not in self.channels:
+            # channel removed from the subscription, the server sends it until the next negotiation
+            self.dropped_packets += 1
+            return False
+        delta = 1. / sampling_rate
+
+        # parts of the packet not received yet (after a resume or a backlog, packets can be sent twice or late)
+        index = self.intervals.get(station)
+        if index is None:
+            index = IntervalIndex(received_until=self.channel_end.get(station))
+            self.intervals[station] = index
+        head = index.end
+        pieces = index.add_packet(starttime, sampling_rate, len(data))
+        if record is not None and self.archive is not None and pieces:
+            # only the records with new samples: a record older than the horizon of the index cannot be told from a
+            # duplicate sent again after a resume or a reconnection, it would be appended twice to the day file
+            self.archive.add(record)
+        if not pieces:
+            self.duplicate_packets += 1
+            return False
+        self.check_continuity(station, starttime, delta, head)
+        self.channel_end[station] = index.end
+
+        for first, n in pieces:
+            piece_starttime = starttime + first * delta
+            if head is not None and piece_starttime + (n - 0.5) * delta <= head:
+                # late part filling a gap, it has its own pipeline so the one of the live data keeps its state
+                pipelines = self.late_pipelines
+                self.late_packets += 1
             else:
-                station = tr.stats.network + '.' + tr.stats.station + '.' + tr.stats.location + '.' + tr.stats.channel
-
-            x = pd.to_datetime(tr.times('timestamp'), unit='s')
-            new_data_sta = pd.DataFrame({'Date': x, 'Data_Sta': tr.data})
+                pipelines = self.pipelines
+
+            # streaming mean removal and resampling to SAMPLING_RATE, the state is kept from one packet to the next
+            pipeline = pipelines.get(station)
+            if pipeline is None:
+                pipeline = ChannelPipeline(sampling_rate)
+                pipelines[station] = pipeline
+            out_starttime, out_rate, out_data = pipeline.process(piece_starttime, sampling_rate, data[first:first + n])
+
+            self.writer.add(station, out_starttime, out_rate, out_data)
+        return True
+
+    def process_packets(self):
+        """
+        Processing stage: the packets waiting in the receive queue (up to RECEIVE_BATCH) are decoded together by
+        mseed_fast, then given to on_record in their order.
+        """
+        while True:
+            batch = self.queue.get_batch(RECEIVE_BATCH)
+            t_process = time.perf_counter()
+            for record in self.decode_batch([packet.msrecord for _, packet in batch]):
+                try:
+                    self.on_record(record)
+                except Exception as e:
+                    # the thread has to go on, else the receive queue would fill and stall the connection
+                    self.failed_records += 1
+                    logger.exception(f'{record.id}: record not processed: {e!r}', extra={'key': 'process:' + record.id})
+            self.packets += len(batch)
+            self.process_time += time.perf_counter() - t_process
+
+    def decode_batch(self, raws):
+        """
+        Decode a batch of records with mseed_fast. If the batch cannot be decoded (malformed record), the records are
+        decoded one by one and the bad ones are logged and skipped.
+        """
+        try:
+            return decode_records(raws)
+        except Exception:
+            pass
+        records = []
+        for raw in raws:
             try:
-                data_sta = pd.read_feather(BUFFER_DIR + '/' + station + '.data')
-                if len(data_sta) <= int(SAMPLING_RATE * QUEUE_DURATION):
-                    data_sta = pd.concat([data_sta, new_data_sta])
-                else:
-                    data_sta = pd.concat([data_sta[round(-len(data_sta) / 2):], new_data_sta])
-            except FileNotFoundError:
-                data_sta = new_data_sta
-            data_sta = data_sta.reset_index(drop=True)
-            data_sta.to_feather(BUFFER_DIR + '/' + station + '.data')
-
-        elif t_start - tr.stats.starttime > 300:
-            print(f'blockette is too old ({(t_start - tr.stats.starttime) / 60} min).\n'
-                  f'Problem could be incorrect computer datetime.')
+                records.extend(decode_records([raw]))
+            except Exception as e:
+                self.failed_records += 1
+                logger.error(f'miniSEED record not decoded: {e!r}', extra={'key': 'decode'})
+        return records
+
+    def apply_subscription(self, new_streams):
+        """
+        Apply a new subscription (server on the first element, then the channels NET.STA.LOC.CHA) by difference with
+        the current one. Only a change of server builds a new SeedLinkConnection. The removed channels are filtered by
+        on_data and their stations are removed from the connection, without reconnecting. The added channels need a
+        new negotiation with the same server: the stations keep their sequence number, so the server sends again what
+        the other channels missed during the reconnection.
+        """
+        old_channels = set(self.streams[1:])
+        new_channels = set(new_streams[1:])
+        if len(new_streams) <= 1:
+            # nothing selected anymore (for this worker), the connection is closed until the next subscription
+            self.conn.disconnect()
+            self.conn.streams = []
+        elif new_streams[0] != self.server:
+            self.connect_server(new_streams)
+            self.start_transition(old_channels, new_channels)
         else:
-            print("blockette contains no trace")
+            stations = {}
+            for stream in new_streams[1:]:
+                full_sta_name = stream.split('.')
+                selector = full_sta_name[2] + full_sta_name[3]
+                stations.setdefault((full_sta_name[0], full_sta_name[1]), []).append(selector)
+            sl_stations = []
+            for sl_station in self.conn.streams:
+                selectors = stations.pop((sl_station.net, sl_station.station), None)
+                if selectors is not None:
+                    sl_station.selectors = selectors
+                    sl_stations.append(sl_station)
+            for (net, sta), selectors in stations.items():
+                sl_stations.append(SLNetStation(net, sta, selectors, self.state.resume_seqnum(net, sta), None))
+            self.conn.streams = sl_stations
+            self.conn.multistation = True
+
+            if new_channels - old_channels:
+                # negotiated again at the next collect(), from the last sequence number of each station
+                self.conn.disconnect()
+                self.start_transition(old_channels, new_channels)
+
+        self.channels = new_channels
+        self.streams = list(new_streams)
+
+    def connect_server(self, new_streams):
+        """New SeedLinkConnection to the server of new_streams[0], with all the channels of new_streams[1:]."""
+        self.save_state(force=True)
+        self._EasySeedLinkClient__streaming_started = False
+        del self.conn
+        self.conn = MonaSeedLinkConnection(timeout=30)
+        new_streams_info = new_streams[0].split(':')
+        if len(new_streams_info) == 1:
+            self.server_hostname = new_streams_info[0]
+            self.server_port = 18000
+        else:
+            self.server_hostname = new_streams_info[0]
+            self.server_port = int(new_streams_info[1])
+        self.conn.set_sl_address('%s:%d' %
+                                 (self.server_hostname, self.server_port))
+        self.conn.multistation = True
+        for station in new_streams[1:]:
+            full_sta_name = station.split('.')
+            net = full_sta_name[0]
+            sta = full_sta_name[1]
+            cha = full_sta_name[2] + full_sta_name[3]
+            self.select_stream(net, sta, cha)
+        self.server = new_streams[0]
+
+        self.state = SeedLinkState(self.server, self.shard)
+        self.channel_end = self.state.channels
+        for sl_station in self.conn.streams:
+            sl_station.seqnum = self.state.resume_seqnum(sl_station.net, sl_station.station)
+
+    def start_transition(self, old_channels, new_channels):
+        """
+        The channels kept by a change of subscription which needed a reconnection are checked at their next packet:
+        the time missing since their last packet is added to transition_loss.
+        """
+        self.transition_pending = old_channels & new_channels
+
+    def save_state(self, force=False):
+        """Save the sequence numbers of the stations every STATE_SAVE_INTERVAL seconds (see SeedLinkState)."""
+        now = time.time()
+        if not force and now - self.state_time < STATE_SAVE_INTERVAL:
+            return
+        self.state_time = now
+        for sl_station in self.conn.streams:
+            if sl_station.seqnum >= 0 and sl_station.btime is not None:
+                self.state.update(sl_station.net, sl_station.station, sl_station.seqnum, sl_station.btime.timestamp)
+        try:
+            self.state.save()
+        except OSError as e:
+            logger.error(f'SeedLink state file not saved: {e}', extra={'key': 'state'})
+
+    def check_continuity(self, station, starttime, delta, expected):
+        if station in self.transition_pending:
+            self.transition_pending.discard(station)
+            gap = starttime - expected if expected is not None else 0.
+            if gap > 0.5 * delta:
+                self.transition_loss[station] = self.transition_loss.get(station, 0.) + gap
+                logger.info(f'{station}: {gap:.2f} s lost while changing the subscription')
+
+    def shard_streams(self, streams):
+        """
+        Keep only the channels of streams.data received by this worker when the ingestion is split between several
+        processes (see IngestSupervisor). The servers are always kept.
+        """
+        if self.shards == 1:
+            return streams
+        return [stream for i, stream in enumerate(streams)
+                if i == 0 or is_server(stream) or shard_of(stream, self.shards) == self.shard]
+
+    def server_streams(self, streams):
+        """
+        Channels of the server of this client (the one given at its creation, else the first one of the subscription),
+        in the format of one server: [server, NET.STA.LOC.CHA, ...]. Empty if the server is not in the subscription.
+        """
+        routes = split_servers(self.shard_streams(streams))
+        server = self.fixed_server if self.fixed_server is not None else next(iter(routes), None)
+        if server not in routes:
+            return []
+        return [server] + routes[server]
+
+    def stats(self):
+        """Counters of the client, also returned by the 'stats' command of the control channel."""
+        return {'packets': self.packets,
+                'queue': self.queue.stats(),
+                'writer': self.writer.stats(),
+                'archive': None if self.archive is None else self.archive.stats(),
+                'transition_loss_s': dict(self.transition_loss),
+                'removed_channel_packets': self.dropped_packets,
+                'duplicate_packets': self.duplicate_packets,
+                'late_packets': self.late_packets,
+                'expired_packets': sum(index.expired for index in list(self.intervals.values())),
+                'failed_records': self.failed_records,
+                'gaps': {station: list(index.gaps) for station, index in list(self.intervals.items()) if index.gaps}}
+
+    def report_stats(self):
+        """
+        Log every INGEST_REPORT_INTERVAL seconds (VERBOSE >= 1) the time spent in the conn.collect() loop (waiting for
+        the packets), the time spent by the processing thread, the state of the receive queue and, separately, the
+        time spent by the writer to flush the ring buffers.
+        """
+        now = time.time()
+        if now - self.report_time < INGEST_REPORT_INTERVAL:
+            return
+        if logger.isEnabledFor(logging.INFO) and self.packets > 0:
+            writer = self.writer.stats()
+            logger.info(f'collect loop: {self.packets} packets in {now - self.report_time:.0f} s, '
+                        f'collect {1000 * self.collect_time / self.packets:.2f} ms/packet, '
+                        f'processing {1000 * self.process_time / self.packets:.2f} ms/packet | '
+                        f'writer: {writer["flushes"]} flushes, {writer["samples"]} samples, '
+                        f'{writer["mean_flush_ms"]:.2f} ms/flush (max {writer["max_flush_ms"]:.2f} ms)')
+            if writer['checkpoints']:
+                logger.info(f'checkpoints: {writer["checkpoints"]} ring buffers ({writer["checkpoint_mb"]:.1f} MB), '
+                            f'{writer["mean_checkpoint_ms"]:.2f} ms/flush (max {writer["max_checkpoint_ms"]:.2f} ms)')
+            queue = self.queue.stats()
+            logger.info(f'receive queue ({queue["policy"]}): {queue["depth"]}/{queue["maxsize"]} packets '
+                        f'(max {queue["max_depth"]}), {queue["dropped"]} dropped, '
+                        f'reception blocked {queue["blocked_s"]:.2f} s')
+            if self.duplicate_packets or self.late_packets:
+                logger.info(f'reassembly: {self.duplicate_packets} packets received twice dropped, '
+                            f'{self.late_packets} late packets inserted')
+            if self.transition_loss or self.dropped_packets:
+                logger.info(f'subscription changes: {sum(self.transition_loss.values()):.2f} s lost in '
+                            f'{len(self.transition_loss)} channels, '
+                            f'{self.dropped_packets} packets of removed channels dropped')
+        self.report_time = now
+        self.queue.reset_max_depth()
+        self.packets = 0
+        self.collect_time = 0.
+        self.process_time = 0.
 
     def run(self):
         if self.data_retrieval is False:
+            if not self.processor.is_alive():
+                self.processor.start()
             while True:
-                try:
-                    with open(BUFFER_DIR+'/streams.data', 'r') as file:
-                        new_streams = file.read().splitlines()
-                        if self.streams != new_streams:
-                            self._EasySeedLinkClient__streaming_started = False
-                            # streams = self.conn.streams.copy()
-                            del self.conn
-                            self.conn = SeedLinkConnection(timeout=30)
-                            new_streams_info = new_streams[0].split(':')
-                            if len(new_streams_info) == 1:
-                                self.server_hostname = new_streams_info[0]
-                                self.server_port = 18000
-                            else:
-                                self.server_hostname = new_streams_info[0]
-                                self.server_port = new_streams_info[1]
-                            self.conn.set_sl_address('%s:%d' %
-                                                     (self.server_hostname, self.server_port))
-                            self.conn.multistation = True
-                            for station in new_streams[1:]:
-                                full_sta_name = station.split('.')
-                                net = full_sta_name[0]
-                                sta = full_sta_name[1]
-                                cha = full_sta_name[2] + full_sta_name[3]
-                                self.select_stream(net, sta, cha)
-
-                            self.streams = new_streams.copy()
-
-                except FileNotFoundError:
-                    print('Waiting for streams.data file...')
-                    time.sleep(5)
-                    if self.data_retrieval:
-                        self.on_terminate()
-                        break
-                else:
-                    if self.data_retrieval:
-                        self.on_terminate()
-                        break
+                if self.subscription.version != self.subscription_version:
+                    # the subscription changed (control channel), nothing is read from the disk in this loop
+                    self.subscription_version = self.subscription.version
+                    self.apply_subscription(self.server_streams(self.subscription.streams))
 
-                    data = self.conn.collect()
+                if len(self.streams) <= 1:
+                    # no channel selected (or none for this worker), wait for the dashboard
+                    self.subscription.wait_change(self.subscription_version, timeout=5)
+                    continue
 
-                    if data == SLPacket.SLTERMINATE:
-                        self.on_terminate()
-                        continue
-                    elif data == SLPacket.SLERROR:
-                        self.on_seedlink_error()
-                        continue
+                t_collect = time.perf_counter()
+                data = self.conn.collect()
+                self.collect_time += time.perf_counter() - t_collect
+
+                if data == SLPacket.SLTERMINATE:
+                    self.on_terminate()
+                    continue
+                elif data == SLPacket.SLERROR:
+                    self.on_seedlink_error()
+                    continue
+
+                # At this point the received data should be a SeedLink packet
+                # XXX In SLClient there is a check for data == None, but I think
+                #     there is no way that self.conn.collect() can ever return None
+                assert(isinstance(data, SLPacket))
 
-                    # At this point the received data should be a SeedLink packet
-                    # XXX In SLClient there is a check for data == None, but I think
-                    #     there is no way that self.conn.collect() can ever return None
-                    assert(isinstance(data, SLPacket))
+                packet_type = data.get_type()
 
-                    packet_type = data.get_type()
+                # Ignore in-stream INFO packets (not supported)
+                if packet_type not in (SLPacket.TYPE_SLINF, SLPacket.TYPE_SLINFT):
+                    # The packet should be a data packet, it is processed by the processing thread
+                    self.queue.put(packet_channel(data), data)
 
-                    # Ignore in-stream INFO packets (not supported)
-                    if packet_type not in (SLPacket.TYPE_SLINF, SLPacket.TYPE_SLINFT):
-                        # The packet should be a data packet
-                        trace = data.get_trace()
-                        # Pass the trace to the on_data callback
-                        self.on_data(trace)
+                self.save_state()
+                self.report_stats()
         elif self.begin_time is not None and self.end_time is not None:
             try:
                 with open(BUFFER_DIR + '/streams.data', 'r') as file:
@@ -175,7 +525,7 @@ class MonaSeedLinkClient(EasySeedLinkClient):
                         self.select_stream(net, sta, cha)
 
             except FileNotFoundError:
-                print('Waiting for streams.data file...')
+                logger.warning('Waiting for streams.data file...')
                 time.sleep(5)
             else:
                 self.conn.set_begin_time(self.begin_time)
@@ -206,11 +556,14 @@ class MonaSeedLinkClient(EasySeedLinkClient):
                         data = self.conn.collect()
 
     # ADAPT
+    # the new connection keeps the SLNetStation of the streams (with the last sequence numbers), the server sends
+    # again what was missed while reconnecting
     def on_terminate(self):
+        self.save_state(force=True)
         self._EasySeedLinkClient__streaming_started = False
         streams = self.conn.streams.copy()
         del self.conn
-        self.conn = SeedLinkConnection(timeout=30)
+        self.conn = MonaSeedLinkConnection(timeout=30)
         self.conn.set_sl_address('%s:%d' %
                                  (self.server_hostname, self.server_port))
         self.conn.multistation = True
@@ -221,10 +574,11 @@ class MonaSeedLinkClient(EasySeedLinkClient):
         # self.conn.begin_time = UTCDateTime()
 
     def on_seedlink_error(self):
+        self.save_state(force=True)
         self._EasySeedLinkClient__streaming_started = False
         streams = self.conn.streams.copy()
         del self.conn
-        self.conn = SeedLinkConnection(timeout=30)
+        self.conn = MonaSeedLinkConnection(timeout=30)
         self.conn.set_sl_address('%s:%d' %
                                  (self.server_hostname, self.server_port))
         self.conn.multistation = True
@@ -249,19 +603,142 @@ class MonaSeedLinkClient(EasySeedLinkClient):
 #         self.client.close()
 
 
-if __name__ == '__main__':
-    # Main algorithm to run the script. it's waiting for MONA to write the streams.data file. It's acting as a service.
-    # Once the client run, it won't stop.
+def shard_of(stream, shards):
+    """
+    Index of the worker which receives a channel NET.STA.LOC.CHA. All the channels of a station go to the same worker,
+    the SeedLink selection is made by station.
+    """
+    full_sta_name = stream.split('.')
+    return zlib.crc32((full_sta_name[0] + '.' + full_sta_name[1]).encode()) % shards
+
+
+def run_client(shard=0, shards=1, use_asyncio=False, subscription=None):
+    """
+    Main algorithm to run the SeedLink client. It starts with the selection of the last streams.data file, then it is
+    waiting for MONA to send the streams on the control channel (see control.py). It's acting as a service. Once the
+    client run, it won't stop. With several workers, each one only receives its shard of the channels and the
+    subscription is given by IngestSupervisor, which owns the control channel.
+
+    The subscription can hold several servers: each server has its own MonaSeedLinkClient in a thread (started when
+    the server appears in the subscription, idle when it is removed), all of them write with the same BufferWriter in
+    the ring buffers of BUFFER_DIR. With use_asyncio, AsyncMonaSeedLinkClient keeps all the connections on one asyncio
+    event loop.
+
+    The client process also keeps the catalogs of streams of the servers (INFO STREAMS, see catalog.py) read by the
+    dashboard, and the compressed history of the channels (see history.py). If ARCHIVE_DIR is set, the records are
+    also archived in an SDS tree (see sds_archive.py). The quality fields of the records are aggregated for the State
+    of Health tab (see quality.py), the latency and gaps of the channels for the Freshness tab (see latency.py) and
+    the time ranges received for the Availability tab (see availability.py). A worker of IngestSupervisor answers the
+    requests about its channels on its own control socket (see worker_address). The messages are logged with
+    mona_logging (level set by VERBOSE). When the process is stopped (SIGTERM, Ctrl-C), these components write what
+    they keep in memory before it exits.
+    """
+    setup_logging()
+    clients = {}
+    writer = BufferWriter()
+    writer.start()
+    quality = QualityTracker(states_path(shard))
+    quality.start()
+    latency = LatencyTracker(latency_path(shard))
+    if shard == 0:
+        # tables of the workers of a previous run with more workers, their channels are now in these tables
+        remove_stale_tables(shards)
+    availability = AvailabilityIndex(shard)
+    availability.start()
+    archive = None
+    if ARCHIVE_DIR:
+        archive = SDSArchive(ARCHIVE_DIR)
+        archive.start()
+    def terminate(signum, frame):
+        # IngestSupervisor stops its workers with SIGTERM: the components are closed by the finally below, a second
+        # signal must not interrupt it
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        sys.exit(0)
+
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, terminate)
+    try:
+        if subscription is None:
+            subscription = SubscriptionState.from_file()
+            control = ControlServer()
+            control.register_subscription(subscription)
+            catalog = CatalogRefresher(lambda: subscription.streams)
+            catalog.register(control)
+            catalog.start()
+        else:
+            control = ControlServer(worker_address(shard))
+        control.register('stats', lambda request: {server: client.stats()
+                                                   for server, client in list(clients.items())})
+        control.register('history', writer.history.request)
+        control.register('quality', quality.request)
+        control.start()
+
+        streams = subscription.wait(timeout=5)
+        while not streams:
+            logger.warning('Waiting for the stations selected in MONA...')
+            streams = subscription.wait(timeout=5)
+
+        if use_asyncio:
+            from async_seedlink import AsyncMonaSeedLinkClient
+            client = AsyncMonaSeedLinkClient(streams[0], shard=shard, shards=shards, subscription=subscription,
+                                             writer=writer, archive=archive, quality=quality,
+                                             latency=latency, availability=availability)
+            clients['all'] = client
+            client.run()  # this is also an infinite loop
+            return
+
+        while True:
+            version = subscription.version
+            for server in split_servers(subscription.streams):
+                if server not in clients:
+                    client = MonaSeedLinkClient(server, shard=shard, shards=shards, autoconnect=False,
+                                                subscription=subscription, server=server, writer=writer,
+                                                archive=archive, quality=quality, latency=latency,
+                                                availability=availability)
+                    clients[server] = client
+                    threading.Thread(target=run_server_client, args=(client,), name=f'MONA SeedLink {server}',
+                                     daemon=True).start()
+            subscription.wait_change(version)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # the data kept in memory (ring buffers, quality states, availability ranges, archive) is written before exit
+        for component in (writer, quality, availability, latency, archive):
+            if component is None:
+                continue
+            try:
+                component.close()
+            except Exception as e:
+                logger.error(f'{type(component).__name__} not closed: {e}')
+
+
+def run_server_client(client):
+    """Thread of the client of one server, if the client crashes, it is started again."""
     while True:
         try:
-            with open(BUFFER_DIR + '/streams.data', 'r') as file:
-                streams = file.read().splitlines()
-                streams_info = streams[0]
-                client = MonaSeedLinkClient(streams_info)
-            client.run()  # this is also an infinite loop, so if the client crashes, script will stay in the main
-        except FileNotFoundError:
-            print('Waiting for streams.data file...')
-            time.sleep(5)
+            client.run()  # this is also an infinite loop
         except SeedLinkException:
-            print('Verify the SeedLink connection information...')
+            logger.error(f'Verify the SeedLink connection information of {client.fixed_server}...')
             time.sleep(5)
+
+
+def get_arguments():
+    """returns AttribDict with command line arguments"""
+    parser = argparse.ArgumentParser(description='launch the SeedLink client of MONA',
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('-w', '--workers', type=int, default=INGEST_WORKERS,
+                        help='Number of processes sharing the channels of streams.data')
+    parser.add_argument('-a', '--asyncio', action='store_true',
+                        help='Use the asyncio SeedLink client instead of the obspy blocking one')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_arguments()
+
+    if args.workers > 1:
+        from ingest_supervisor import IngestSupervisor
+        IngestSupervisor(args.workers, use_asyncio=args.asyncio).run()
+    else:
+        run_client(use_asyncio=args.asyncio)
@@ -0,0 +1,367 @@
+# -*- coding: utf-8 -*-
+# overview.py
+# Author: Jeremy
+# Description: overview of many channels drawn by the dashboard in PNG tiles (record section, min/max per pixel column).
+
+import collections
+import concurrent.futures
+import hashlib
+import io
+import math
+import threading
+import time
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+from flask import Response, abort
+from PIL import Image, ImageDraw
+
+from availability import DAY, covered, load_day
+from config import COLOR_TIME_GRAPH, OVERVIEW_CACHE_TILES, OVERVIEW_CHANNEL_SETS, OVERVIEW_DURATIONS, \
+    OVERVIEW_LABEL_WIDTH, OVERVIEW_REFRESH, OVERVIEW_RENDER_TIMEOUT, OVERVIEW_ROW_HEIGHT, OVERVIEW_TILE_WIDTH, \
+    OVERVIEW_TILES, OVERVIEW_WORKERS, PYRAMID_LEVELS
+from history import trim_segment
+from mona_logging import get_logger
+from pyramid import bin_duration, pyramid_key_paths, read_level
+from ring_buffer import RingBufferReader
+
+logger = get_logger('overview')
+
+OVERVIEW_URL = '/overview'
+BACKGROUND = (17, 17, 17)  # background of the plotly_dark template of the time graphs
+SEPARATOR = (60, 60, 60)
+TEXT = (220, 220, 220)
+
+_readers = None  # ring buffers and pyramid opened by a worker process
+
+
+def tile_duration(zoom):
+    """Duration (s) of a tile of a zoom level (index of OVERVIEW_DURATIONS)."""
+    return OVERVIEW_DURATIONS[zoom] / OVERVIEW_TILES
+
+
+def duration_label(seconds):
+    if seconds % 3600 == 0:
+        return f'{seconds // 3600} h'
+    return f'{seconds // 60} min'
+
+
+def channel_set_key(stations):
+    """Key of a list of channels in the URLs of the tiles, the order of the rows is part of it."""
+    return hashlib.sha1(','.join(stations).encode('ascii')).hexdigest()[:16]
+
+
+def tile_coverage(stations, start, end):
+    """
+    Seconds of [start, end] received for each channel, read in the availability index written by the SeedLink client
+    (see availability.py). It changes when late or backfilled packets reach a tile already over.
+    :return: tuple, one value per channel
+    """
+    seconds = [0.] * len(stations)
+    for day in range(int(start // DAY), int((end - 1e-9) // DAY) + 1):
+        channels = load_day(day)
+        for i, station in enumerate(stations):
+            intervals = channels.get(station)
+            if intervals:
+                seconds[i] += covered(intervals, max(start, day * DAY), min(end, (day + 1) * DAY))
+    return tuple(round(value, 3) for value in seconds)
+
+
+def coverage_version(coverage):
+    """Short version of a coverage in the URL of a tile, the browser loads the tile again when it changes."""
+    return hashlib.sha1(repr(coverage).encode('ascii')).hexdigest()[:8]
+
+
+def raster_level(duration, width):
+    """
+    Coarsest level of the pyramid with at least one bin per column of pixels (0: the samples of the ring buffer).
+    Unlike choose_level (time graphs, about one bin per pixel), a tile never has columns without data.
+    """
+    level = 0
+    for candidate in range(1, PYRAMID_LEVELS + 1):
+        if duration / bin_duration(candidate) < width:
+            break
+        level = candidate
+    return level
+
+
+def read_channel(station, start, end, width):
+    """
+    Segments of a channel between start and end for a tile of `width` columns. When the level chosen does not cover the
+    tile anymore (a level keeps PYRAMID_CAPACITY bins), the next levels are read.
+    """
+    global _readers
+    if _readers is None:
+        _readers = RingBufferReader(), RingBufferReader(pyramid_key_paths)
+    ring_reader, pyramid_reader = _readers
+
+    level = raster_level(end - start, width)
+    if level == 0:
+        try:
+            segments = [trim_segment(segment.starttime, segment.sampling_rate, segment.data, start, end)
+                        for segment in ring_reader.snapshot(station)]
+        except (FileNotFoundError, BlockingIOError):
+            segments = []
+        segments = [segment for segment in segments if segment is not None]
+        if segments:
+            return segments
+        level = 1
+    for level in range(level, PYRAMID_LEVELS + 1):
+        segments = read_level(pyramid_reader, station, level, start, end)
+        if segments and segments[0].starttime <= start + bin_duration(level):
+            return segments
+    return segments
+
+
+def columns(segments, start, end, width):
+    """
+    Minimum and maximum of the points of each column of pixels, NaN for the columns without data.
+    :return: two numpy arrays of `width` values
+    """
+    column_min = np.full(width, np.inf)
+    column_max = np.full(width, -np.inf)
+    scale = width / (end - start)
+    for segment in segments:
+        index = ((segment.times() - start) * scale).astype(np.int64)
+        keep = (index >= 0) & (index < width)
+        index, data = index[keep], np.asarray(segment.data, dtype=np.float64)[keep]
+        np.minimum.at(column_min, index, data)
+        np.maximum.at(column_max, index, data)
+    empty = column_min > column_max
+    column_min[empty] = np.nan
+    column_max[empty] = np.nan
+    return column_min, column_max
+
+
+def draw_row(image, top, height, column_min, column_max, color):
+    """
+    Draw a channel in its row of the image: a vertical line from the minimum to the maximum of each column, joined to
+    the line of the previous column so the trace stays continuous. Each tile has its own scale (from the data of the
+    channel in the tile).
+    """
+    valid = ~np.isnan(column_min)
+    if not valid.any():
+        return
+    low, high = column_min[valid].min(), column_max[valid].max()
+    scale = (height - 2) / (high - low) if high > low else 0.
+    middle = (height - 1) / 2.
+    y_top = np.where(valid, 1 + (high - column_max) * scale if scale else middle, 0).astype(np.int64)
+    y_bottom = np.where(valid, 1 + (high - column_min) * scale if scale else middle, -1).astype(np.int64)
+
+    previous = np.concatenate(([False], valid[:-1]))
+    previous_top = np.concatenate(([0], y_top[:-1]))
+    previous_bottom = np.concatenate(([0], y_bottom[:-1]))
+    y_top = np.where(previous & valid, np.minimum(y_top, previous_bottom), y_top)
+    y_bottom = np.where(previous & valid, np.maximum(y_bottom, previous_top), y_bottom)
+
+    rows = np.arange(height)[:, None]
+    mask = (rows >= y_top[None, :]) & (rows <= y_bottom[None, :])
+    image[top:top + height][mask] = color
+
+
+def hex_color(color):
+    return tuple(int(color[i:i + 2], 16) for i in (1, 3, 5))
+
+
+def render_tile(stations, start, end, width=OVERVIEW_TILE_WIDTH, row_height=OVERVIEW_ROW_HEIGHT):
+    """
+    PNG of a tile: one row per channel (record section), one column of pixels per width-th of [start, end]. Run by
+    the worker processes of OverviewTiles, it only reads the ring buffers and the pyramid written by the SeedLink
+    client.
+    :return: bytes of the PNG
+    """
+    image = np.empty((len(stations) * row_height, width, 3), dtype=np.uint8)
+    image[:] = BACKGROUND
+    color = hex_color(COLOR_TIME_GRAPH)
+    for i, station in enumerate(stations):
+        column_min, column_max = columns(read_channel(station, start, end, width), start, end, width)
+        draw_row(image, i * row_height, row_height - 1, column_min, column_max, color)
+        image[(i + 1) * row_height - 1] = SEPARATOR
+    buffer = io.BytesIO()
+    Image.fromarray(image).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def render_labels(stations, width=OVERVIEW_LABEL_WIDTH, row_height=OVERVIEW_ROW_HEIGHT):
+    """PNG of the names of the channels, on the left of the tiles."""
+    image = Image.new('RGB', (width, len(stations) * row_height), BACKGROUND)
+    draw = ImageDraw.Draw(image)
+    for i, station in enumerate(stations):
+        draw.text((2, i * row_height + max(0, (row_height - 11) // 2)), station, fill=TEXT)
+        draw.line([(0, (i + 1) * row_height - 1), (width, (i + 1) * row_height - 1)], fill=SEPARATOR)
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+class OverviewTiles:
+    """
+    OverviewTiles draws the overview of the channels selected when they are too many for a time graph each: all the
+    channels are rows of PNG tiles, the browser only loads images. A tile covers a time bucket of a zoom level
+    (OVERVIEW_DURATIONS[zoom] / OVERVIEW_TILES seconds, aligned on multiples of it) for a list of channels, its URL is
+        /overview/<key of the channels>/<zoom>/<bucket>.png
+    so the browser and the dashboard keep the tiles already drawn.
+
+    The tiles are rendered by a pool of OVERVIEW_WORKERS processes (numpy and PIL, see render_tile), from the pyramid
+    of the channels (one bin or more per column of pixels), so a tile of a day costs about as much as a tile of a few
+    minutes. The last OVERVIEW_CACHE_TILES tiles are kept in memory. The tiles of the last buckets are rendered again
+    every OVERVIEW_REFRESH milliseconds at most. A tile whose bucket is over (and the next one, for the late packets)
+    is final: it is kept with the coverage of its channels in the availability index (see tile_coverage), and only
+    rendered again when late, backfilled or resumed data changes this coverage; the version of the coverage is in its
+    URL, so the browser keeps it as long as it does not change. A tile asked by several browsers at the same time is
+    rendered once. If a worker dies, the pool is replaced at the next tile.
+
+    Attributes
+    ----------
+    sets : collections.OrderedDict
+        key -> channels (in the order of the rows), registered by the dashboard, the last `max_sets` used
+    tiles : collections.OrderedDict
+        (key, zoom, bucket) -> (time of the rendering, PNG, coverage of a final tile), least recently used first
+    """
+    def __init__(self, workers=OVERVIEW_WORKERS, capacity=OVERVIEW_CACHE_TILES, refresh=OVERVIEW_REFRESH / 1000.,
+                 max_sets=OVERVIEW_CHANNEL_SETS):
+        self.workers = workers
+        self.capacity = capacity
+        self.refresh = refresh
+        self.max_sets = max_sets
+        self.sets = collections.OrderedDict()
+        self.tiles = collections.OrderedDict()
+        self.pending = {}
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def register(self, stations):
+        """
+        Called again at each refresh of the overview, so the lists of channels still shown are not forgotten.
+        :return: key of the channels in the URLs of the tiles
+        """
+        key = channel_set_key(stations)
+        with self._lock:
+            self.sets[key] = tuple(stations)
+            self.sets.move_to_end(key)
+            while len(self.sets) > self.max_sets:
+                self.sets.popitem(last=False)
+        return key
+
+    def is_final(self, zoom, bucket, now=None):
+        """True if the tile does not change anymore (its bucket ended more than a bucket ago)."""
+        now = time.time() if now is None else now
+        return (bucket + 2) * tile_duration(zoom) <= now
+
+    def urls(self, key, zoom, now=None):
+        """URLs of the OVERVIEW_TILES tiles of the window of a zoom level ending now, the oldest first."""
+        now = time.time() if now is None else now
+        last = int(now // tile_duration(zoom))
+        urls = []
+        stations = self.sets.get(key, ())
+        duration = tile_duration(zoom)
+        for bucket in range(last - OVERVIEW_TILES + 1, last + 1):
+            url = f'{OVERVIEW_URL}/{key}/{zoom}/{bucket}.png'
+            if not self.is_final(zoom, bucket, now):
+                # the browser asks again for the tiles which still change
+                url += f'?v={int(now // self.refresh)}'
+            else:
+                url += f'?c={coverage_version(tile_coverage(stations, bucket * duration, (bucket + 1) * duration))}'
+            urls.append(url)
+        return urls
+
+    def pool(self):
+        if self._pool is None:
+            self._pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers)
+        return self._pool
+
+    def discard_pool(self, pool):
+        """Pool broken (a worker was killed, e.g. out of memory): the next tile starts a new one."""
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+        pool.shutdown(wait=False)
+
+    def tile(self, key, zoom, bucket, now=None):
+        """
+        PNG of a tile, from the cache or rendered by the pool.
+        :raise KeyError: unknown channels key
+        :raise IndexError: unknown zoom level
+        """
+        with self._lock:
+            stations = self.sets[key]
+            self.sets.move_to_end(key)
+        duration = tile_duration(zoom)
+        now = time.time() if now is None else now
+        coverage = None
+        if self.is_final(zoom, bucket, now):
+            coverage = tile_coverage(stations, bucket * duration, (bucket + 1) * duration)
+        tile_key = (key, zoom, bucket)
+        with self._lock:
+            cached = self.tiles.get(tile_key)
+            if cached is not None and ((coverage is not None and cached[2] == coverage) or
+                                       (coverage is None and now - cached[0] < self.refresh)):
+                self.tiles.move_to_end(tile_key)
+                return cached[1]
+            future = self.pending.get(tile_key)
+            pool = self._pool
+            if future is None:
+                pool = self.pool()
+                try:
+                    future = pool.submit(render_tile, stations, bucket * duration, (bucket + 1) * duration)
+                except BrokenProcessPool:
+                    self._pool = None
+                    pool.shutdown(wait=False)
+                    raise
+                self.pending[tile_key] = future
+        try:
+            png = future.result(timeout=OVERVIEW_RENDER_TIMEOUT)
+        except BrokenProcessPool:
+            if pool is not None:
+                self.discard_pool(pool)
+            raise
+        finally:
+            with self._lock:
+                if self.pending.get(tile_key) is future and future.done():
+                    del self.pending[tile_key]
+        with self._lock:
+            self.tiles[tile_key] = (now, png, coverage)
+            self.tiles.move_to_end(tile_key)
+            while len(self.tiles) > self.capacity:
+                self.tiles.popitem(last=False)
+        return png
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._pool = None
+
+
+def register_overview(server, tiles):
+    """Routes of the tiles and of the names of the channels on the Flask server of Dash."""
+    @server.route(f'{OVERVIEW_URL}/<key>/<int(signed=True):zoom>/<int(signed=True):bucket>.png')
+    def overview_tile(key, zoom, bucket):
+        if not 0 <= zoom < len(OVERVIEW_DURATIONS):
+            abort(404)
+        try:
+            png = tiles.tile(key, zoom, bucket)
+        except KeyError:
+            abort(404)
+        except concurrent.futures.TimeoutError:
+            logger.warning(f'Overview tile {zoom}/{bucket} not rendered in {OVERVIEW_RENDER_TIMEOUT} s',
+                           extra={'key': 'overview timeout'})
+            abort(503)
+        except BrokenProcessPool:
+            logger.error('Overview rendering process died, the pool is started again', extra={'key': 'overview pool'})
+            abort(503)
+        except Exception:
+            logger.exception(f'Overview tile {zoom}/{bucket} not rendered', extra={'key': 'overview error'})
+            abort(500)
+        if tiles.is_final(zoom, bucket):
+            # the URL of a final tile holds the version of its coverage (see OverviewTiles.urls)
+            cache_control = f'public, max-age={math.ceil(OVERVIEW_DURATIONS[-1])}'
+        else:
+            cache_control = 'no-cache'
+        return Response(png, mimetype='image/png', headers={'Cache-Control': cache_control})
+
+    @server.route(f'{OVERVIEW_URL}/<key>/labels.png')
+    def overview_labels(key):
+        stations = tiles.sets.get(key)
+        if stations is None:
+            abort(404)
+        return Response(render_labels(stations), mimetype='image/png', headers={'Cache-Control': 'no-cache'})
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+# push.py
+# Author: Jeremy
+# Description: push of the new samples, alarms and states to the browser (Server-Sent Events next to the Dash server).
+
+import glob
+import json
+import math
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+from flask import Response, request, stream_with_context
+
+from config import PUSH_HEARTBEAT, PUSH_POLL_INTERVAL, PUSH_QUEUE_SIZE, TIME_DELTA
+from history import trim_segment
+from mona_logging import get_logger
+from ring_buffer import RingBufferReader, segments_to_arrays
+
+logger = get_logger('push')
+
+PUSH_URL = '/push'
+# files written by the other processes of MONA, the browser reads them again when they change
+WATCHED_FILES = {'alarms': 'log/*/alarms.xml', 'states': 'log/*/states*.xml'}
+
+
+def new_samples(reader, station, last, duration=TIME_DELTA.total_seconds()):
+    """
+    Samples of the ring buffer of a station received after the last one drawn by a graph, at most the last `duration`
+    seconds: only the end of the ring buffer is copied. A late packet older than `last` is only shown when the figure
+    is drawn again (zoom, new list of stations).
+    :param reader: RingBufferReader
+    :param last: timestamp (s) of the last sample drawn, None if the graph has no data
+    :return: times (timestamps in s), data and sampling rate, None if there is no new sample
+    """
+    ring = reader.get(station)
+    end = ring.endtime() if ring is not None else None
+    if end is None or (last is not None and end <= last):
+        return None
+    sampling_rate = ring.sampling_rate()
+    start = end - duration
+    if last is not None:
+        start = max(start, last + 0.5 / sampling_rate)
+    try:
+        segments = reader.snapshot(station, min(int((end - start) * sampling_rate) + 2, ring.capacity))
+    except (FileNotFoundError, BlockingIOError):
+        return None
+    segments = [trim_segment(segment.starttime, segment.sampling_rate, segment.data, start, end)
+                for segment in segments]
+    times, data = segments_to_arrays([segment for segment in segments if segment is not None])
+    if len(times) == 0:
+        return None
+    if last is not None and times[0] - last > 1.5 / sampling_rate:
+        # gap since the last sample drawn, not drawn as a line
+        times, data = np.concatenate(([last + 1 / sampling_rate], times)), np.concatenate(([np.nan], data))
+    return times, data, sampling_rate
+
+
+def event(name, data=None):
+    """Server-Sent Event, the data is one line of JSON."""
+    return f'event: {name}\ndata: {json.dumps(data if data is not None else {})}\n\n'
+
+
+def samples_event(station, times, data, sampling_rate):
+    """
+    Event of the new samples of a station for Plotly.extendTraces: dates in ms (a number on a date axis of Plotly is a
+    time in ms) and null for the NaN of the gaps (not valid in JSON).
+    """
+    return event('samples', {'station': station,
+                             'x': [round(t * 1000., 3) for t in times],
+                             'y': [None if math.isnan(value) else float(value) for value in data],
+                             'maxPoints': int(TIME_DELTA.total_seconds() * sampling_rate) + 1})
+
+
+def modification_times(pattern):
+    times = {}
+    for path in glob.glob(pattern):
+        try:
+            times[path] = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            pass
+    return times
+
+
+class Subscriber:
+    """
+    Push stream of a browser: its stations, the timestamp of the last sample sent for each one (None if none) and the
+    queue of its events, filled by PushWatcher.
+    """
+    def __init__(self, stations, since, queue_size=PUSH_QUEUE_SIZE):
+        self.stations = stations
+        self.last = {station: since.get(station) for station in stations}
+        self.queue = queue.Queue(queue_size)
+
+
+class PushWatcher(threading.Thread):
+    """
+    PushWatcher looks for the changes for all the browsers at once: every poll_interval, the end time of the ring
+    buffer of each station subscribed is read once (in its memory-mapped header, nothing is copied for a channel
+    without new samples), and the WATCHED_FILES are listed once. The events are put in the queues of the subscribers;
+    the new samples of a station are copied once per poll for all the browsers at the same point. The cost of a poll
+    grows with the number of stations shown, not with the number of browsers, and the thread waits while no browser
+    is connected.
+
+    If the queue of a slow browser is full, its events are dropped; its samples stay in the ring buffers and are sent
+    later, from the last one it received.
+
+    Attributes
+    ----------
+    subscribers : set
+        Subscriber of the open push streams
+    """
+    def __init__(self, poll_interval=PUSH_POLL_INTERVAL):
+        super().__init__(name='MONA push', daemon=True)
+        self.poll_interval = poll_interval
+        self.subscribers = set()
+        self.reader = RingBufferReader()
+        self._lock = threading.Lock()
+        self._wake_up = threading.Event()
+
+    def subscribe(self, stations, since):
+        subscriber = Subscriber(stations, since)
+        with self._lock:
+            self.subscribers.add(subscriber)
+            if not self.is_alive():
+                self.start()
+        self._wake_up.set()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self.subscribers.discard(subscriber)
+
+    def run(self):
+        files = {}
+        while True:
+            self._wake_up.clear()
+            with self._lock:
+                subscribers = list(self.subscribers)
+            if not subscribers:
+                self.reader.close()
+                self._wake_up.wait()
+                continue
+            try:
+                self.poll(subscribers, files)
+            except Exception as e:
+                # the thread has to go on, else all the push streams stop
+                logger.exception(f'Push watcher error: {e}', extra={'key': 'push'})
+            time.sleep(self.poll_interval)
+
+    def poll(self, subscribers, files):
+        stations = set()
+        for subscriber in subscribers:
+            stations.update(subscriber.stations)
+        for station in [station for station in self.reader.rings if station not in stations]:
+            # channel no longer shown by any browser
+            self.reader.rings.pop(station).close()
+
+        samples = {}  # (station, last) -> event of the new samples, copied once for the browsers at the same point
+        for station in stations:
+            ring = self.reader.get(station)
+            end = ring.endtime() if ring is not None else None
+            if end is None:
+                continue
+            for subscriber in subscribers:
+                if station not in subscriber.last:
+                    continue
+                last = subscriber.last[station]
+                if last is not None and end <= last:
+                    continue
+                if (station, last) not in samples:
+                    new = new_samples(self.reader, station, last)
+                    samples[(station, last)] = (new[0][-1], samples_event(station, *new)) if new is not None else None
+                if samples[(station, last)] is not None:
+                    new_last, message = samples[(station, last)]
+                    if self.send(subscriber, message):
+                        subscriber.last[station] = new_last
+
+        for name, pattern in WATCHED_FILES.items():
+            modified = modification_times(pattern)
+            if name in files and modified != files[name]:
+                for subscriber in subscribers:
+                    self.send(subscriber, event(name))
+            files[name] = modified
+
+    @staticmethod
+    def send(subscriber, message):
+        try:
+            subscriber.queue.put_nowait(message)
+            return True
+        except queue.Full:
+            return False
+
+
+def stream(watcher, stations, since, heartbeat=PUSH_HEARTBEAT):
+    """
+    Events of a browser: the samples of its stations as they are written in the ring buffers by the SeedLink client,
+    and a notification when the alarms or the states files change, given by the PushWatcher shared by all the
+    browsers. A comment is sent after `heartbeat` seconds without event, so the stream of a closed browser stops (the
+    write fails) and leaves the watcher.
+    :param stations: NET.STA.LOC.CHA of the time graphs of the browser
+    :param since: station -> timestamp (s) of the last sample of its graph, the stream starts after it
+    """
+    subscriber = watcher.subscribe(stations, since)
+    try:
+        yield 'retry: 2000\n\n'
+        while True:
+            try:
+                events = [subscriber.queue.get(timeout=heartbeat)]
+            except queue.Empty:
+                yield ': heartbeat\n\n'
+                continue
+            while True:
+                try:
+                    events.append(subscriber.queue.get_nowait())
+                except queue.Empty:
+                    break
+            yield ''.join(events)
+    finally:
+        watcher.unsubscribe(subscriber)
+
+
+def register_push(server):
+    """
+    Route PUSH_URL of the Flask server of Dash, opened by assets/push.js with EventSource:
+        /push?stations=NET.STA.LOC.CHA,...&since=timestamp,...
+    Each browser has its own stream (a thread of the server, which runs with threaded=True), waiting for the events
+    of the PushWatcher of the server.
+    """
+    watcher = PushWatcher()
+
+    @server.route(PUSH_URL)
+    def push():
+        stations = [station for station in request.args.get('stations', '').split(',') if station]
+        since = {}
+        for station, timestamp in zip(stations, request.args.get('since', '').split(',')):
+            try:
+                since[station] = float(timestamp)
+            except ValueError:
+                pass
+        logger.debug(f'push stream opened for {len(stations)} stations')
+        return Response(stream_with_context(stream(watcher, stations, since)), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+# pyramid.py
+# Author: Jeremy
+# Description: min/max decimation pyramid of the channels, written at ingest, read by the time graphs for their zoom.
+
+import math
+import os
+import time
+
+import numpy as np
+
+from config import BUFFER_DIR, PYRAMID_CAPACITY, PYRAMID_FACTOR, PYRAMID_LEVELS, PYRAMID_PIXELS, SAMPLING_RATE
+from history import trim_segment
+from ring_buffer import RingBuffer
+
+
+def pyramid_path(station, level):
+    """Ring buffer of a level of the pyramid of a channel, in the pyramid directory of BUFFER_DIR."""
+    return os.path.join(BUFFER_DIR, 'pyramid', f'{station}.L{level}.ring')
+
+
+def bin_duration(level, factor=PYRAMID_FACTOR, sampling_rate=SAMPLING_RATE):
+    """Duration (s) of a bin of a level: factor samples of the ring buffer for the level 1, factor bins of level - 1."""
+    return factor ** level / sampling_rate
+
+
+def choose_level(duration, pixels=PYRAMID_PIXELS, levels=PYRAMID_LEVELS):
+    """
+    Level giving about one bin (two points, min and max) per pixel for a window of `duration` seconds: 0 (the samples
+    of the ring buffer) while the window has less than two samples per pixel.
+    """
+    if duration * SAMPLING_RATE <= 2 * pixels:
+        return 0
+    for level in range(1, levels + 1):
+        if duration / bin_duration(level) <= pixels:
+            return level
+    return levels
+
+
+class MinMaxLevel:
+    """
+    Bins of one level, aligned on multiples of the bin duration (the bins of all the channels start at the same
+    times). The last bin stays open until a sample of a later bin arrives; the samples older than it (late packets)
+    are not added to the pyramid.
+    """
+    def __init__(self, duration):
+        self.duration = duration
+        self.open_index = None
+        self.open_min = None
+        self.open_max = None
+
+    def add(self, index, mins, maxs):
+        """
+        :param index: index of the bin of each sample (time // duration), increasing
+        :return: index, minimum and maximum of the bins completed by these samples, numpy arrays
+        """
+        if self.open_index is not None:
+            keep = index >= self.open_index
+            if not keep.all():
+                index, mins, maxs = index[keep], mins[keep], maxs[keep]
+        if len(index) == 0:
+            return index, mins, maxs
+
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(index)) + 1))
+        bin_index = index[starts]
+        bin_min = np.minimum.reduceat(mins, starts)
+        bin_max = np.maximum.reduceat(maxs, starts)
+        if self.open_index is not None:
+            if bin_index[0] == self.open_index:
+                bin_min[0] = min(bin_min[0], self.open_min)
+                bin_max[0] = max(bin_max[0], self.open_max)
+            else:
+                bin_index = np.concatenate(([self.open_index], bin_index))
+                bin_min = np.concatenate(([self.open_min], bin_min))
+                bin_max = np.concatenate(([self.open_max], bin_max))
+        self.open_index, self.open_min, self.open_max = int(bin_index[-1]), bin_min[-1], bin_max[-1]
+        return bin_index[:-1], bin_min[:-1], bin_max[:-1]
+
+
+class ChannelPyramid:
+    """
+    Levels of a channel and their ring buffers. A completed bin is written as two points (its minimum then its maximum)
+    at the start and the middle of the bin: a level is a ring buffer of 2 / bin_duration Hz, read like the one of the
+    samples. The bins completed at a level are the samples of the next one.
+    """
+    def __init__(self, station, levels=PYRAMID_LEVELS, factor=PYRAMID_FACTOR, capacity=PYRAMID_CAPACITY):
+        self.station = station
+        self.factor = factor
+        self.levels = [MinMaxLevel(bin_duration(level, factor)) for level in range(1, levels + 1)]
+        self.capacity = capacity
+        self.rings = [None] * levels
+        self.checked = [0.] * levels
+
+    def ring(self, level):
+        """
+        Ring buffer of a level (from 1). Every second at most, it verifies that the file was not removed by the
+        dashboard (delete_residual_data), else it creates it again.
+        """
+        ring = self.rings[level - 1]
+        now = time.time()
+        if ring is not None and now - self.checked[level - 1] > 1:
+            self.checked[level - 1] = now
+            if ring.is_deleted():
+                ring.close()
+                ring = None
+        if ring is None:
+            path = pyramid_path(self.station, level)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            ring = RingBuffer.create(path, capacity=2 * self.capacity)
+            self.rings[level - 1] = ring
+        return ring
+
+    def add(self, starttime, sampling_rate, data):
+        times = starttime + np.arange(len(data)) / sampling_rate
+        index = np.floor(times / self.levels[0].duration).astype(np.int64)
+        mins = maxs = np.asarray(data)
+        for level, min_max in enumerate(self.levels, start=1):
+            if level > 1:
+                # the bins of a level are the samples of the next one, their index is computed exactly from theirs
+                index = index // self.factor
+            index, mins, maxs = min_max.add(index, mins, maxs)
+            if len(index) == 0:
+                return
+            ring = self.ring(level)
+            points = np.empty(2 * len(index), dtype=ring.dtype)
+            points[0::2] = mins
+            points[1::2] = maxs
+            # one append per run of consecutive bins, a missing bin starts a new segment of the ring buffer
+            runs = np.concatenate(([0], np.flatnonzero(np.diff(index) != 1) + 1, [len(index)]))
+            for first, last in zip(runs[:-1], runs[1:]):
+                ring.append(index[first] * min_max.duration, 2. / min_max.duration, points[2 * first:2 * last])
+
+    def close(self):
+        for ring in self.rings:
+            if ring is not None:
+                ring.close()
+        self.rings = [None] * len(self.rings)
+
+
+class Pyramid:
+    """
+    Pyramid keeps, for each channel written by the BufferWriter, PYRAMID_LEVELS levels of minimum and maximum: the
+    level 1 has a bin every PYRAMID_FACTOR samples of the ring buffer, each next level a bin every PYRAMID_FACTOR bins
+    of the previous one. It is updated incrementally with the samples of each flush, the cost of a packet does not
+    depend on the length of the windows.
+
+    Each level is a ring buffer of PYRAMID_CAPACITY bins in BUFFER_DIR/pyramid (see pyramid_path): the coarser levels
+    cover much more time than the ring buffer of the samples (with 8 samples per bin at 25 Hz, 10000 bins are 53 min
+    at the level 1 and 19 days at the level 4). The time graphs read the level which gives about one bin per pixel for
+    their window (see choose_level and read_level), so the data sent to the browser is bounded whatever the window.
+
+    Methods
+    -------
+    add(station, starttime, sampling_rate, data)
+        Called by the BufferWriter with the samples written in the ring buffer.
+    """
+    def __init__(self, levels=PYRAMID_LEVELS, factor=PYRAMID_FACTOR, capacity=PYRAMID_CAPACITY):
+        self.levels = levels
+        self.factor = factor
+        self.capacity = capacity
+        self.channels = {}
+
+    def add(self, station, starttime, sampling_rate, data):
+        if self.levels <= 0:
+            return
+        channel = self.channels.get(station)
+        if channel is None:
+            channel = ChannelPyramid(station, self.levels, self.factor, self.capacity)
+            self.channels[station] = channel
+        channel.add(starttime, sampling_rate, data)
+
+    def close(self):
+        for channel in self.channels.values():
+            channel.close()
+
+
+def read_level(reader, station, level, start, end):
+    """
+    Points of a level of the pyramid of a channel between start and end (timestamps in s), only the end of the ring
+    buffer needed for the window is copied.
+    :param reader: RingBufferReader of the pyramid (see pyramid_reader in app.py)
+    :return: list of Segment ordered in time
+    """
+    ring = reader.get(f'{station}.L{level}')
+    if ring is None:
+        return []
+    ring_end = ring.endtime()
+    if ring_end is None or ring_end < start:
+        return []
+    # whole bins (minimum and maximum) only
+    duration = bin_duration(level)
+    start = math.floor(start / duration) * duration
+    last = int(math.ceil((ring_end - start) * 2. / duration)) + 2
+    try:
+        segments = ring.snapshot(min(last, ring.capacity))
+    except BlockingIOError:
+        return []
+    trimmed = [trim_segment(segment.starttime, segment.sampling_rate, segment.data, start, end)
+               for segment in segments]
+    return [segment for segment in trimmed if segment is not None]
+
+
+def pyramid_key_paths(key):
+    """Paths of a level of the pyramid for RingBufferReader, the key is NET.STA.LOC.CHA.L<level>."""
+    station, level = key.rsplit('.L', 1)
+    return pyramid_path(station, int(level)),
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+# quality.py
+# Author: Jeremy
+# Description: rolling aggregates of the quality flags and timing quality of the miniSEED records received by MONA.
+
+import collections
+import datetime
+import os
+import threading
+
+from config import QUALITY_WINDOW, QUALITY_WRITE_INTERVAL, TIMING_QUALITY_CRITICAL, TIMING_QUALITY_WARNING
+from mona_logging import get_logger
+from utils import format_states_dt
+
+logger = get_logger('quality')
+
+# flags of the fixed header counted for each channel, bit of the combined flags -> name
+# bits 0-7: data quality flags, 8-10: I/O flags, 11: activity flags
+FLAG_NAMES = {0: 'amplifier saturation', 1: 'digitizer clipping', 2: 'spikes', 3: 'glitches', 4: 'missing/padded data',
+              5: 'telemetry sync error', 6: 'filter charging', 7: 'questionable time tag',
+              8: 'parity error', 9: 'long record', 10: 'short record', 11: 'calibration'}
+CLOCK_LOCKED = 0x20  # bit of the I/O and clock flags
+
+
+def combined_flags(record):
+    return record.quality_flags | (record.io_flags & 0x07) << 8 | (record.activity_flags & 0x01) << 11
+
+
+def states_path(shard=0):
+    """File of the aggregates read by the State of Health tab, one per worker of IngestSupervisor."""
+    return 'log/server/states_mseed.xml' if shard == 0 else f'log/server/states_mseed.{shard}.xml'
+
+
+class ChannelQuality:
+    """
+    Aggregates of one channel over the last `window` seconds of records, in 60 bins so a record costs a few additions
+    whatever the window. A bin is [start, records, records with a timing quality, sum and minimum of the timing
+    quality, records with a locked clock, flagged records, counts of each flag].
+    """
+    def __init__(self, window=QUALITY_WINDOW):
+        self.window = window
+        self.bin_duration = window / 60
+        self.bins = collections.deque()
+        self.last_time = None
+        self.last_timing_quality = None
+
+    def add(self, record):
+        bin_start = record.starttime - record.starttime % self.bin_duration
+        if not self.bins or self.bins[-1][0] < bin_start:
+            self.bins.append([bin_start, 0, 0, 0, 101, 0, 0, {}])
+            while self.bins[0][0] <= bin_start - self.window:
+                self.bins.popleft()
+        # a late record is counted in the last bin
+        current = self.bins[-1]
+        current[1] += 1
+        if record.timing_quality is not None:
+            current[2] += 1
+            current[3] += record.timing_quality
+            current[4] = min(current[4], record.timing_quality)
+            self.last_timing_quality = record.timing_quality
+        if record.io_flags & CLOCK_LOCKED:
+            current[5] += 1
+        flags = combined_flags(record)
+        if flags:
+            current[6] += 1
+            counts = current[7]
+            for bit in FLAG_NAMES:
+                if flags >> bit & 1:
+                    counts[bit] = counts.get(bit, 0) + 1
+        if self.last_time is None or record.starttime > self.last_time:
+            self.last_time = record.starttime
+
+    def summary(self):
+        records = timed = timing_sum = locked = flagged = 0
+        timing_min = 101
+        counts = {}
+        for _, n, n_timed, total, minimum, n_locked, n_flagged, bin_counts in self.bins:
+            records += n
+            timed += n_timed
+            timing_sum += total
+            timing_min = min(timing_min, minimum)
+            locked += n_locked
+            flagged += n_flagged
+            for bit, count in bin_counts.items():
+                counts[bit] = counts.get(bit, 0) + count
+        return {'last_time': self.last_time,
+                'records': records,
+                'timing_quality_min': timing_min if timed else None,
+                'timing_quality_mean': timing_sum / timed if timed else None,
+                'timing_quality_last': self.last_timing_quality,
+                'clock_locked': locked,
+                'flagged': flagged,
+                'flags': {FLAG_NAMES[bit]: count for bit, count in sorted(counts.items())}}
+
+
+def state_lines(channel, summary):
+    """Lines <state> of a channel for states_mseed.xml, same format as states.xml (see OracleClient)."""
+    dt = format_states_dt(datetime.datetime.fromtimestamp(summary['last_time'], datetime.timezone.utc))
+    _, _, location, channel_code = channel.split('.')
+    name = f'{location}.{channel_code}' if location else channel_code
+    lines = []
+
+    if summary['timing_quality_min'] is None:
+        value, problem = 'not sent (no blockette 1001)', 0
+    else:
+        value = f"min {summary['timing_quality_min']}% mean {summary['timing_quality_mean']:.0f}% " \
+                f"last {summary['timing_quality_last']}%"
+        problem = 2 if summary['timing_quality_min'] < TIMING_QUALITY_CRITICAL else \
+            1 if summary['timing_quality_min'] < TIMING_QUALITY_WARNING else 0
+    lines.append(f"<state name='{name} Timing quality' datetime='{dt}' value='{value}' problem='{problem}'/>")
+
+    locked = summary['clock_locked']
+    # a datalogger which never sets the flag is not reported as unlocked
+    problem = 1 if 0 < locked < summary['records'] else 0
+    lines.append(f"<state name='{name} Clock locked' datetime='{dt}' "
+                 f"value='{100 * locked / summary['records']:.0f}%' problem='{problem}'/>")
+
+    value = f"{summary['flagged']}/{summary['records']} records"
+    if summary['flags']:
+        value += ' (' + ', '.join(f'{flag} {count}' for flag, count in summary['flags'].items()) + ')'
+    lines.append(f"<state name='{name} Flagged records' datetime='{dt}' value='{value}' "
+                 f"problem='{1 if summary['flagged'] else 0}'/>")
+    return lines
+
+
+class QualityTracker(threading.Thread):
+    """
+    QualityTracker keeps, for each channel, the aggregates of the quality fields of the headers of the records over
+    QUALITY_WINDOW seconds (see ChannelQuality): minimum, mean and last timing quality (blockette 1001), part of the
+    records with a locked clock and counts of the records with data quality, I/O or calibration flags. The fields are
+    read by parse_header with the rest of the header, add() costs a few additions per record.
+
+    Every QUALITY_WRITE_INTERVAL seconds, the aggregates are written in log/server/states_mseed.xml with the format of
+    states.xml, so the State of Health tab shows them with the states of the Oracle database. They are also returned by
+    the 'quality' command of the control channel.
+
+    Methods
+    -------
+    add(record)
+        Called by the SeedLink client for each new record (Record of mseed_fast).
+    summaries()
+        NET.STA.LOC.CHA -> aggregates of the channel.
+    write_states()
+        Write the states file (temporary file then rename).
+    """
+    def __init__(self, path=None, window=QUALITY_WINDOW, write_interval=QUALITY_WRITE_INTERVAL):
+        super(QualityTracker, self).__init__(name='MONA record quality', daemon=True)
+        self.path = states_path() if path is None else path
+        self.window = window
+        self.write_interval = write_interval
+        self.channels = {}
+        self._lock = threading.Lock()
+        self._closing = threading.Event()
+
+    def add(self, record):
+        with self._lock:
+            channel = self.channels.get(record.id)
+            if channel is None:
+                channel = ChannelQuality(self.window)
+                self.channels[record.id] = channel
+            channel.add(record)
+
+    def summaries(self):
+        with self._lock:
+            return {channel: quality.summary() for channel, quality in self.channels.items() if quality.bins}
+
+    def request(self, request):
+        """Handler of the 'quality' command of the control channel."""
+        return {'ok': True, 'channels': self.summaries()}
+
+    def write_states(self):
+        stations = {}
+        for channel, summary in sorted(self.summaries().items()):
+            stations.setdefault(channel.split('.')[1], []).extend(state_lines(channel, summary))
+        if not stations:
+            return
+
+        states_data = "<?xml version='1.0' encoding='utf-8'?>\n<server source='mseed'>\n"
+        for station, lines in stations.items():
+            states_data += f"<station name='{station}'>\n"
+            states_data += f"<state name='MSEED QUALITY TABLE ({self.window / 60:.0f} min)' datetime='' value='' " \
+                           f"problem='' />\n"
+            states_data += '\n'.join(lines) + '\n</station>\n'
+        states_data += '</server>\n'
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as fp:
+            fp.write(states_data)
+        os.replace(temp_path, self.path)
+
+    def run(self):
+        while not self._closing.wait(self.write_interval):
+            try:
+                self.write_states()
+            except OSError as e:
+                logger.error(f'Quality states not written: {e}', extra={'key': 'quality'})
+
+    def close(self):
+        self._closing.set()
+        if self.is_alive():
+            self.join()
+        self.write_states()
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+# receive_queue.py
+# Author: Jeremy
+# Description: bounded queue between the reception and the processing of the SeedLink packets of MONA.
+
+import collections
+import fnmatch
+import itertools
+import queue
+import threading
+import time
+
+from config import CHANNEL_PRIORITIES, RECEIVE_QUEUE_POLICY, RECEIVE_QUEUE_SIZE
+
+POLICIES = ('block', 'drop_oldest', 'priority')
+
+
+def packet_channel(packet):
+    """
+    NET.STA.LOC.CHA of a SeedLink packet, read in the fixed header of its miniSEED record (nothing is decoded).
+    """
+    record = packet.msrecord
+    return '.'.join(record[start:end].decode('ascii', 'replace').strip()
+                    for start, end in ((18, 20), (8, 13), (13, 15), (15, 18)))
+
+
+class ReceiveQueue:
+    """
+    ReceiveQueue holds the packets received by the SeedLink client until the processing thread takes them (decoding,
+    pipelines, BufferWriter), so a slow processing or a burst of packets (backlog sent by the server after a resume)
+    does not stop the reception. The packets are taken in their order of arrival.
+
+    When the queue is full (RECEIVE_QUEUE_SIZE packets), the policy RECEIVE_QUEUE_POLICY is applied:
+        'block': the reception waits for the processing (the server then waits for the client)
+        'drop_oldest': the oldest packet of the queue is dropped
+        'priority': the oldest packet of the channels with the lowest priority is dropped (the new packet itself if
+        its priority is lower than all the waiting ones). The priorities are given by CHANNEL_PRIORITIES, patterns of
+        NET.STA.LOC.CHA -> int, 0 by default, the highest is kept.
+
+    Attributes
+    ----------
+    maxsize : int
+    policy : str
+    received : int
+        number of packets put in the queue
+    dropped : dict
+        NET.STA.LOC.CHA -> number of packets dropped
+    max_depth : int
+        highest number of waiting packets since the last reset_max_depth()
+    blocked_time : float
+        time (s) the reception waited for the processing
+
+    Methods
+    -------
+    put(channel, item, block=True)
+        Called by the reception. With block=False and the 'block' policy, raises queue.Full instead of waiting.
+    get(timeout=None)
+        Called by the processing, returns (channel, item), or None after the timeout.
+    get_batch(max_items, timeout=None)
+        Same for all the waiting packets at once.
+    """
+    def __init__(self, maxsize=RECEIVE_QUEUE_SIZE, policy=RECEIVE_QUEUE_POLICY, priorities=None):
+        if policy not in POLICIES:
+            raise ValueError(f'unknown receive queue policy {policy}, expected one of {POLICIES}')
+        self.maxsize = maxsize
+        self.policy = policy
+        self.priorities = CHANNEL_PRIORITIES if priorities is None else priorities
+        self._priority_cache = {}
+
+        # one FIFO per priority, the order of arrival between them is given by a counter
+        self._queues = {}
+        self._counter = itertools.count()
+        self._depth = 0
+        self._condition = threading.Condition()
+
+        self.received = 0
+        self.dropped = {}
+        self.max_depth = 0
+        self.blocked_time = 0.
+
+    def priority(self, channel):
+        priority = self._priority_cache.get(channel)
+        if priority is None:
+            priority = max((value for pattern, value in self.priorities.items() if fnmatch.fnmatch(channel, pattern)),
+                           default=0)
+            self._priority_cache[channel] = priority
+        return priority
+
+    def put(self, channel, item, block=True):
+        priority = self.priority(channel) if self.policy == 'priority' else 0
+        with self._condition:
+            if self._depth >= self.maxsize:
+                if self.policy == 'block':
+                    if not block:
+                        raise queue.Full
+                    t_start = time.perf_counter()
+                    self._condition.wait_for(lambda: self._depth < self.maxsize)
+                    self.blocked_time += time.perf_counter() - t_start
+                elif self.policy == 'drop_oldest':
+                    self._drop(self._oldest())
+                else:
+                    lowest = min(priority for priority, queue in self._queues.items() if queue)
+                    if priority < lowest:
+                        self.dropped[channel] = self.dropped.get(channel, 0) + 1
+                        return
+                    self._drop(lowest)
+
+            self._queues.setdefault(priority, collections.deque()).append((next(self._counter), channel, item))
+            self._depth += 1
+            self.received += 1
+            self.max_depth = max(self.max_depth, self._depth)
+            self._condition.notify_all()
+
+    def get(self, timeout=None):
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._depth > 0, timeout):
+                return None
+            _, channel, item = self._queues[self._oldest()].popleft()
+            self._depth -= 1
+            self._condition.notify_all()
+            return channel, item
+
+    def get_batch(self, max_items, timeout=None):
+        """
+        Wait for a packet, then take all the waiting ones (max_items at most), in their order.
+        :return: list of (channel, item), empty after the timeout
+        """
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._depth > 0, timeout):
+                return []
+            batch = []
+            while self._depth > 0 and len(batch) < max_items:
+                _, channel, item = self._queues[self._oldest()].popleft()
+                self._depth -= 1
+                batch.append((channel, item))
+            self._condition.notify_all()
+            return batch
+
+    def _oldest(self):
+        """Priority of the queue holding the oldest packet."""
+        return min((queue[0][0], priority) for priority, queue in self._queues.items() if queue)[1]
+
+    def _drop(self, priority):
+        _, channel, _ = self._queues[priority].popleft()
+        self._depth -= 1
+        self.dropped[channel] = self.dropped.get(channel, 0) + 1
+
+    def __len__(self):
+        return self._depth
+
+    def reset_max_depth(self):
+        self.max_depth = self._depth
+
+    def stats(self):
+        return {'depth': self._depth,
+                'max_depth': self.max_depth,
+                'maxsize': self.maxsize,
+                'policy': self.policy,
+                'received': self.received,
+                'dropped': sum(self.dropped.values()),
+                'dropped_channels': dict(self.dropped),
+                'blocked_s': self.blocked_time}
@@ -0,0 +1,436 @@
+# -*- coding: utf-8 -*-
+# ring_buffer.py
+# Author: Jeremy
+# Description: fixed-size per-channel ring buffers shared between the SeedLink client and the dashboard.
+
+import mmap
+import os
+import shutil
+import struct
+import time
+
+import numpy as np
+
+from config import BUFFER_DIR, BUFFER_DTYPE, QUEUE_DURATION, SAMPLING_RATE
+
+RING_MAGIC = b'MONARING'
+RING_VERSION = 2
+RING_EXTENSION = '.ring'
+
+# magic, version, capacity, segment capacity, sample type, write count, sequence, segment count
+HEADER_FORMAT = '<8sIIIIQQQ'
+HEADER_SIZE = 64
+COUNT_OFFSET = 24  # write count, sequence and segment count, three uint64
+SAMPLE_TYPES = {0: np.dtype('<f4'), 1: np.dtype('<i4')}
+SEGMENT_DTYPE = np.dtype([('start_count', '<u8'), ('starttime', '<f8'), ('sampling_rate', '<f8')])
+SEGMENT_CAPACITY = 256
+SNAPSHOT_TIMEOUT = 0.1  # in s, a reader gives up a buffer written during all this time
+
+
+def ring_path(station):
+    """
+    Path of the ring buffer file of a channel NET.STA.LOC.CHA in BUFFER_DIR.
+    """
+    return os.path.join(BUFFER_DIR, station + RING_EXTENSION)
+
+
+def checkpoint_path(station):
+    """
+    Path of the last checkpoint of the ring buffer of a channel, in the checkpoint directory of BUFFER_DIR.
+    """
+    return os.path.join(BUFFER_DIR, 'checkpoint', station + RING_EXTENSION)
+
+
+def default_capacity():
+    return int(SAMPLING_RATE * QUEUE_DURATION)
+
+
+class Segment:
+    """
+    Contiguous samples of a channel: the time of each sample is implicit (starttime + i / sampling_rate), so only the
+    samples are stored. The time axis is computed only when a consumer asks for it.
+    """
+    __slots__ = ('starttime', 'sampling_rate', 'data')
+
+    def __init__(self, starttime, sampling_rate, data):
+        self.starttime = starttime
+        self.sampling_rate = sampling_rate
+        self.data = data
+
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def endtime(self):
+        """Timestamp of the last sample."""
+        return self.starttime + (len(self.data) - 1) / self.sampling_rate
+
+    def times(self):
+        return self.starttime + np.arange(len(self.data)) / self.sampling_rate
+
+
+def segments_to_arrays(segments):
+    """
+    Build the time axis of a list of segments (ordered in time) for a graph. A NaN sample is put between two segments,
+    so the gap is not drawn as a line. The samples of a segment overlapping the previous one are not used, so the time
+    axis never goes back.
+    :return: times (timestamps in s) and data, numpy float64 arrays
+    """
+    times = []
+    data = []
+    previous_end = None
+    for segment in segments:
+        segment_times = segment.times()
+        segment_data = segment.data
+        if previous_end is not None:
+            first = np.searchsorted(segment_times, previous_end, side='right')
+            segment_times, segment_data = segment_times[first:], segment_data[first:]
+        if len(segment_times) == 0:
+            continue
+        if previous_end is not None:
+            times.append([previous_end + 1 / segment.sampling_rate])
+            data.append([np.nan])
+        times.append(segment_times)
+        data.append(segment_data)
+        previous_end = segment_times[-1]
+    if len(times) == 0:
+        return np.array([]), np.array([])
+    return np.concatenate(times), np.concatenate(data).astype(np.float64)
+
+
+class RingBuffer:
+    """
+    RingBuffer is a fixed-size buffer of samples for one channel, stored in a memory-mapped file of BUFFER_DIR. The
+    SeedLink client is the only writer, the dashboard (and the alarms) only read it. Nothing is ever rewritten: a
+    packet is copied at the write position, so an append costs O(packet) whatever the size of the buffer.
+
+    The samples are stored as float32 (or int32) without their time. A small table of segments, also a ring, gives the
+    start time and the sampling rate of each run of contiguous samples: a packet which does not follow the previous one
+    (gap, overlap or new sampling rate) starts a new segment.
+
+    The header holds the total number of samples written and a sequence number. The writer makes the sequence odd
+    before touching the data and even again when it is done, so a reader knows that it has a consistent snapshot if
+    the sequence was even and did not change while it copied the samples (seqlock).
+
+    Layout of the file: header (64 bytes), then the segments table (24 bytes per segment), then the samples.
+
+    Attributes
+    ----------
+    path : str
+        path of the memory-mapped file
+    capacity : int
+        number of samples the buffer can hold before overwriting the oldest ones
+    segment_capacity : int
+        number of segments the buffer can describe before forgetting the oldest ones
+    dtype : numpy.dtype
+        type of the stored samples (float32 or int32)
+    writable : bool
+        True if the buffer was opened by the writer (SeedLink client)
+
+    Methods
+    -------
+    create(path, capacity, dtype)
+        Create (or reuse if the format matches) the file of a channel and open it for writing.
+    open(path)
+        Open an existing file read-only.
+    append(starttime, sampling_rate, data)
+        Write a packet at the write position.
+    snapshot(last=None)
+        Return a consistent copy of the last samples as a list of segments, ordered from the oldest to the newest.
+    checkpoint(path)
+        Copy the whole file (only by the writer, between two appends).
+    """
+    def __init__(self, path, writable=False):
+        self.path = path
+        self.writable = writable
+        self._file = open(path, 'r+b' if writable else 'rb')
+        try:
+            access = mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ
+            self._mm = mmap.mmap(self._file.fileno(), 0, access=access)
+        except ValueError:
+            # empty file, the writer did not initialise it yet
+            self._file.close()
+            raise FileNotFoundError(path)
+
+        magic, version, capacity, segment_capacity, sample_type, _, _, _ = \
+            struct.unpack_from(HEADER_FORMAT, self._mm, 0)
+        if magic != RING_MAGIC or version != RING_VERSION:
+            self.close()
+            raise ValueError(f'{path} is not a ring buffer of MONA (version {RING_VERSION})')
+
+        self.capacity = capacity
+        self.segment_capacity = segment_capacity
+        self.dtype = SAMPLE_TYPES[sample_type]
+        self._counters = np.ndarray((3,), dtype='<u8', buffer=self._mm, offset=COUNT_OFFSET)
+        self._segments = np.ndarray((segment_capacity,), dtype=SEGMENT_DTYPE, buffer=self._mm, offset=HEADER_SIZE)
+        self._data = np.ndarray((capacity,), dtype=self.dtype, buffer=self._mm,
+                                offset=HEADER_SIZE + SEGMENT_DTYPE.itemsize * segment_capacity)
+        self.inode = os.fstat(self._file.fileno()).st_ino
+
+    @classmethod
+    def create(cls, path, capacity=None, dtype=BUFFER_DTYPE, segment_capacity=SEGMENT_CAPACITY, checkpoint=None):
+        """
+        The file of the previous run is reused if it has the same format and was not left in the middle of a write (the
+        SeedLink client was killed during an append). Otherwise, the checkpoint of the channel is restored if it has
+        the same format and its last samples are less than QUEUE_DURATION old, so the graphs do not start empty.
+        :param checkpoint: path of the checkpoint of the channel, None to start without it
+        """
+        if capacity is None:
+            capacity = default_capacity()
+        dtype = np.dtype(dtype).newbyteorder('<')
+        sample_type = [key for key, value in SAMPLE_TYPES.items() if value == dtype][0]
+
+        def same_format(ring):
+            return ring.capacity == capacity and ring.segment_capacity == segment_capacity and ring.dtype == dtype
+
+        try:
+            ring = cls(path, writable=True)
+            if same_format(ring) and ring.sequence % 2 == 0:
+                return ring
+            ring.close()
+        except (FileNotFoundError, ValueError):
+            pass
+
+        if checkpoint is not None:
+            try:
+                saved = cls(checkpoint)
+                try:
+                    endtime = saved.endtime()
+                    usable = same_format(saved) and saved.sequence % 2 == 0 and endtime is not None and \
+                        time.time() - endtime < QUEUE_DURATION
+                finally:
+                    saved.close()
+                if usable:
+                    tmp_path = path + '.tmp'
+                    shutil.copyfile(checkpoint, tmp_path)
+                    os.replace(tmp_path, path)
+                    return cls(path, writable=True)
+            except (FileNotFoundError, ValueError):
+                pass
+
+        size = HEADER_SIZE + SEGMENT_DTYPE.itemsize * segment_capacity + dtype.itemsize * capacity
+        # write to a temporary file and rename it, a reader never sees a half initialised header
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as fp:
+            fp.write(struct.pack(HEADER_FORMAT, RING_MAGIC, RING_VERSION, capacity, segment_capacity, sample_type,
+                                 0, 0, 0).ljust(HEADER_SIZE, b'\0'))
+            fp.truncate(size)
+        os.replace(tmp_path, path)
+        return cls(path, writable=True)
+
+    @classmethod
+    def open(cls, path):
+        return cls(path, writable=False)
+
+    @property
+    def count(self):
+        """Total number of samples written since the creation of the buffer."""
+        return int(self._counters[0])
+
+    @property
+    def sequence(self):
+        return int(self._counters[1])
+
+    def endtime(self):
+        """Timestamp of the last sample written, None if the buffer is empty."""
+        last = self._last_segment()
+        if last is None:
+            return None
+        return float(last['starttime']) + (self.count - 1 - int(last['start_count'])) / float(last['sampling_rate'])
+
+    def sampling_rate(self):
+        """Sampling rate of the last samples written, None if the buffer is empty."""
+        last = self._last_segment()
+        return None if last is None else float(last['sampling_rate'])
+
+    def _last_segment(self):
+        seg_count = int(self._counters[2])
+        if seg_count == 0:
+            return None
+        return self._segments[(seg_count - 1) % self.segment_capacity]
+
+    def append(self, starttime, sampling_rate, data):
+        """
+        Write a packet. If it does not start one sample after the end of the previous packet (within half a sample),
+        a new segment is started.
+        :param starttime: timestamp (s) of the first sample
+        :param sampling_rate: sampling rate of the packet (Hz)
+        :param data: samples, converted to the type of the buffer
+        """
+        data = np.asarray(data)
+        n = len(data)
+        if n == 0:
+            return
+        if n > self.capacity:
+            starttime += (n - self.capacity) / sampling_rate
+            data = data[-self.capacity:]
+            n = self.capacity
+
+        count = int(self._counters[0])
+        seg_count = int(self._counters[2])
+        last = self._last_segment()
+        new_segment = last is None or last['sampling_rate'] != sampling_rate or \
+            abs(last['starttime'] + (count - int(last['start_count'])) / sampling_rate - starttime) > \
+            0.5 / sampling_rate
+
+        pos = count % self.capacity
+        first = min(n, self.capacity - pos)
+
+        self._counters[1] += 1  # odd: write in progress
+        if new_segment:
+            self._segments[seg_count % self.segment_capacity] = (count, starttime, sampling_rate)
+            self._counters[2] = seg_count + 1
+        self._data[pos:pos + first] = data[:first]
+        if first < n:
+            self._data[:n - first] = data[first:]
+        self._counters[0] = count + n
+        self._counters[1] += 1  # even: consistent again
+
+    def _copy(self, count, seg_count, n):
+        start = count - n
+        pos = start % self.capacity
+        end = pos + n
+        if end <= self.capacity:
+            data = self._data[pos:end].copy()
+        else:
+            data = np.concatenate((self._data[pos:], self._data[:end - self.capacity]))
+
+        segments = []
+        seg_end = count
+        for k in range(seg_count - 1, max(seg_count - self.segment_capacity, 0) - 1, -1):
+            seg_start, starttime, sampling_rate = self._segments[k % self.segment_capacity].tolist()
+            if seg_end <= start:
+                break
+            first = max(seg_start, start)
+            starttime += (first - seg_start) / sampling_rate
+            segments.append(Segment(starttime, sampling_rate, data[first - start:seg_end - start]))
+            seg_end = seg_start
+        segments.reverse()
+        return segments
+
+    def snapshot(self, last=None, timeout=SNAPSHOT_TIMEOUT):
+        """
+        Copy the last samples of the buffer without blocking the writer. If the writer was updating the buffer during
+        the copy, the copy is done again after a short pause: a tight loop of the reader would give up during a
+        single append of the writer.
+        :param last: number of samples wanted, all the buffer if None
+        :param timeout: time (s) of the tries before giving up
+        :return: list of Segment, ordered in time
+        """
+        deadline = time.monotonic() + timeout
+        attempt = 0
+        while attempt == 0 or time.monotonic() < deadline:
+            if attempt:
+                # the first tries only yield the CPU, then the pause grows to 1 ms
+                time.sleep(0 if attempt < 4 else min(1e-5 * 2 ** (attempt - 4), 1e-3))
+            attempt += 1
+            seq = int(self._counters[1])
+            if seq % 2 == 1:
+                continue
+            count = int(self._counters[0])
+            seg_count = int(self._counters[2])
+            n = min(count, self.capacity)
+            if last is not None:
+                n = min(n, last)
+            segments = self._copy(count, seg_count, n)
+            if int(self._counters[1]) == seq:
+                # the segments are stored in their order of arrival, a late packet (filling a gap) comes after
+                segments.sort(key=lambda segment: segment.starttime)
+                return segments
+        raise BlockingIOError(f'no consistent snapshot of {self.path}')
+
+    def checkpoint(self, path):
+        """
+        Copy the file of the buffer to path (temporary file synced to the disk then renamed, the checkpoint is never
+        half written, even if the machine stops). Only the writer may call it, between two appends, so the copy is
+        consistent without looking at the sequence.
+        :return: number of bytes written
+        """
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as fp:
+            fp.write(self._mm)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp_path, path)
+        return len(self._mm)
+
+    def is_deleted(self):
+        """True if the file was removed from BUFFER_DIR while it was still open (delete_residual_data)."""
+        return os.fstat(self._file.fileno()).st_nlink == 0
+
+    def close(self):
+        # the numpy views have to be released before the memory map can be closed
+        self._counters = self._segments = self._data = None
+        try:
+            self._mm.close()
+        except (AttributeError, BufferError):
+            pass
+        self._file.close()
+
+
+class RingBufferReader:
+    """
+    Cache of the ring buffers opened read-only by the dashboard. A buffer is opened again if the SeedLink client
+    created a new file for the same channel. While a channel has no ring buffer (the SeedLink client did not write it
+    since it started), its last checkpoint is read instead.
+
+    With `paths`, a function giving the files of a key (the first one existing is read), the reader is used for other
+    ring buffers, e.g. the levels of the pyramid (see pyramid.py).
+    """
+    def __init__(self, paths=None):
+        self.rings = {}
+        self.paths = paths
+
+    def candidates(self, station):
+        if self.paths is None:
+            return ring_path(station), checkpoint_path(station)
+        return self.paths(station)
+
+    def get(self, station):
+        ring = self.rings.get(station)
+        inode = None
+        for path in self.candidates(station):
+            try:
+                inode = os.stat(path).st_ino
+                break
+            except FileNotFoundError:
+                pass
+        if inode is None:
+            if ring is not None:
+                ring.close()
+                del self.rings[station]
+            return None
+
+        if ring is None or ring.inode != inode:
+            if ring is not None:
+                ring.close()
+            try:
+                ring = RingBuffer.open(path)
+            except (FileNotFoundError, ValueError):
+                return None
+            self.rings[station] = ring
+        return ring
+
+    def snapshot(self, station, last=None):
+        ring = self.get(station)
+        if ring is None:
+            raise FileNotFoundError(self.candidates(station)[0])
+        try:
+            return ring.snapshot(last)
+        except BlockingIOError as e:
+            # file left in the middle of a write by a SeedLink client which was killed
+            if len(self.candidates(station)) < 2:
+                raise
+            try:
+                checkpoint = RingBuffer.open(self.candidates(station)[1])
+            except (FileNotFoundError, ValueError):
+                raise e
+            try:
+                return checkpoint.snapshot(last)
+            finally:
+                checkpoint.close()
+
+    def close(self):
+        for ring in self.rings.values():
+            ring.close()
+        self.rings = {}
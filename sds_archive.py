@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+# sds_archive.py
+# Author: Jeremy
+# Description: archive of the raw miniSEED records received by the SeedLink client of MONA, in an SDS tree.
+
+import argparse
+import collections
+import io
+import os
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from obspy import Stream, Trace, UTCDateTime
+
+from config import ARCHIVE_DIR, ARCHIVE_FLUSH_INTERVAL, ARCHIVE_MAX_OPEN_FILES, ARCHIVE_QUEUE_SIZE
+from mona_logging import get_logger
+from mseed_fast import parse_header
+
+logger = get_logger('archive')
+
+
+def sds_path(root, record):
+    """
+    File of the day of a record in the SDS tree: root/YEAR/NET/STA/CHA.D/NET.STA.LOC.CHA.D.YEAR.DOY. A record is
+    archived in the day of its first sample.
+    :param record: Record of mseed_fast
+    """
+    day = time.gmtime(record.starttime)
+    return os.path.join(root, str(day.tm_year), record.network, record.station, record.channel + '.D',
+                        f'{record.id}.D.{day.tm_year}.{day.tm_yday:03d}')
+
+
+class SDSArchive(threading.Thread):
+    """
+    SDSArchive writes the miniSEED records received by the SeedLink client, as they were sent by the server, in the
+    files of an SDS archive (see sds_path). The client only puts the records in a list (add), the files are written by
+    the thread of the archive every flush_interval seconds: the records of each channel-day are written together, in
+    one write call. If the disk is too slow, the list is bounded to queue_size records and the next records are
+    dropped, the reception of the client never waits for the archive.
+
+    The files are kept open between two flushes, max_open_files at most (the least recently used are closed). When
+    the day of a channel changes, the file of the previous day is closed; a late record of the previous day opens it
+    again in append mode.
+
+    Attributes
+    ----------
+    root : str
+        directory of the SDS archive
+    records, bytes, dropped : int
+        numbers of records written, of bytes written and of records dropped
+    write_time, max_write_time : float
+        time (s) spent to write the records (all the flushes, the longest one)
+
+    Methods
+    -------
+    add(record)
+        Called by the SeedLink client for each new record (Record of mseed_fast).
+    flush()
+        Write all the waiting records.
+    close()
+        Flush one last time, stop the thread and close the files.
+    """
+    def __init__(self, root=ARCHIVE_DIR, flush_interval=ARCHIVE_FLUSH_INTERVAL, max_open_files=ARCHIVE_MAX_OPEN_FILES,
+                 queue_size=ARCHIVE_QUEUE_SIZE):
+        super(SDSArchive, self).__init__(name='MONA SDS archive', daemon=True)
+        self.root = root
+        self.flush_interval = flush_interval
+        self.max_open_files = max_open_files
+        self.queue_size = queue_size
+
+        self.files = collections.OrderedDict()  # path -> open file, the least recently used first
+        self.channel_paths = {}  # NET.STA.LOC.CHA -> path of its current day
+        self._paths = {}  # (NET.STA.LOC.CHA, day number) -> path, sds_path is only called once per channel-day
+        self._pending = []
+        self._lock = threading.Lock()
+        self._closing = threading.Event()
+
+        self.records = 0
+        self.bytes = 0
+        self.dropped = 0
+        self.flush_count = 0
+        self.write_time = 0.
+        self.max_write_time = 0.
+
+    def add(self, record):
+        with self._lock:
+            if len(self._pending) >= self.queue_size:
+                self.dropped += 1
+                return
+            self._pending.append(record)
+
+    def run(self):
+        while not self._closing.wait(self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if not pending:
+            return
+
+        t_start = time.perf_counter()
+        days = {}
+        for record in pending:
+            key = (record.id, int(record.starttime // 86400))
+            path = self._paths.get(key)
+            if path is None:
+                if len(self._paths) > 4 * self.max_open_files:
+                    self._paths.clear()
+                path = self._paths[key] = sds_path(self.root, record)
+            days.setdefault(path, []).append(record)
+        for path, records in days.items():
+            channel = records[0].id
+            previous = self.channel_paths.get(channel)
+            if previous is not None and previous < path:
+                # new day (the DOY of a new year is after the one of the previous year, the path has the year first)
+                self.close_file(previous)
+            if previous is None or previous < path:
+                self.channel_paths[channel] = path
+            try:
+                file = self.get_file(path)
+                data = b''.join(record.raw for record in records)
+                file.write(data)
+            except OSError as e:
+                logger.error(f'Archive of {channel} failed: {e}', extra={'key': 'archive:' + channel})
+                self.close_file(path)
+                continue
+            self.records += len(records)
+            self.bytes += len(data)
+        for file in self.files.values():
+            file.flush()
+        duration = time.perf_counter() - t_start
+
+        self.flush_count += 1
+        self.write_time += duration
+        self.max_write_time = max(self.max_write_time, duration)
+
+    def get_file(self, path):
+        file = self.files.get(path)
+        if file is not None:
+            self.files.move_to_end(path)
+            return file
+        while len(self.files) >= self.max_open_files:
+            _, oldest = self.files.popitem(last=False)
+            oldest.close()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        file = open(path, 'ab')
+        self.files[path] = file
+        return file
+
+    def close_file(self, path):
+        file = self.files.pop(path, None)
+        if file is not None:
+            file.close()
+
+    def stats(self):
+        return {'records': self.records,
+                'mb': self.bytes / 1e6,
+                'dropped': self.dropped,
+                'waiting': len(self._pending),
+                'open_files': len(self.files),
+                'mean_flush_ms': 1000 * self.write_time / self.flush_count if self.flush_count else 0.,
+                'max_flush_ms': 1000 * self.max_write_time}
+
+    def close(self):
+        self._closing.set()
+        if self.is_alive():
+            self.join()
+        self.flush()
+        for file in self.files.values():
+            file.close()
+        self.files.clear()
+
+
+def benchmark(channels, duration, root, rate=0., sampling_rate=100.):
+    """
+    Sustained write test: records of 512 bytes of `channels` channels (`duration` seconds of data each, the day changes
+    in the middle) are given to an SDSArchive at `rate` records per second, as fast as possible if 0. It prints the
+    time of add() seen by the client and the throughput of the archive. Only the start time of the headers read by the
+    archive changes, the bytes written are the ones of the first record of each channel.
+    """
+    # one record per channel, its times are shifted to make the following ones
+    samples_per_record = 400
+    start = UTCDateTime(2024, 1, 1) - duration / 2
+    templates = []
+    for i in range(channels):
+        trace = Trace(np.cumsum(np.random.default_rng(i).integers(-20, 20, samples_per_record)).astype(np.int32))
+        trace.stats.network, trace.stats.station, trace.stats.channel = 'XX', f'S{i:04d}', 'HHZ'
+        trace.stats.sampling_rate = sampling_rate
+        trace.stats.starttime = start
+        buffer = io.BytesIO()
+        Stream([trace]).write(buffer, format='MSEED', reclen=512, encoding='STEIM2')
+        templates.append(parse_header(buffer.getvalue()[:512]))
+    record_duration = templates[0].npts / sampling_rate
+
+    archive = SDSArchive(root)
+    archive.start()
+    add_times = []
+    n_records = 0
+    t_bench = time.perf_counter()
+    for k in range(int(duration / record_duration)):
+        if rate > 0:
+            time.sleep(max(0., t_bench + n_records / rate - time.perf_counter()))
+        for template in templates:
+            record = parse_header(template.raw)
+            record.starttime = template.starttime + k * record_duration
+            t_add = time.perf_counter()
+            archive.add(record)
+            add_times.append(time.perf_counter() - t_add)
+            n_records += 1
+    t_feed = time.perf_counter() - t_bench
+    archive.close()
+    t_total = time.perf_counter() - t_bench
+
+    add_times = np.array(add_times) * 1e6
+    stats = archive.stats()
+    print(f'{n_records} records ({channels} channels, {duration:.0f} s of data at {sampling_rate:.0f} Hz), '
+          f'fed at {n_records / t_feed:.0f} records/s')
+    print(f'add(): median {np.median(add_times):.2f} us, 99% {np.percentile(add_times, 99):.2f} us, '
+          f'max {add_times.max():.0f} us')
+    print(f'written {stats["mb"]:.1f} MB in {t_total:.2f} s ({stats["mb"] / t_total:.1f} MB/s, '
+          f'{n_records / t_total:.0f} records/s), dropped {stats["dropped"]}, '
+          f'flush mean {stats["mean_flush_ms"]:.1f} ms max {stats["max_flush_ms"]:.1f} ms')
+
+
+def get_arguments():
+    """returns AttribDict with command line arguments"""
+    parser = argparse.ArgumentParser(description='sustained write benchmark of the SDS archive of MONA',
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('-c', '--channels', type=int, default=300, help='Number of channels')
+    parser.add_argument('-d', '--duration', type=float, default=3600., help='Seconds of data written per channel')
+    parser.add_argument('-r', '--rate', type=float, default=0.,
+                        help='Records given to the archive per second (0: as fast as possible)')
+    parser.add_argument('-o', '--output', default=None, help='Directory of the archive (temporary by default)')
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_arguments()
+
+    if args.output is None:
+        with tempfile.TemporaryDirectory() as directory:
+            benchmark(args.channels, args.duration, directory, args.rate)
+    else:
+        benchmark(args.channels, args.duration, args.output, args.rate)
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+# seedlink_state.py
+# Author: Jeremy
+# Description: state file of the SeedLink client of MONA (last sequence number of each station), to resume without gap.
+
+import glob
+import json
+import os
+import time
+
+from config import ARCHIVE_DIR, BACKFILL_MAX_AGE, BUFFER_DIR, QUEUE_DURATION
+
+
+def state_path(server, shard=0):
+    """State file of a server (host:port) for a worker, in the state directory of BUFFER_DIR."""
+    return BUFFER_DIR + '/state/' + server.replace(':', '_') + '.' + str(shard) + '.json'
+
+
+def resume_max_age():
+    """
+    Age of the oldest packets worth asking again to the server: QUEUE_DURATION, what the buffers of the graphs keep
+    (an older backlog goes through the pipelines and the writer only to be overwritten), or BACKFILL_MAX_AGE if the
+    records are archived (ARCHIVE_DIR).
+    """
+    return BACKFILL_MAX_AGE if ARCHIVE_DIR else float(QUEUE_DURATION)
+
+
+class SeedLinkState:
+    """
+    SeedLinkState keeps, for one SeedLink server, the sequence number and the time of the last packet received from
+    each station (NET.STA), and the end time of the last packet of each channel (NET.STA.LOC.CHA). It is saved in a
+    JSON file of BUFFER_DIR/state (a subdirectory, so delete_residual_data does not remove it) and loaded when the
+    client starts, from the files of all the workers: a station moved to another worker with a new number of workers
+    is resumed as well.
+
+    The sequence numbers are given to the server at the negotiation (DATA seqnum), which sends again the packets
+    missed since then. The end times are used by the client to drop the packets it already received.
+
+    Attributes
+    ----------
+    path : str
+        state file of this worker
+    max_age : float
+        in s, older stations and channels are not resumed and not saved (resume_max_age() by default)
+    stations : dict
+        NET.STA -> [sequence number, timestamp of the last packet]
+    channels : dict
+        NET.STA.LOC.CHA -> timestamp of the end of the last packet
+
+    Methods
+    -------
+    resume_seqnum(net, sta)
+        Sequence number to give to the server for a station, -1 if unknown or older than max_age.
+    update(net, sta, seqnum, timestamp)
+        Called for each packet.
+    save()
+        Write the state file (temporary file then rename, it is never half written). The file receives the state of
+        the previous call: the packets received since then may still wait in the BufferWriter, they must be sent
+        again if the client stops before they are written.
+    """
+    def __init__(self, server, shard=0, max_age=None):
+        self.path = state_path(server, shard)
+        self.max_age = resume_max_age() if max_age is None else max_age
+        self.stations = {}
+        self.channels = {}
+        self.load(server)
+        self._saved = None
+
+    def load(self, server):
+        for path in glob.glob(state_path(server, '*')):
+            try:
+                with open(path, 'r') as file:
+                    state = json.load(file)
+            except (OSError, ValueError):
+                continue
+            for station, (seqnum, timestamp) in state.get('stations', {}).items():
+                if station not in self.stations or self.stations[station][1] < timestamp:
+                    self.stations[station] = [seqnum, timestamp]
+            for channel, end in state.get('channels', {}).items():
+                self.channels[channel] = max(end, self.channels.get(channel, end))
+
+    def resume_seqnum(self, net, sta):
+        seqnum, timestamp = self.stations.get(net + '.' + sta, (-1, 0.))
+        if time.time() - timestamp > self.max_age:
+            # too old, the backlog could not be used
+            return -1
+        return seqnum
+
+    def update(self, net, sta, seqnum, timestamp):
+        self.stations[net + '.' + sta] = [seqnum, timestamp]
+
+    def save(self):
+        state = self._saved
+        self._saved = {'stations': {station: list(value) for station, value in self.stations.items()},
+                       'channels': dict(self.channels)}
+        if state is None:
+            return
+        now = time.time()
+        state['stations'] = {station: value for station, value in state['stations'].items()
+                             if now - value[1] <= self.max_age}
+        state['channels'] = {channel: end for channel, end in state['channels'].items()
+                             if now - end <= self.max_age}
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as file:
+            json.dump(state, file)
+        os.replace(temp_path, self.path)
@@ -1,8 +1,11 @@
 import cx_Oracle
 from config import *
 from bs4 import BeautifulSoup as bs
+from mona_logging import get_logger
 from utils import format_states_dt, base10_to_base2_str
 
+logger = get_logger('state_health')
+
 
 class OracleClient:
     """
@@ -29,9 +32,9 @@ class OracleClient:
                     if sta not in self.stations:
                         self.stations.append(sta)
         except cx_Oracle.ProgrammingError:
-            print('Connection error for HatOracleClient')
+            logger.error('Connection error for HatOracleClient')
         except cx_Oracle.DatabaseError:
-            print('Connection error for HatOracleClient')
+            logger.error('Connection error for HatOracleClient')
 
     def write_state_health(self):
         """
@@ -193,12 +196,12 @@ class OracleClient:
                 fp.write(soup.prettify())
 
         except cx_Oracle.DatabaseError:
-            print('Request is false')
+            logger.error('Request is false', extra={'key': 'oracle request'})
         except FileNotFoundError:
-            print('No states file found')
+            logger.error('No states file found', extra={'key': 'states file'})
 
     def analyze_alarm(self, station, alarm, dt):
-        print(station, alarm, dt)
+        logger.debug(f'{station} alarm {alarm} {dt}')
         try:
             with open('log/server/alarms.xml', 'r', encoding='utf-8'):
                 pass
@@ -241,9 +244,10 @@ class OracleClient:
             with open("log/server/alarms.xml", 'w', encoding='utf-8') as fp:
                 fp.write(bs_content_alarms.prettify())
         except KeyError:
-            print(f"Normal state for XAT station {station} not in config.py.")
+            logger.warning(f"Normal state for XAT station {station} not in config.py.",
+                           extra={'key': 'normal state:' + station})
         except IndexError:
-            print(f"Not enough XAT_ALARM_NAME in config.py to write alarm.")
+            logger.warning(f"Not enough XAT_ALARM_NAME in config.py to write alarm.", extra={'key': 'alarm names'})
 
     def verify_states(self, **parameters):
 
@@ -412,13 +416,13 @@ class OracleClient:
 
 
 def init_oracle_client(path_to_client):
-    print(f'Initializing Oracle client to {path_to_client}')
+    logger.info(f'Initializing Oracle client to {path_to_client}')
     try:
         cx_Oracle.init_oracle_client(path_to_client)
     except cx_Oracle.DatabaseError as e:
-        print(e)
-        print(f"Variable CLIENT_ORACLE for the Oracle Client software not/badly configured in config.py.\n"
-              f"Value: {path_to_client}.")
+        logger.error(e)
+        logger.error(f"Variable CLIENT_ORACLE for the Oracle Client software not/badly configured in config.py.\n"
+                     f"Value: {path_to_client}.")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+# streaming.py
+# Author: Jeremy
+# Description: per-channel streaming processing (mean removal, resampling) of the SeedLink packets.
+
+from fractions import Fraction
+
+import numpy as np
+from scipy.signal import firwin, lfilter
+
+from config import DEMEAN_WINDOW, RESAMPLER_HALF_LENGTH, SAMPLING_RATE
+
+
+class StreamingDemean:
+    """
+    Removes the mean of a channel packet by packet. The mean is an exponential moving average over about DEMEAN_WINDOW
+    seconds, its state is carried from one packet to the next one, so there is no step at the packet boundaries like
+    with a detrend of each packet.
+    """
+    def __init__(self, sampling_rate, window=DEMEAN_WINDOW):
+        self.alpha = min(1., 1. / (sampling_rate * window))
+        self._zi = None
+
+    def process(self, data):
+        data = np.asarray(data, dtype=np.float64)
+        if len(data) == 0:
+            return data
+        if self._zi is None:
+            # start from the mean of the first packet, not from 0
+            self._zi = np.array([(1 - self.alpha) * data.mean()])
+        mean, self._zi = lfilter([self.alpha], [1., -(1 - self.alpha)], data, zi=self._zi)
+        return data - mean
+
+
+class StreamingResampler:
+    """
+    Polyphase FIR resampler by a rational factor up/down (for example 100 Hz -> 25 Hz is 1/4, 40 Hz -> 25 Hz is
+    5/8), fed packet by packet. The last input samples are kept between two packets, so the output is continuous and
+    has no edge effect at the packet boundaries, and there is no FFT of each packet.
+
+    The low-pass filter is the one of scipy.signal.resample_poly (Kaiser window, 2 * RESAMPLER_HALF_LENGTH * max(up,
+    down) + 1 taps). Its group delay is removed from the output times.
+
+    Attributes
+    ----------
+    input_rate, output_rate : float
+        sampling rates (Hz)
+    up, down : int
+        resampling factor
+    starttime : float
+        timestamp of the first input sample since the last reset
+
+    Methods
+    -------
+    process(starttime, data)
+        Resample a packet, returns (starttime, data) of the output samples it makes available. If the packet does not
+        follow the previous one, the state is reset (new segment).
+    """
+    def __init__(self, input_rate, output_rate=SAMPLING_RATE, half_length=RESAMPLER_HALF_LENGTH):
+        self.input_rate = input_rate
+        self.output_rate = output_rate
+        ratio = Fraction(output_rate / input_rate).limit_denominator(1000)
+        self.up, self.down = ratio.numerator, ratio.denominator
+
+        if self.up == self.down == 1:
+            # same sampling rate, the packets are only passed through
+            half_length = 0
+        n_taps = 2 * half_length * max(self.up, self.down) + 1
+        h = np.ones(1) if n_taps == 1 else firwin(n_taps, 1. / max(self.up, self.down), window=('kaiser', 5.0)) * self.up
+        self.n_phase_taps = -(-n_taps // self.up)
+        h = np.concatenate((h, np.zeros(self.n_phase_taps * self.up - n_taps)))
+        # polyphase[p, m] = h[p + m * up]
+        self.polyphase = h.reshape(self.n_phase_taps, self.up).T.copy()
+        self.delay = (n_taps - 1) / 2 / (self.up * input_rate)
+
+        self.starttime = None
+        self._history = None
+        self._next_input = 0
+        self._next_output = 0
+
+    def reset(self, starttime, first_value=0.):
+        self.starttime = starttime
+        # the history is filled with the first value to avoid a transient at the start of a segment
+        self._history = np.full(self.n_phase_taps - 1, first_value, dtype=np.float64)
+        self._next_input = 0
+        self._next_output = 0
+
+    def expected_starttime(self):
+        return self.starttime + self._next_input / self.input_rate
+
+    def process(self, starttime, data):
+        data = np.asarray(data, dtype=np.float64)
+        if len(data) == 0:
+            return starttime, data
+        if self.starttime is None or abs(self.expected_starttime() - starttime) > 0.5 / self.input_rate:
+            self.reset(starttime, data[0])
+
+        if self.up == self.down == 1:
+            self._next_input += len(data)
+            return starttime, data
+
+        buffer = np.concatenate((self._history, data))
+        # absolute input index of buffer[0]
+        base = self._next_input - len(self._history)
+        last_input = self._next_input + len(data) - 1
+
+        # output k needs the input samples up to (k * down) // up
+        end_output = ((last_input + 1) * self.up - 1) // self.down + 1
+        k = np.arange(self._next_output, end_output, dtype=np.int64)
+        out_starttime = self.starttime + self._next_output / self.output_rate - self.delay
+        if len(k) > 0:
+            position = k * self.down
+            phase = position % self.up
+            index = position // self.up - base
+            windows = buffer[index[:, None] - np.arange(self.n_phase_taps)[None, :]]
+            output = np.einsum('ij,ij->i', self.polyphase[phase], windows)
+        else:
+            output = np.array([], dtype=np.float64)
+
+        self._history = buffer[-(self.n_phase_taps - 1):] if self.n_phase_taps > 1 else buffer[:0]
+        self._next_input += len(data)
+        self._next_output = end_output
+        return out_starttime, output
+
+
+class ChannelPipeline:
+    """
+    Processing of one channel NET.STA.LOC.CHA, registered by the SeedLink client at its first packet: streaming mean
+    removal then streaming resampling to SAMPLING_RATE. If the sampling rate of the channel changes, the pipeline
+    starts again.
+    """
+    def __init__(self, sampling_rate, output_rate=SAMPLING_RATE):
+        self.sampling_rate = sampling_rate
+        self.output_rate = output_rate
+        self.demean = StreamingDemean(sampling_rate)
+        self.resampler = StreamingResampler(sampling_rate, output_rate)
+
+    def process(self, starttime, sampling_rate, data):
+        """
+        :param starttime: timestamp (s) of the first sample of the packet
+        :param sampling_rate: sampling rate of the packet
+        :param data: samples of the packet
+        :return: starttime, sampling rate and samples of the processed packet
+        """
+        if sampling_rate != self.sampling_rate:
+            self.__init__(sampling_rate, self.output_rate)
+        starttime, data = self.resampler.process(starttime, self.demean.process(data))
+        return starttime, self.output_rate, data
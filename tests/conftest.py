@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+# conftest.py
+# Author: Jeremy
+# Description: configuration of the tests of MONA (python -m pytest), the modules of MONA are imported from the root.
+
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture
+def buffer_dir(tmp_path, monkeypatch):
+    """BUFFER_DIR of the modules of MONA already imported, in a temporary directory."""
+    for module in list(sys.modules.values()):
+        if os.path.dirname(os.path.abspath(getattr(module, '__file__', None) or '')) == ROOT and \
+                hasattr(module, 'BUFFER_DIR'):
+            monkeypatch.setattr(module, 'BUFFER_DIR', str(tmp_path))
+    return tmp_path
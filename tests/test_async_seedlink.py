@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+# test_async_seedlink.py
+# Author: Jeremy
+# Description: tests of the asyncio SeedLink client.
+
+import asyncio
+from unittest import mock
+
+from async_seedlink import AsyncMonaSeedLinkClient
+from receive_queue import ReceiveQueue
+
+
+def data_packet():
+    packet = mock.Mock()
+    packet.get_type.return_value = -1
+    packet.msrecord = b'000001D AAA  00HHZXX' + bytes(492)
+    return packet
+
+
+def test_full_queue_does_not_block_the_event_loop():
+    client = AsyncMonaSeedLinkClient.__new__(AsyncMonaSeedLinkClient)
+    client.queue = ReceiveQueue(maxsize=1, policy='block')
+
+    async def run():
+        await client.on_packet(data_packet())
+        ticks = 0
+        waiting = asyncio.ensure_future(client.on_packet(data_packet()))
+        # the event loop goes on while the packet waits for a free place in the queue
+        while ticks < 10:
+            await asyncio.sleep(0.005)
+            ticks += 1
+        assert not waiting.done()
+        assert client.queue.get(timeout=1)[0] == 'XX.AAA.00.HHZ'
+        await asyncio.wait_for(waiting, 1)
+        return ticks
+
+    assert asyncio.run(run()) == 10
+    assert client.queue.received == 2
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+# test_availability.py
+# Author: Jeremy
+# Description: tests of the time ranges received per channel.
+
+from availability import insert_interval
+
+
+def test_insert_interval():
+    intervals = []
+    insert_interval(intervals, 0., 10.)
+    insert_interval(intervals, 10., 20.)
+    insert_interval(intervals, 30., 40.)
+    assert intervals == [[0., 20.], [30., 40.]]
+    # late interval in a gap, then one joining the two
+    insert_interval(intervals, 22., 25.)
+    assert intervals == [[0., 20.], [22., 25.], [30., 40.]]
+    insert_interval(intervals, 19., 31.)
+    assert intervals == [[0., 40.]]
+    insert_interval(intervals, 40.005, 50., tolerance=0.01)
+    assert intervals == [[0., 50.]]
+    insert_interval(intervals, -10., -5.)
+    assert intervals == [[-10., -5.], [0., 50.]]
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+# test_buffer_writer.py
+# Author: Jeremy
+# Description: tests of the background writer of the ring buffers.
+
+import numpy as np
+
+from buffer_writer import BufferWriter, coalesce
+from ring_buffer import RingBuffer, ring_path
+
+
+def test_coalesce():
+    chunks = [(0., 10., np.arange(10)), (1., 10., np.arange(10, 20)), (2.02, 10., np.arange(20, 25)),
+              (5., 10., np.arange(3)), (5.3, 20., np.arange(4))]
+    merged = coalesce(chunks)
+    assert [(start, rate, len(data)) for start, rate, data in merged] == [(0., 10., 25), (5., 10., 3), (5.3, 20., 4)]
+    np.testing.assert_array_equal(merged[0][2], np.arange(25))
+    assert coalesce([]) == []
+
+
+def test_flush_writes_the_other_channels_after_an_error(buffer_dir):
+    writer = BufferWriter(checkpoint_interval=0)
+    get_ring = writer.get_ring
+
+    def failing_get_ring(station):
+        if station == 'XX.BAD..HHZ':
+            raise OSError('disk full')
+        return get_ring(station)
+
+    writer.get_ring = failing_get_ring
+    # a late packet is written in its place, the contiguous packets in one segment
+    writer.add('XX.AAA..HHZ', 1., 25., np.arange(25, 50, dtype=np.float32))
+    writer.add('XX.BAD..HHZ', 0., 25., np.zeros(25, dtype=np.float32))
+    writer.add('XX.AAA..HHZ', 0., 25., np.arange(25, dtype=np.float32))
+    writer.flush()
+    assert writer.write_errors == 1
+
+    ring = RingBuffer.open(ring_path('XX.AAA..HHZ'))
+    segments = ring.snapshot()
+    ring.close()
+    writer.close()
+    assert len(segments) == 1
+    np.testing.assert_array_equal(segments[0].data, np.arange(50))
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+# test_control.py
+# Author: Jeremy
+# Description: tests of the control channel between the dashboard and the SeedLink client.
+
+import socketserver
+
+import pytest
+
+from control import ControlServer, SubscriptionState, send_control, split_servers
+
+
+@pytest.fixture
+def control(tmp_path):
+    address = str(tmp_path / 'control' / 'ingest.sock') if hasattr(socketserver, 'ThreadingUnixStreamServer') \
+        else ('127.0.0.1', 0)
+    server = ControlServer(address)
+    server.address = server.server.server_address
+    server.start()
+    yield server
+    server.close()
+
+
+def test_request_response(control):
+    subscription = SubscriptionState()
+    control.register_subscription(subscription)
+    control.register('echo', lambda request: {'ok': True, 'value': request['value']})
+
+    assert send_control({'cmd': 'ping'}, control.address) == {'ok': True}
+    assert send_control({'cmd': 'echo', 'value': [1, 'a']}, control.address) == {'ok': True, 'value': [1, 'a']}
+
+    version = subscription.version
+    streams = ['host:18000', 'XX.AAA..HHZ', 'other:18000', 'YY.BBB.00.BHZ']
+    assert send_control({'cmd': 'subscribe', 'streams': streams}, control.address) == {'ok': True}
+    assert subscription.version == version + 1
+    assert split_servers(subscription.streams) == {'host:18000': ['XX.AAA..HHZ'], 'other:18000': ['YY.BBB.00.BHZ']}
+
+
+def test_unknown_command(control):
+    answer = send_control({'cmd': 'unknown'}, control.address)
+    assert answer['ok'] is False and 'KeyError' in answer['error']
+
+
+def test_no_server(tmp_path):
+    assert send_control({'cmd': 'ping'}, str(tmp_path / 'missing.sock'), timeout=0.1) is None
+
+
+def test_stdlib_servers_are_not_modified(control):
+    assert socketserver.ThreadingTCPServer.daemon_threads is False
+    assert socketserver.ThreadingTCPServer.allow_reuse_address is False
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+# test_history.py
+# Author: Jeremy
+# Description: tests of the compressed history of the channels kept by the SeedLink client.
+
+import numpy as np
+import pytest
+
+from history import ChannelHistory, HistoryBlock, decode_block, encode_block
+
+
+@pytest.mark.parametrize('dtype', ['<i4', '>i4', '<f4', '>f4'])
+def test_encode_decode_lossless(dtype):
+    rng = np.random.default_rng(0)
+    data = np.cumsum(rng.normal(scale=1000., size=3000)).astype(dtype)
+    data[1000] = np.iinfo(np.int32).max if data.dtype.kind == 'i' else 1e30  # a spike
+    if data.dtype.kind == 'i':
+        data[1001] = np.iinfo(np.int32).min  # differences overflow
+    else:
+        data[2000:2003] = [np.nan, np.inf, -0.]
+
+    decoded = decode_block(encode_block(data), data.dtype, len(data))
+    assert decoded.dtype == data.dtype
+    # same bits, NaN and -0. included
+    np.testing.assert_array_equal(decoded.view(np.uint8), data.view(np.uint8))
+    assert len(decode_block(encode_block(data[:0]), data.dtype, 0)) == 0
+
+
+def test_block_to_dict():
+    data = np.arange(100, dtype=np.float32) / 3.
+    block = HistoryBlock(0., 10., len(data), data.dtype, encode_block(data))
+    np.testing.assert_array_equal(HistoryBlock.from_dict(block.to_dict()).decode(), data)
+
+
+def test_blocks_between_late_blocks():
+    history = ChannelHistory(block_duration=10.)
+    history.add(0., 1., np.arange(10, dtype=np.float32))  # [0, 9]
+    history.add(100., 1., np.arange(10, dtype=np.float32))  # gap: [0, 9] closed
+    history.add(20., 1., np.arange(50, dtype=np.float32))  # late, [20, 69], ends after the next block
+    history.add(30., 1., np.arange(10, dtype=np.float32))  # late, [30, 39], nested in the previous one
+    history.close_block()
+    assert history.starts == [0., 20., 30., 100.]
+    assert history.ends == [9., 69., 69., 109.]
+
+    def starts(start, end):
+        return [block.starttime for block in history.blocks_between(start, end)]
+
+    assert starts(50., 60.) == [20.]
+    assert starts(40., 100.) == [20., 100.]
+    assert starts(35., 36.) == [20., 30.]
+    assert starts(10., 19.) == []
+    assert starts(-10., 200.) == [0., 20., 30., 100.]
+
+
+def test_blocks_between_open_block():
+    history = ChannelHistory(block_duration=100.)
+    history.add(0., 1., np.arange(10, dtype=np.int32))
+    blocks = history.blocks_between(5., 6.)
+    assert len(blocks) == 1 and history.blocks == []
+    np.testing.assert_array_equal(blocks[0].decode(), np.arange(10))
+    assert history.blocks_between(20., 30.) == []
+
+
+def test_oldest_blocks_forgotten():
+    history = ChannelHistory(max_bytes=1, block_duration=10.)
+    for i in range(5):
+        history.add(i * 10., 1., np.arange(10, dtype=np.float32))
+    assert history.starts == [40.] and history.ends == [49.]
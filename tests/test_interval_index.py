@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+# test_interval_index.py
+# Author: Jeremy
+# Description: tests of the index of the time ranges received per channel (duplicates, late packets, resume).
+
+import pytest
+
+from interval_index import IntervalIndex
+
+
+def test_duplicates_and_late_packets():
+    index = IntervalIndex()
+    assert index.add_packet(0., 10., 100) == [(0, 100)]
+    # same packet again
+    assert index.add_packet(0., 10., 100) == []
+    # overlapping the end of the last packet: only its new samples
+    assert index.add_packet(5., 10., 100) == [(50, 50)]
+    # after a gap
+    assert index.add_packet(20., 10., 100) == [(0, 100)]
+    assert index.gaps[-1] == pytest.approx((15., 5.))
+    # late packet filling the gap and overlapping both sides
+    assert index.add_packet(14., 10., 100) == [(10, 50)]
+    assert index.starts == [0.] and index.ends == [30.]
+
+
+def test_horizon():
+    index = IntervalIndex(horizon=60.)
+    index.add_packet(0., 10., 100)
+    index.add_packet(100., 10., 100)
+    assert index.forgotten == pytest.approx(50.)
+    # older than the intervals kept: cannot be told from a duplicate
+    assert index.add_packet(20., 10., 100) == []
+    assert index.expired == 1
+    # only its part after the horizon is kept
+    assert index.add_packet(45., 10., 100) == [(50, 50)]
+
+
+def test_resume():
+    index = IntervalIndex(received_until=1000., horizon=60.)
+    assert index.add_packet(990., 10., 100) == []
+    assert index.add_packet(995., 10., 100) == [(50, 50)]
+
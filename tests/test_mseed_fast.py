@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+# test_mseed_fast.py
+# Author: Jeremy
+# Description: tests of the miniSEED decoder of the SeedLink client, compared with obspy.
+
+import io
+
+import numpy as np
+import pytest
+
+from obspy import Trace, UTCDateTime, read
+
+from mseed_fast import decode_records
+
+RECORD_LENGTH = 512
+
+
+def make_records(data, encoding, byteorder='>', sampling_rate=100.):
+    """Records of 512 bytes written by obspy, as a SeedLink server sends them."""
+    trace = Trace(data, header={'network': 'XX', 'station': 'AAA', 'location': '00', 'channel': 'HHZ',
+                                'sampling_rate': sampling_rate, 'starttime': UTCDateTime(2024, 1, 1, 0, 0, 0, 5000)})
+    buffer = io.BytesIO()
+    trace.write(buffer, format='MSEED', encoding=encoding, reclen=RECORD_LENGTH, byteorder=byteorder)
+    raw = buffer.getvalue()
+    return [raw[i:i + RECORD_LENGTH] for i in range(0, len(raw), RECORD_LENGTH)]
+
+
+def seismic_samples(npts, seed=0):
+    """Random walk with bursts, so the differences use all the widths of Steim1 and Steim2."""
+    rng = np.random.default_rng(seed)
+    steps = rng.integers(-8, 8, npts)
+    steps[rng.random(npts) < 0.05] *= 4000
+    steps[rng.random(npts) < 0.01] *= 100000
+    return np.clip(np.cumsum(steps), -2 ** 28, 2 ** 28).astype(np.int32)
+
+
+@pytest.mark.parametrize('encoding, byteorder, dtype', [
+    ('STEIM1', '>', np.int32),
+    ('STEIM2', '>', np.int32),
+    ('INT32', '>', np.int32),
+    ('INT32', '<', np.int32),
+    ('FLOAT32', '>', np.float32),
+])
+def test_decode_records_matches_obspy(encoding, byteorder, dtype):
+    data = seismic_samples(3000).astype(dtype)
+    raws = make_records(data, encoding, byteorder)
+    assert len(raws) > 1
+
+    records = decode_records(raws)
+    assert len(records) == len(raws)
+    for raw, record in zip(raws, records):
+        expected = read(io.BytesIO(raw), format='MSEED', header_byteorder=byteorder)[0]
+        assert record.id == expected.id
+        assert record.starttime == pytest.approx(expected.stats.starttime.timestamp, abs=1e-6)
+        assert record.sampling_rate == expected.stats.sampling_rate
+        assert record.npts == expected.stats.npts
+        np.testing.assert_array_equal(record.data, expected.data)
+    np.testing.assert_array_equal(np.concatenate([record.data for record in records]), data)
+
+
+def test_decode_records_mixed_batch():
+    """A batch holds the records of several channels and encodings, decoded in their order."""
+    raws = make_records(seismic_samples(1000, seed=1), 'STEIM2') + make_records(seismic_samples(1000, seed=2), 'STEIM1')
+    raws += make_records(seismic_samples(500, seed=3), 'INT32')
+    raws = raws[::-1]
+    for raw, record in zip(raws, decode_records(raws)):
+        np.testing.assert_array_equal(record.data, read(io.BytesIO(raw), format='MSEED')[0].data)
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+# test_pyramid.py
+# Author: Jeremy
+# Description: tests of the min/max levels of the pyramid of the channels.
+
+import numpy as np
+
+from pyramid import MinMaxLevel
+
+
+def test_min_max_level():
+    level = MinMaxLevel(1.)
+    index, mins, maxs = level.add(np.array([0, 0, 1, 1, 2]), np.array([1., -1., 3., 2., 5.]),
+                                  np.array([1., -1., 3., 2., 5.]))
+    np.testing.assert_array_equal(index, [0, 1])
+    np.testing.assert_array_equal(mins, [-1., 2.])
+    np.testing.assert_array_equal(maxs, [1., 3.])
+    # the open bin 2 gets the next samples, the late sample of bin 1 is dropped
+    index, mins, maxs = level.add(np.array([1, 2, 3]), np.array([-9., 4., 0.]), np.array([9., 7., 0.]))
+    np.testing.assert_array_equal(index, [2])
+    np.testing.assert_array_equal(mins, [4.])
+    np.testing.assert_array_equal(maxs, [7.])
+    assert level.open_index == 3
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+# test_receive_queue.py
+# Author: Jeremy
+# Description: tests of the policies of the queue between the reception and the processing of the packets.
+
+import queue
+import threading
+import time
+
+import pytest
+
+from receive_queue import ReceiveQueue
+
+
+def test_block():
+    receive_queue = ReceiveQueue(maxsize=2, policy='block')
+    receive_queue.put('XX.AAA..HHZ', 1)
+    receive_queue.put('XX.AAA..HHZ', 2)
+    with pytest.raises(queue.Full):
+        receive_queue.put('XX.AAA..HHZ', 3, block=False)
+
+    thread = threading.Thread(target=receive_queue.put, args=('XX.AAA..HHZ', 3))
+    thread.start()
+    time.sleep(0.05)
+    # the reception waits for the processing
+    assert thread.is_alive() and len(receive_queue) == 2
+    assert receive_queue.get(timeout=1.) == ('XX.AAA..HHZ', 1)
+    thread.join(1.)
+    assert not thread.is_alive()
+    assert receive_queue.get_batch(10, timeout=1.) == [('XX.AAA..HHZ', 2), ('XX.AAA..HHZ', 3)]
+    assert receive_queue.dropped == {} and receive_queue.blocked_time > 0.
+
+
+def test_drop_oldest():
+    receive_queue = ReceiveQueue(maxsize=3, policy='drop_oldest')
+    for i in range(5):
+        receive_queue.put('XX.AAA..HH' + 'ZNE'[i % 3], i)
+    assert receive_queue.get_batch(10) == [('XX.AAA..HHE', 2), ('XX.AAA..HHZ', 3), ('XX.AAA..HHN', 4)]
+    assert receive_queue.dropped == {'XX.AAA..HHZ': 1, 'XX.AAA..HHN': 1}
+    assert receive_queue.received == 5 and receive_queue.max_depth == 3
+
+
+def test_priority():
+    receive_queue = ReceiveQueue(maxsize=3, policy='priority', priorities={'*.HHZ': 2, 'XX.AAA.*': 1})
+    receive_queue.put('XX.BBB..HHN', 'low')
+    receive_queue.put('XX.AAA..HHZ', 'high')
+    receive_queue.put('XX.AAA..HHN', 'middle')
+    # full: the packet of the lowest priority is dropped, even if it is not the oldest
+    receive_queue.put('XX.AAA..HHE', 'middle 2')
+    # lower than all the waiting ones, the new packet itself is dropped
+    receive_queue.put('XX.BBB..HHE', 'low 2')
+    assert receive_queue.get_batch(10) == [('XX.AAA..HHZ', 'high'), ('XX.AAA..HHN', 'middle'),
+                                           ('XX.AAA..HHE', 'middle 2')]
+    assert receive_queue.dropped == {'XX.BBB..HHN': 1, 'XX.BBB..HHE': 1}
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        ReceiveQueue(policy='drop_newest')
+
+
+def test_get_timeout():
+    receive_queue = ReceiveQueue(maxsize=2, policy='block')
+    assert receive_queue.get(timeout=0.01) is None
+    assert receive_queue.get_batch(10, timeout=0.01) == []
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+# test_ring_buffer.py
+# Author: Jeremy
+# Description: tests of the ring buffers shared between the SeedLink client and the dashboard.
+
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from ring_buffer import RingBuffer
+
+
+@pytest.fixture
+def ring(tmp_path):
+    ring = RingBuffer.create(str(tmp_path / 'XX.AAA..HHZ.ring'), capacity=1000)
+    yield ring
+    ring.close()
+
+
+def test_snapshot_during_writes(ring):
+    """Each snapshot taken while the writer appends is consistent: the samples are a ramp of their index."""
+    stop = threading.Event()
+
+    def write():
+        count = 0
+        while not stop.is_set() and count < 10 ** 7:  # float32 ramp stays exact
+            ring.append(count / 100., 100., np.arange(count, count + 37, dtype=np.float32))
+            count += 37
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    reader = RingBuffer.open(ring.path)
+    try:
+        for _ in range(200):
+            segments = reader.snapshot()
+            if not segments:
+                continue
+            assert len(segments) == 1
+            segment = segments[0]
+            first = round(segment.starttime * 100.)
+            np.testing.assert_array_equal(segment.data, np.arange(first, first + len(segment.data)))
+    finally:
+        stop.set()
+        writer.join()
+        reader.close()
+
+
+def test_snapshot_waits_for_the_end_of_a_write(ring):
+    ring.append(0., 100., np.arange(10, dtype=np.float32))
+    reader = RingBuffer.open(ring.path)
+    ring._counters[1] += 1  # odd: write in progress
+    timer = threading.Timer(0.02, lambda: ring._counters.__setitem__(1, ring._counters[1] + 1))
+    timer.start()
+    try:
+        segments = reader.snapshot()
+        assert len(segments[0].data) == 10
+    finally:
+        timer.join()
+        reader.close()
+
+
+def test_snapshot_gives_up_on_a_buffer_left_in_a_write(ring):
+    ring.append(0., 100., np.arange(10, dtype=np.float32))
+    ring._counters[1] += 1
+    started = time.monotonic()
+    with pytest.raises(BlockingIOError):
+        ring.snapshot(timeout=0.05)
+    assert time.monotonic() - started >= 0.05
+
+
+def test_segments_across_changes(ring):
+    ring.append(0., 100., np.arange(100, dtype=np.float32))
+    ring.append(1., 100., np.arange(100, 150, dtype=np.float32))  # follows: same segment
+    ring.append(2., 50., np.arange(10, dtype=np.float32))  # new sampling rate
+    ring.append(3., 50., np.arange(10, 20, dtype=np.float32))  # gap
+    ring.append(1.6, 100., np.arange(5, dtype=np.float32))  # late packet, written last, sorted by time
+
+    segments = ring.snapshot()
+    assert [(segment.starttime, segment.sampling_rate, len(segment.data)) for segment in segments] == \
+        [(0., 100., 150), (1.6, 100., 5), (2., 50., 10), (3., 50., 10)]
+    np.testing.assert_array_equal(segments[0].data, np.arange(150))
+    assert ring.endtime() == pytest.approx(1.64)
+    assert ring.sampling_rate() == 100.
+
+    # the last 30 samples written: the end of the first segment, then the others
+    segments = ring.snapshot(last=30)
+    assert [len(segment.data) for segment in segments] == [5, 5, 10, 10]
+    assert segments[0].starttime == pytest.approx(1.45)
+
+
+def test_oldest_samples_overwritten(ring):
+    for i in range(25):
+        ring.append(i, 100., np.full(100, i, dtype=np.float32))
+    segments = ring.snapshot()
+    assert sum(len(segment.data) for segment in segments) == ring.capacity
+    assert segments[0].starttime == pytest.approx(15.)
+
+
+def test_warm_start_from_checkpoint(tmp_path):
+    path, checkpoint = str(tmp_path / 'XX.AAA..HHZ.ring'), str(tmp_path / 'XX.AAA..HHZ.checkpoint')
+    now = time.time()
+    ring = RingBuffer.create(path, capacity=1000)
+    ring.append(now - 1., 100., np.arange(100, dtype=np.float32))
+    ring.checkpoint(checkpoint)
+    ring.append(now, 100., np.arange(100, 110, dtype=np.float32))
+    ring._counters[1] += 1  # killed in the middle of a write
+    ring.close()
+
+    ring = RingBuffer.create(path, capacity=1000, checkpoint=checkpoint)
+    try:
+        assert ring.sequence % 2 == 0
+        segments = ring.snapshot()
+        assert len(segments) == 1 and segments[0].starttime == pytest.approx(now - 1.)
+        np.testing.assert_array_equal(segments[0].data, np.arange(100))
+    finally:
+        ring.close()
+
+
+@pytest.mark.parametrize('age', [None, 10 ** 6])
+def test_checkpoint_not_usable(tmp_path, age):
+    """An empty checkpoint (no end time) or an old one gives a new empty buffer."""
+    path, checkpoint = str(tmp_path / 'XX.AAA..HHZ.ring'), str(tmp_path / 'XX.AAA..HHZ.checkpoint')
+    ring = RingBuffer.create(checkpoint, capacity=1000)
+    if age is not None:
+        ring.append(time.time() - age, 100., np.arange(100, dtype=np.float32))
+    ring.close()
+
+    ring = RingBuffer.create(path, capacity=1000, checkpoint=checkpoint)
+    try:
+        assert ring.count == 0 and ring.snapshot() == []
+    finally:
+        ring.close()
+
+
+def test_reuse_the_buffer_of_the_previous_run(ring):
+    ring.append(0., 100., np.arange(10, dtype=np.float32))
+    ring.close()
+    ring = RingBuffer.create(ring.path, capacity=1000)
+    try:
+        assert ring.count == 10
+        # another format: a new buffer
+        other = RingBuffer.create(ring.path, capacity=500)
+        assert other.count == 0 and other.capacity == 500
+        other.close()
+    finally:
+        ring.close()
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+# test_sds_archive.py
+# Author: Jeremy
+# Description: tests of the SDS archive of the raw miniSEED records.
+
+import io
+import os
+
+import numpy as np
+
+from obspy import Stream, Trace, UTCDateTime
+
+from mseed_fast import parse_header
+from sds_archive import SDSArchive
+
+
+def make_record(starttime, station='AAA'):
+    trace = Trace(np.arange(100, dtype=np.int32))
+    trace.stats.network, trace.stats.station, trace.stats.channel = 'XX', station, 'HHZ'
+    trace.stats.sampling_rate = 10.
+    trace.stats.starttime = UTCDateTime(starttime)
+    buffer = io.BytesIO()
+    Stream([trace]).write(buffer, format='MSEED', reclen=512, encoding='STEIM2')
+    return parse_header(buffer.getvalue()[:512])
+
+
+def test_day_rotation(tmp_path):
+    archive = SDSArchive(str(tmp_path), max_open_files=10)
+    day_1 = tmp_path / '2023' / 'XX' / 'AAA' / 'HHZ.D' / 'XX.AAA..HHZ.D.2023.365'
+    day_2 = tmp_path / '2024' / 'XX' / 'AAA' / 'HHZ.D' / 'XX.AAA..HHZ.D.2024.001'
+    first, second = make_record('2023-12-31T23:59:00'), make_record('2024-01-01T00:00:30')
+    archive.add(first)
+    archive.flush()
+    assert list(archive.files) == [str(day_1)]
+
+    archive.add(second)
+    archive.flush()
+    # new day: the file of the previous one is closed
+    assert list(archive.files) == [str(day_2)]
+    assert archive.channel_paths == {'XX.AAA..HHZ': str(day_2)}
+
+    # a late record of the previous day is appended to its file, the current day stays the same
+    late = make_record('2023-12-31T23:59:10')
+    archive.add(late)
+    archive.close()
+    assert archive.channel_paths == {'XX.AAA..HHZ': str(day_2)}
+    assert day_1.read_bytes() == first.raw + late.raw
+    assert day_2.read_bytes() == second.raw
+    assert archive.records == 3 and archive.dropped == 0 and archive.files == {}
+
+
+def test_full_queue_and_open_files(tmp_path):
+    archive = SDSArchive(str(tmp_path), max_open_files=2, queue_size=3)
+    for station in ('AAA', 'BBB', 'CCC', 'DDD'):
+        archive.add(make_record('2024-01-01T00:00:00', station))
+    archive.flush()
+    assert archive.records == 3 and archive.dropped == 1
+    # the least recently used file is closed
+    assert [os.path.basename(path) for path in archive.files] == ['XX.BBB..HHZ.D.2024.001', 'XX.CCC..HHZ.D.2024.001']
+    archive.close()
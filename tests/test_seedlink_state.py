@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+# test_seedlink_state.py
+# Author: Jeremy
+# Description: tests of the state file of the SeedLink client (sequence numbers to resume).
+
+import time
+
+import seedlink_state
+from seedlink_state import SeedLinkState, resume_max_age
+
+
+def test_save_and_resume(buffer_dir):
+    now = time.time()
+    state = SeedLinkState('localhost:18000', shard=0, max_age=600.)
+    state.update('XX', 'AAA', 42, now - 10.)
+    state.update('XX', 'OLD', 7, now - 3600.)
+    state.channels['XX.AAA..HHZ'] = now - 10.
+    state.save()
+    # the first save only keeps the state, written at the next one
+    assert not (buffer_dir / 'state').exists()
+    state.update('XX', 'AAA', 43, now - 5.)
+    state.save()
+
+    resumed = SeedLinkState('localhost:18000', shard=1, max_age=600.)
+    assert resumed.resume_seqnum('XX', 'AAA') == 42
+    assert resumed.resume_seqnum('XX', 'OLD') == -1
+    assert resumed.resume_seqnum('XX', 'BBB') == -1
+    assert resumed.channels == {'XX.AAA..HHZ': now - 10.}
+
+
+def test_resume_window(buffer_dir, monkeypatch):
+    monkeypatch.setattr(seedlink_state, 'ARCHIVE_DIR', '')
+    assert resume_max_age() == seedlink_state.QUEUE_DURATION
+    monkeypatch.setattr(seedlink_state, 'ARCHIVE_DIR', str(buffer_dir / 'archive'))
+    assert resume_max_age() == seedlink_state.BACKFILL_MAX_AGE
+
+    state = SeedLinkState('localhost:18000', max_age=60.)
+    state.update('XX', 'AAA', 42, time.time() - 120.)
+    assert state.resume_seqnum('XX', 'AAA') == -1
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+# test_streaming.py
+# Author: Jeremy
+# Description: tests of the streaming processing of the channels (mean removal, resampling).
+
+import numpy as np
+import pytest
+from scipy.signal import upfirdn
+
+from streaming import StreamingDemean, StreamingResampler
+
+
+def packets(data, seed=0):
+    """Cut the samples in packets of random lengths, as received from a SeedLink server."""
+    rng = np.random.default_rng(seed)
+    cuts = np.sort(rng.choice(np.arange(1, len(data)), 30, replace=False))
+    return np.split(data, cuts)
+
+
+def signal(npts, seed=1):
+    rng = np.random.default_rng(seed)
+    data = np.cumsum(rng.normal(size=npts)) + 10 * np.sin(np.arange(npts) / 7.)
+    data[0] = 0.  # the history of the resampler starts with the first value, as the zeros of upfirdn
+    return data
+
+
+@pytest.mark.parametrize('input_rate', [100., 40., 25., 20.])
+def test_resampler_packets_match_one_shot(input_rate):
+    data = signal(4000)
+    streaming = StreamingResampler(input_rate, 25.)
+    one_shot = StreamingResampler(input_rate, 25.)
+
+    outputs = []
+    starttime = 1000.
+    first_output_time = None
+    for packet in packets(data):
+        out_starttime, output = streaming.process(starttime, packet)
+        if first_output_time is None:
+            first_output_time = out_starttime
+        outputs.append(output)
+        starttime += len(packet) / input_rate
+    out_starttime, expected = one_shot.process(1000., data)
+
+    assert first_output_time == pytest.approx(out_starttime)
+    np.testing.assert_allclose(np.concatenate(outputs), expected, rtol=1e-12, atol=1e-9)
+
+    # same samples as the polyphase filter of scipy on the whole signal
+    h = streaming.polyphase.T.ravel()
+    reference = upfirdn(h, data, streaming.up, streaming.down)[:len(expected)]
+    np.testing.assert_allclose(expected, reference, rtol=1e-12, atol=1e-9)
+    assert out_starttime == pytest.approx(1000. - streaming.delay)
+
+
+def test_resampler_gap_starts_a_new_segment():
+    resampler = StreamingResampler(100., 25.)
+    resampler.process(0., np.ones(400))
+    starttime, output = resampler.process(10., np.ones(400))
+    assert resampler.starttime == 10.
+    assert starttime == pytest.approx(10. - resampler.delay)
+
+
+def test_demean_packets_match_one_shot():
+    data = signal(3000) + 500.
+    streaming = StreamingDemean(100.)
+    pieces = packets(data)
+    output = np.concatenate([streaming.process(packet) for packet in pieces])
+
+    # after the same first packet (the mean starts from its mean), the rest in one call gives the same samples
+    one_shot = StreamingDemean(100.)
+    one_shot.process(pieces[0])
+    np.testing.assert_allclose(output[len(pieces[0]):], one_shot.process(data[len(pieces[0]):]), rtol=1e-12,
+                               atol=1e-9)
+    assert abs(output[-1000:].mean()) < abs(data[-1000:].mean()) / 10
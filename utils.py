@@ -2,7 +2,13 @@ import os
 import xml.etree.ElementTree as ET
 from bs4 import BeautifulSoup as BS
 
+from catalog import is_expired, read_catalog
 from config import BUFFER_DIR
+from control import send_control
+from mona_logging import get_logger
+from ring_buffer import RING_EXTENSION
+
+logger = get_logger('dashboard')
 
 
 def format_date_to_str(number, nb_digit):
@@ -37,23 +43,56 @@ def base10_to_base2_str(num):
     return res
 
 
+def parse_servers(value):
+    """
+    Servers written in the connection input of MONA, separated by commas: 'host1:port1, host2' (port 18000 if not
+    given).
+    :return: list of (hostname, port)
+    """
+    servers = []
+    for server in value.split(','):
+        server_info = server.strip().split(':')
+        if server_info[0] == '':
+            continue
+        if len(server_info) == 1:
+            servers.append((server_info[0], 18000))
+        else:
+            servers.append((server_info[0], int(server_info[1])))
+    return servers
+
+
 def get_network_list(type_connection, network_list, network_list_values,
                      server_hostname=None, server_port=None, folder_file=None):
-
+    """
+    Fill the lists of the channels (dropdown options and values) of a server or of a folder. For a server, the catalog
+    of its streams kept by the SeedLink client (INFO STREAMS, see catalog.py) is used first; the SeedLink client is
+    asked to refresh it if it is missing or expired. Without catalog, the channels are read in the StationXML file of
+    config/server.
+    :return: 1 if channels were found, -1 if the config file is missing, -2 if it has no station, None if the
+    arguments are not given
+    """
     if type_connection == 'server':
         if server_hostname is not None and server_port is not None:
             stations_xml = server_hostname + '.' + str(server_port) + '.xml'
+            server = f'{server_hostname}:{server_port}'
+            catalog = read_catalog(server)
+            if is_expired(catalog):
+                send_control({'cmd': 'catalog', 'servers': [server]})
+            if catalog is not None and catalog['channels']:
+                network_list_values.extend(catalog['channels'])
+                network_list.extend({'label': full_name, 'value': full_name} for full_name in catalog['channels'])
+                return 1
         else:
-            print('Server hostname/port not defined.')
+            logger.error('Server hostname/port not defined.')
             return None
     elif type_connection == 'folder':
         if folder_file is not None:
             stations_xml = folder_file
         else:
-            print('Folder file not defined')
+            logger.error('Folder file not defined')
             return None
     else:
-        print('type_connection not defined')
+        logger.error('type_connection not defined')
         return None
     try:
         with open(f'config/{type_connection}/{stations_xml}', 'r') as fp:
@@ -69,28 +108,37 @@ def get_network_list(type_connection, network_list, network_list_values,
                 for bs_channel in bs_station.find_all('Channel'):
                     full_name = network + '.' + station + '.' + \
                                 bs_channel.get('locationCode') + '.' + bs_channel.get('code')
-                    print(full_name)
                     network_list_values.append(full_name)
                     network_list.append({'label': full_name, 'value': full_name})
 
+        logger.info(f'{len(network_list_values)} channels read in config/{type_connection}/{stations_xml}')
         return 1
 
     except FileNotFoundError:
-        print('Config file missing.')
+        logger.error('Config file missing.')
         return -1
     except IndexError:
-        print('Verify the config file, no station found')
+        logger.error('Verify the config file, no station found')
         return -2
 
 
-def delete_residual_data(delete_streams=True):
+def delete_residual_data(delete_streams=True, delete_rings=True):
+    """
+    Remove the files left in BUFFER_DIR. With delete_rings=False, the ring buffers (and their checkpoints and pyramids)
+    are kept, so the graphs of a dashboard started again show at once the data received before.
+    """
     try:
         for file in os.listdir(BUFFER_DIR):
             if os.path.isdir(BUFFER_DIR+'/'+file) or file == 'streams.data':
                 pass
-            else:
+            elif delete_rings or not file.endswith(RING_EXTENSION):
                 os.remove(BUFFER_DIR+'/'+file)
-        os.remove(BUFFER_DIR + '/streams.data')
+        for directory in ('/checkpoint', '/pyramid'):
+            if delete_rings and os.path.isdir(BUFFER_DIR + directory):
+                for file in os.listdir(BUFFER_DIR + directory):
+                    os.remove(BUFFER_DIR + directory + '/' + file)
+        if delete_streams:
+            os.remove(BUFFER_DIR + '/streams.data')
     except PermissionError:
         pass
     except FileNotFoundError: